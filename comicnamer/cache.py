@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Persistent cache of volume and issue names, stored in an SQLite database
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+
+def log():
+    """Returns the logger for current file
+    """
+    return logging.getLogger(__name__)
+
+
+class LookupCache(object):
+    """Caches volume search results, keyed by normalised volume name, and
+    issue names, keyed by volume id and issue number, in the SQLite database
+    at path.
+
+    Complete issue lists of volumes are stored as their issues, and an
+    entry in the listings table recording that the list is complete, with
+    the number of issues. Using a list marks its issues as used, and a list
+    some of whose issues were removed is ignored.
+
+    Lookups which failed because the volume or issue does not exist are
+    cached separately (see getMissing), so they can expire sooner.
+
+    Entries older than ttl (or negative_ttl) seconds are ignored, and
+    replaced when next fetched. When a table holds more than max_entries
+    rows, the least recently used are removed. With refresh, existing
+    entries are ignored but still replaced, so the cache is repopulated.
+
+    Writes are committed at most once a second, and on close().
+    """
+
+    # Tables are recreated when this changes
+    schema_version = 2
+
+    tables = {
+        'volumes': """
+            CREATE TABLE volumes (
+                name TEXT PRIMARY KEY,
+                volumeid INTEGER,
+                volumename TEXT,
+                fetched REAL,
+                used REAL)""",
+        'issues': """
+            CREATE TABLE issues (
+                volumeid INTEGER,
+                issueno TEXT,
+                issuename TEXT,
+                fetched REAL,
+                used REAL,
+                PRIMARY KEY (volumeid, issueno))""",
+        'listings': """
+            CREATE TABLE listings (
+                volumeid INTEGER PRIMARY KEY,
+                issues INTEGER,
+                fetched REAL,
+                used REAL)""",
+        'missing': """
+            CREATE TABLE missing (
+                kind TEXT,
+                key TEXT,
+                message TEXT,
+                fetched REAL,
+                used REAL,
+                PRIMARY KEY (kind, key))""",
+    }
+
+    commit_every = 1.0
+
+    def __init__(self, path, ttl, max_entries, refresh = False, negative_ttl = None):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        if negative_ttl is None:
+            self.negative_ttl = ttl
+        else:
+            self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.refresh = refresh
+
+        self._lock = threading.Lock()
+        self._committed = time.time()
+
+        self._db = sqlite3.connect(self.path, timeout = 30, check_same_thread = False)
+        try:
+            # Lets other comicnamer processes read while this one writes
+            self._db.execute("PRAGMA journal_mode = WAL")
+        except sqlite3.DatabaseError:
+            pass
+        self._createTables()
+
+    def _createTables(self):
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        existing = set(row[0] for row in self._db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+        for name, schema in sorted(self.tables.items()):
+            if name in existing and version != self.schema_version:
+                log().info("Recreating cache table %s for new schema" % name)
+                self._db.execute("DROP TABLE %s" % name)
+                existing.discard(name)
+            if name not in existing:
+                self._db.execute(schema)
+                self._db.execute("CREATE INDEX %s_used ON %s (used)" % (name, name))
+
+        self._db.execute("PRAGMA user_version = %d" % self.schema_version)
+        self._db.commit()
+
+    def _ttl(self, table):
+        if table == 'missing':
+            return self.negative_ttl
+        return self.ttl
+
+    def _get(self, table, columns, where, params):
+        """Returns the requested columns of the matching, unexpired row, or
+        None
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            row = None
+            if not self.refresh:
+                row = self._db.execute(
+                    "SELECT rowid, %s FROM %s WHERE %s AND fetched > ?" % (columns, table, where),
+                    params + (now - self._ttl(table), )).fetchone()
+
+            if row is None:
+                return None
+
+            self._db.execute("UPDATE %s SET used = ? WHERE rowid = ?" % table, (now, row[0]))
+            self._maybeCommit(now)
+            return row[1:]
+        finally:
+            self._lock.release()
+
+    def _set(self, table, values):
+        """Inserts or replaces a row, values being a dict of column values
+        """
+        now = time.time()
+        values = dict(values, fetched = now, used = now)
+        columns = sorted(values)
+
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+                table, ", ".join(columns), ", ".join("?" * len(columns))),
+                [values[x] for x in columns])
+            self._maybeCommit(now)
+        finally:
+            self._lock.release()
+
+    def _maybeCommit(self, now):
+        if now - self._committed > self.commit_every:
+            self._db.commit()
+            self._committed = now
+
+    def getVolume(self, name):
+        """Returns (volumeid, volumename) for a normalised volume name, or None
+        """
+        return self._get('volumes', 'volumeid, volumename', 'name = ?', (name, ))
+
+    def setVolume(self, name, volumeid, volumename):
+        self._set('volumes', {'name': name, 'volumeid': volumeid, 'volumename': volumename})
+
+    def getIssueName(self, volumeid, issueno):
+        """Returns the name of an issue, or None
+        """
+        row = self._get('issues', 'issuename', 'volumeid = ? AND issueno = ?',
+            (volumeid, unicode(issueno)))
+        if row is None:
+            return None
+        return row[0]
+
+    def setIssueName(self, volumeid, issueno, issuename):
+        self._set('issues', {'volumeid': volumeid, 'issueno': unicode(issueno), 'issuename': issuename})
+
+    def getListing(self, volumeid):
+        """Returns a dict of issue number to name of every issue of a volume,
+        or None if the complete list is not cached
+        """
+        row = self._get('listings', 'issues', 'volumeid = ?', (volumeid, ))
+        if row is None:
+            return None
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            issues = dict(self._db.execute(
+                "SELECT issueno, issuename FROM issues WHERE volumeid = ? AND fetched > ?",
+                (volumeid, now - self.ttl)).fetchall())
+
+            if len(issues) < row[0]:
+                # Some issues were evicted or expired, so the list is incomplete
+                log().info("Ignoring incomplete cached issue list of volume %s (%d of %d issues)" % (
+                    volumeid, len(issues), row[0]))
+                self._db.execute("DELETE FROM listings WHERE volumeid = ?", (volumeid, ))
+                self._maybeCommit(now)
+                return None
+
+            # Keep the issues as long as the list
+            self._db.execute("UPDATE issues SET used = ? WHERE volumeid = ?", (now, volumeid))
+            self._maybeCommit(now)
+            return issues
+        finally:
+            self._lock.release()
+
+    def setListing(self, volumeid, issues):
+        """Stores the complete list of issues of a volume, a dict of issue
+        number to name
+        """
+        for issueno, issuename in issues.items():
+            self.setIssueName(volumeid, issueno, issuename)
+        self._set('listings', {'volumeid': volumeid, 'issues': len(issues)})
+
+    def getMissing(self, kind, key):
+        """Returns the error message recorded when kind ('volume', 'issue',
+        or 'issuename' for an issue without a name) key was not found, or
+        None
+        """
+        row = self._get('missing', 'message', 'kind = ? AND key = ?', (kind, key))
+        if row is None:
+            return None
+        return row[0]
+
+    def setMissing(self, kind, key, message):
+        self._set('missing', {'kind': kind, 'key': key, 'message': message})
+
+    def listVolumes(self):
+        """Returns list of unexpired (name, volumeid, volumename) entries
+        """
+        self._lock.acquire()
+        try:
+            return self._db.execute(
+                "SELECT name, volumeid, volumename FROM volumes WHERE fetched > ?",
+                (time.time() - self.ttl, )).fetchall()
+        finally:
+            self._lock.release()
+
+    def listIssues(self):
+        """Returns list of unexpired (volumeid, issueno, issuename) entries
+        """
+        self._lock.acquire()
+        try:
+            return self._db.execute(
+                "SELECT volumeid, issueno, issuename FROM issues WHERE fetched > ?",
+                (time.time() - self.ttl, )).fetchall()
+        finally:
+            self._lock.release()
+
+    def listMissing(self):
+        """Returns list of unexpired (kind, key, message, fetched) negative
+        entries
+        """
+        self._lock.acquire()
+        try:
+            return self._db.execute(
+                "SELECT kind, key, message, fetched FROM missing WHERE fetched > ? ORDER BY kind, key",
+                (time.time() - self.negative_ttl, )).fetchall()
+        finally:
+            self._lock.release()
+
+    def purgeMissing(self):
+        """Removes all negative entries, returns the number removed
+        """
+        self._lock.acquire()
+        try:
+            removed = self._db.execute("DELETE FROM missing").rowcount
+            self._db.commit()
+            return removed
+        finally:
+            self._lock.release()
+
+    def evict(self):
+        """Removes expired entries, and the least recently used entries of
+        tables with more than max_entries rows
+        """
+        self._lock.acquire()
+        try:
+            for table in sorted(self.tables):
+                self._db.execute("DELETE FROM %s WHERE fetched <= ?" % table,
+                    (time.time() - self._ttl(table), ))
+
+                count = self._db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+                if count > self.max_entries:
+                    log().info("Evicting %d entries from cache table %s" % (
+                        count - self.max_entries, table))
+                    self._db.execute(
+                        "DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY used LIMIT ?)" % (
+                            table, table),
+                        (count - self.max_entries, ))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self.evict()
+        self._db.close()
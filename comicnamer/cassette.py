@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Recorded volume searches and issue lookups, for replaying runs without
+contacting comicvine.com
+"""
+
+import os
+import gzip
+import logging
+import threading
+
+import simplejson as json
+
+
+def log():
+    """Returns the logger for current file
+    """
+    return logging.getLogger(__name__)
+
+
+class Cassette(object):
+    """Results of lookups, stored as JSON in the file at path (compressed
+    with gzip if the name ends with .gz).
+
+    Entries are dicts, stored by kind ('volumes', 'issues' or 'listings')
+    and key. Entries of lookups which failed have 'error' (the exception
+    class name) and 'message' keys
+    """
+
+    kinds = ('volumes', 'issues', 'listings')
+
+    # Files with a different format version are not loaded
+    format_version = 1
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.entries = dict((kind, {}) for kind in self.kinds)
+        self._lock = threading.Lock()
+
+    def _open(self, path, mode):
+        if self.path.endswith(".gz"):
+            return gzip.open(path, mode)
+        return open(path, mode)
+
+    def load(self):
+        """Reads the file. Raises IOError or ValueError if it cannot be read
+        """
+        f = self._open(self.path, "rb")
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+
+        if data.get('version') != self.format_version:
+            raise ValueError("Unsupported cassette version %r" % data.get('version'))
+        for kind in self.kinds:
+            self.entries[kind] = data.get(kind, {})
+
+    def save(self):
+        """Writes the file, replacing it once complete
+        """
+        self._lock.acquire()
+        try:
+            data = dict(self.entries, version = self.format_version)
+            f = self._open(self.path + ".tmp", "wb")
+            try:
+                json.dump(data, f, separators = (',', ':'), sort_keys = True)
+            finally:
+                f.close()
+            os.rename(self.path + ".tmp", self.path)
+        finally:
+            self._lock.release()
+        log().info("Saved %d volumes, %d issues and %d issue lists to %s" % (
+            len(self.entries['volumes']), len(self.entries['issues']),
+            len(self.entries['listings']), self.path))
+
+    def get(self, kind, key):
+        """Returns the entry of kind stored for key, or None
+        """
+        return self.entries[kind].get(unicode(key))
+
+    def set(self, kind, key, entry):
+        self._lock.acquire()
+        try:
+            self.entries[kind][unicode(key)] = entry
+        finally:
+            self._lock.release()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Local catalog of volumes and issue names, for looking them up offline
+"""
+
+import os
+import mmap
+import logging
+
+
+def log():
+    """Returns the logger for current file
+    """
+    return logging.getLogger(__name__)
+
+
+# First line of catalog files
+catalog_header = "#comicnamer catalog 1\n"
+
+
+def _field(value):
+    """Returns value as UTF-8, without characters which separate fields
+    """
+    if value is None:
+        return ""
+    return unicode(value).replace("\t", " ").replace("\n", " ").replace("\r", " ").encode("utf-8")
+
+
+def _volumePrefix(key):
+    return "V\t%s\t" % _field(key)
+
+
+def _issuePrefix(volumeid, issueno = None):
+    # Ids are padded so a volume's issues sort together
+    prefix = "I\t%010d\t" % volumeid
+    if issueno is None:
+        return prefix
+    return prefix + "%s\t" % _field(issueno)
+
+
+class CatalogWriter(object):
+    """Builds a catalog file at path. Volumes are stored by normalised
+    name (several names can refer to the same volume), and issue names by
+    volume id and issue number
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.volumes = {}
+        self.issues = {}
+
+    def addVolume(self, key, volumeid, volumename, year = None):
+        if volumeid is not None:
+            self.volumes[key] = (volumeid, volumename, year)
+
+    def addIssue(self, volumeid, issueno, issuename):
+        """Adds an issue, with issuename None if it has no name
+        """
+        if volumeid is not None:
+            self.issues[(volumeid, unicode(issueno))] = issuename
+
+    def write(self):
+        """Writes the file, replacing it once complete
+        """
+        lines = []
+        for key, (volumeid, volumename, year) in self.volumes.items():
+            lines.append("%s%d\t%s\t%s\n" % (
+                _volumePrefix(key), volumeid, _field(volumename), _field(year)))
+        for (volumeid, issueno), issuename in self.issues.items():
+            lines.append("%s%s\n" % (_issuePrefix(volumeid, issueno), _field(issuename)))
+        lines.sort()
+
+        f = open(self.path + ".tmp", "wb")
+        try:
+            f.write(catalog_header)
+            f.writelines(lines)
+        finally:
+            f.close()
+        os.rename(self.path + ".tmp", self.path)
+
+        log().info("Wrote %d volume names and %d issues to %s" % (
+            len(self.volumes), len(self.issues), self.path))
+
+
+class Catalog(object):
+    """Reads a catalog file written by CatalogWriter. The file is one
+    tab-separated line per volume name or issue, sorted, so lines are found
+    by binary search of the memory-mapped file without reading all of it
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+        f = open(self.path, "rb")
+        try:
+            if f.read(len(catalog_header)) != catalog_header:
+                raise ValueError("%s is not a comicnamer catalog" % self.path)
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self._size = len(self._map)
+
+    def _lineEnd(self, start):
+        end = self._map.find("\n", start)
+        if end < 0:
+            return self._size
+        return end
+
+    def _seek(self, key):
+        """Returns the offset of the first line not sorting before key
+        """
+        # lo and hi are always offsets of line starts (or the end)
+        lo, hi = len(catalog_header), self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._map.rfind("\n", lo, mid) + 1
+            if start == 0:
+                start = lo
+            end = self._lineEnd(start)
+            if self._map[start:end] < key:
+                lo = end + 1
+            else:
+                hi = start
+        return lo
+
+    def _lines(self, prefix):
+        """Yields the fields after prefix of each line starting with prefix
+        """
+        offset = self._seek(prefix)
+        while offset < self._size:
+            end = self._lineEnd(offset)
+            line = self._map[offset:end]
+            if not line.startswith(prefix):
+                break
+            yield line[len(prefix):].decode("utf-8").split(u"\t")
+            offset = end + 1
+
+    def findVolume(self, key):
+        """Returns (volumeid, volumename, year) of the volume with the
+        normalised name key, or None
+        """
+        for volumeid, volumename, year in self._lines(_volumePrefix(key)):
+            return int(volumeid), volumename, year or None
+        return None
+
+    def getIssueName(self, volumeid, issueno):
+        """Returns the name of an issue, u"" if it has no name, or None if
+        it is not in the catalog
+        """
+        for fields in self._lines(_issuePrefix(volumeid, issueno)):
+            return fields[0]
+        return None
+
+    def listIssues(self, volumeid):
+        """Returns a dict of issue number to name of every issue of a volume
+        in the catalog, with None for issues without a name
+        """
+        return dict((issueno, issuename or None)
+            for issueno, issuename in self._lines(_issuePrefix(volumeid)))
+
+    def close(self):
+        self._map.close()
@@ -13,6 +13,20 @@ from __future__ import with_statement
 from optparse import OptionParser, OptionGroup
 
 
+def addExclude(option, opt_str, value, parser):
+    """Callback for --exclude, which adds the pattern to both exclude_dirs and
+    exclude_files. Creates new lists so the defaults are left unchanged
+    """
+    parser.values.exclude_dirs = list(parser.values.exclude_dirs or []) + [value]
+    parser.values.exclude_files = list(parser.values.exclude_files or []) + [value]
+
+
+def setProviders(option, opt_str, value, parser):
+    """Callback for --providers, which takes a comma separated list
+    """
+    parser.values.providers = [x.strip() for x in value.split(",") if x.strip()]
+
+
 class Group(object):
     """Simple helper context manager to add a group to an OptionParser
     """
@@ -58,10 +72,62 @@ def getCommandlineParser(defaults):
         g.add_option("-s", "--save", action = "store", dest = "saveconfig", help = "Save configuration to this file and exit")
         g.add_option("-p", "--preview-config", action = "store_true", dest = "showconfig", help = "Show current config values and exit")
 
+    # Lookups
+    with Group(parser, "Lookups") as g:
+        g.add_option("--lookup-workers", action = "store", type = "int", dest = "lookup_workers", help = "In batch mode, look up this many files at once", metavar = "N")
+        g.add_option("--adaptive-lookups", action = "store_true", dest = "lookup_adaptive", help = "Adjust the number of concurrent requests to comicvine.com (up to --lookup-workers) to how quickly it responds")
+        g.add_option("--fixed-lookups", action = "store_false", dest = "lookup_adaptive", help = "Always allow --lookup-workers concurrent requests to comicvine.com")
+        g.add_option("--lookup-rate-limit", action = "store", type = "float", dest = "lookup_rate_limit", help = "Make at most this many requests a second to comicvine.com", metavar = "RPS")
+        g.add_option("--shared-rate-limit", action = "store", type = "float", dest = "shared_rate_limit", help = "Make at most this many requests an hour to comicvine.com, across all comicnamer processes", metavar = "RPH")
+        g.add_option("--shared-rate-limit-burst", action = "store", type = "int", dest = "shared_rate_limit_burst", help = "Allow up to this many requests at once within the shared rate limit", metavar = "N")
+        g.add_option("--shared-rate-limit-file", action = "store", dest = "shared_rate_limit_file", help = "File storing the shared rate limit state", metavar = "PATH")
+        g.add_option("--record", action = "store", dest = "record_cassette", help = "Record lookups to this file, for replaying with --replay", metavar = "FILE")
+        g.add_option("--replay", action = "store", dest = "replay_cassette", help = "Look up volumes and issues from a file recorded with --record, without contacting comicvine.com", metavar = "FILE")
+        g.add_option("--replay-latency", action = "store", type = "float", dest = "replay_latency", help = "Seconds added to each volume search and issue list when replaying", metavar = "SECONDS")
+        g.add_option("--client", action = "store", dest = "comicvine_client", choices = ["comicvine_api", "builtin"], help = "Contact comicvine.com using comicvine_api, or the builtin client (batch mode only)")
+        g.add_option("--api-key", action = "store", dest = "comicvine_api_key", help = "comicvine.com API key, for the builtin client", metavar = "KEY")
+        g.add_option("--base-url", action = "store", dest = "comicvine_base_url", help = "URL of the comicvine.com API, for the builtin client", metavar = "URL")
+        g.add_option("--lookup-timeout", action = "store", type = "float", dest = "lookup_timeout", help = "Seconds to wait for comicvine.com to respond", metavar = "SECONDS")
+        g.add_option("--lookup-retries", action = "store", type = "int", dest = "lookup_retries", help = "Retry failed requests to comicvine.com this many times", metavar = "N")
+        g.add_option("--breaker-failures", action = "store", type = "int", dest = "circuit_breaker_failures", help = "Stop contacting comicvine.com for a while after this many consecutive failed requests", metavar = "N")
+        g.add_option("--breaker-cooldown", action = "store", type = "float", dest = "circuit_breaker_cooldown", help = "Seconds to stop contacting comicvine.com for after repeated failures", metavar = "SECONDS")
+        g.add_option("--defer-unavailable", action = "store_const", const = "defer", dest = "circuit_breaker_action", help = "Look up files again at the end of the run if comicvine.com was unavailable")
+        g.add_option("--rename-unavailable", action = "store_const", const = "rename", dest = "circuit_breaker_action", help = "Rename files without issue names if comicvine.com was unavailable")
+
+    # Lookup cache
+    with Group(parser, "Lookup cache") as g:
+        g.add_option("--no-cache", action = "store_false", dest = "cache_enable", help = "Do not use or update the cache of volume and issue names")
+        g.add_option("--cache", action = "store_true", dest = "cache_enable", help = "Use the cache of volume and issue names")
+        g.add_option("--refresh-cache", action = "store_true", dest = "cache_refresh", help = "Fetch all volume and issue names again, updating the cache")
+        g.add_option("--prefetch-threshold", action = "store", type = "int", dest = "prefetch_threshold", help = "Fetch the complete issue list of volumes with more than this many issues in the run", metavar = "N")
+        g.add_option("--list-negative-cache", action = "store_true", dest = "list_negative_cache", help = "List the volumes and issues cached as not found, and exit")
+        g.add_option("--purge-negative-cache", action = "store_true", dest = "purge_negative_cache", help = "Forget the volumes and issues cached as not found, and exit")
+        g.add_option("--providers", action = "callback", callback = setProviders, type = "string", help = "Comma separated list of where to look up volumes and issue names, in order: catalog, comicvine", metavar = "LIST")
+        g.add_option("--offline", action = "store_true", dest = "offline", help = "Look up volumes and issue names only in the local catalog")
+        g.add_option("--catalog", action = "store", dest = "catalog_file", help = "Location of the local catalog", metavar = "FILE")
+        g.add_option("--build-catalog", action = "store_true", dest = "build_catalog", help = "Build the local catalog from the lookup cache and the cassette files given as arguments, and exit")
+
+    # Filename parsing
+    with Group(parser, "Filename parsing") as g:
+        g.add_option("--filename-parser", action="store", dest="filename_parser", choices = ["regex", "tokenizer"], help = "Parse filenames with the regex patterns, or the comic filename tokenizer (falling back to patterns)")
+        g.add_option("--filename-matcher", action="store", dest="filename_matcher", choices = ["sequential", "combined", "adaptive", "bulk"], help = "How filename patterns are evaluated: sequential, combined, adaptive or bulk")
+        g.add_option("--comicinfo", action="store", dest="comicinfo_mode", choices = ["off", "fill", "trust"], help = "Use ComicInfo.xml in CBZ files: off, fill (series and number) or trust (also the title, without looking it up)")
+        g.add_option("--write-comicinfo", action="store_true", dest="write_comicinfo", help = "Write the names found into the ComicInfo.xml of renamed CBZ files")
+        g.add_option("--no-write-comicinfo", action="store_false", dest="write_comicinfo", help = "Overrides --write-comicinfo")
+        g.add_option("--pattern-stats", action="store_true", dest="showpatternstats", help = "Show statistics recorded by the adaptive filename matcher and exit")
+        g.add_option("--analyze-patterns", action="store", dest="analyze_patterns", help = "Benchmark the filename patterns against a file listing one filename per line, and exit. With --verbose, lists the pattern used for each filename", metavar="CORPUS")
+
     # Misc
     with Group(parser, "Misc") as g:
         g.add_option("-r", "--recursive", action="store_true", dest = "recursive", help = "Descend more than one level directories supplied as arguments")
         g.add_option("--not-recursive", action="store_false", dest = "recursive", help = "Only descend one level into directories")
+        g.add_option("--max-depth", action = "store", type = "int", dest = "max_depth", help = "When recursive, descend at most this many levels of subdirectories", metavar = "N")
+        g.add_option("--follow-symlinks", action = "store_true", dest = "follow_symlinks", help = "When recursive, descend into symlinked directories")
+        g.add_option("--no-follow-symlinks", action = "store_false", dest = "follow_symlinks", help = "When recursive, skip symlinked directories")
+        g.add_option("--exclude", action = "callback", callback = addExclude, type = "string", help = "Skip files and directories matching this glob pattern, for example @eaDir or '*.jpg'. Can be given more than once", metavar = "PATTERN")
+        g.add_option("--finder-threads", action = "store", type = "int", dest = "finder_threads", help = "Number of directories to list at once when recursing. Only faster on network filesystems such as NFS (default 1)")
+        g.add_option("--stream", action = "store_true", dest = "stream", help = "Rename each file as soon as it is found, rather than after searching all paths. Useful for very large libraries")
+        g.add_option("--sort-window", action = "store", type = "int", dest = "stream_sort_window", help = "With --stream, sort files by volume within batches of this many files (0 to not sort)", metavar = "N")
 
         g.add_option("-m", "--move", action="store_true", dest="move_files_enable", help = "Move files to destination specified in config or with --movedestination argument")
         g.add_option("--not-move", action="store_false", dest="move_files_enable", help = "Files will remain in current directory")
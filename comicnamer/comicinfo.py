@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Reads and writes ComicInfo.xml metadata embedded in CBZ archives
+"""
+
+import os
+import time
+import zlib
+import logging
+import zipfile
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+
+def log():
+    """Returns the logger for current file
+    """
+    return logging.getLogger(__name__)
+
+
+# Extensions of archives which are zip files
+zip_extensions = ('.cbz', '.zip')
+
+# Larger ComicInfo.xml members are ignored
+max_comicinfo_size = 1024 * 1024
+
+
+class ComicInfo(object):
+    """Metadata from a ComicInfo.xml file. Missing values are None, number
+    is an int (or None if it is not a whole number)
+    """
+
+    def __init__(self, series = None, number = None, title = None, volume = None, year = None):
+        self.series = series
+        self.number = number
+        self.title = title
+        self.volume = volume
+        self.year = year
+
+    def __repr__(self):
+        return (u"<ComicInfo %s #%s: %s>" % (self.series, self.number, self.title)).encode("utf-8")
+
+
+def _text(root, name):
+    """Returns the stripped text of the child element name, or None
+    """
+    for element in root:
+        # Ignore any namespace
+        if element.tag.split("}")[-1] == name:
+            text = (element.text or u"").strip()
+            if text:
+                return unicode(text)
+    return None
+
+
+def _int(text):
+    if text is not None and text.isdigit():
+        return int(text)
+    return None
+
+
+def parseComicInfo(data):
+    """Parses the contents of a ComicInfo.xml file. Raises SyntaxError if
+    it is not valid XML
+
+    >>> info = parseComicInfo('<ComicInfo><Series>Batman</Series><Number>012</Number>'
+    ...     '<Title>The Last Laugh</Title></ComicInfo>')
+    >>> info.series, info.number, info.title
+    (u'Batman', 12, u'The Last Laugh')
+    """
+    root = ElementTree.fromstring(data)
+    return ComicInfo(
+        series = _text(root, "Series"),
+        number = _int(_text(root, "Number")),
+        title = _text(root, "Title"),
+        volume = _int(_text(root, "Volume")),
+        year = _int(_text(root, "Year")))
+
+
+def findComicInfo(archive):
+    """Returns the ZipInfo of the ComicInfo.xml member of a ZipFile, or None.
+    A member at the top of the archive is preferred
+    """
+    found = None
+    for info in archive.infolist():
+        name = info.filename.replace("\\", "/")
+        if name.split("/")[-1].lower() == "comicinfo.xml":
+            if "/" not in name:
+                return info
+            if found is None:
+                found = info
+    return found
+
+
+def readComicInfo(path):
+    """Returns the ComicInfo of the CBZ archive at path, or None if it has
+    no (valid) ComicInfo.xml.
+
+    Only the end of the archive, its central directory and the
+    ComicInfo.xml member are read, not the pages
+    """
+    if os.path.splitext(path)[1].lower() not in zip_extensions:
+        return None
+
+    try:
+        archive = zipfile.ZipFile(path)
+        try:
+            info = findComicInfo(archive)
+            if info is None:
+                return None
+            if info.file_size > max_comicinfo_size:
+                log().info("Ignoring %d byte ComicInfo.xml in %s" % (info.file_size, path))
+                return None
+            data = archive.read(info)
+        finally:
+            archive.close()
+    except (IOError, RuntimeError, zlib.error, zipfile.BadZipfile), errormsg:
+        # RuntimeError is raised for encrypted members
+        log().info("Could not read %s: %s" % (path, errormsg))
+        return None
+
+    try:
+        return parseComicInfo(data)
+    except SyntaxError, errormsg:
+        log().info("Invalid ComicInfo.xml in %s: %s" % (path, errormsg))
+        return None
+
+
+def _setText(root, name, value):
+    """Sets the text of the child element name, adding it if needed
+    """
+    for element in root:
+        if element.tag.split("}")[-1] == name:
+            element.text = value
+            return
+    ElementTree.SubElement(root, name).text = value
+
+
+def writeComicInfo(path, series, number, title):
+    """Writes series, issue number and title into the ComicInfo.xml of the
+    CBZ archive at path, keeping its other fields. Returns the number of
+    bytes written, 0 if it already had these values.
+
+    The archive is not rewritten: the new ComicInfo.xml and a new central
+    directory are appended to the end of the file, and an existing
+    ComicInfo.xml is left in place but removed from the directory. If
+    writing fails the file is truncated back to its original size, leaving
+    it unchanged. Raises IOError, zipfile.BadZipfile or SyntaxError (if an
+    existing ComicInfo.xml is invalid)
+    """
+    if not zipfile.is_zipfile(path):
+        raise zipfile.BadZipfile("%s is not a zip file" % path)
+
+    original_size = os.path.getsize(path)
+    archive = zipfile.ZipFile(path, "a")
+    written = False
+    try:
+        existing = findComicInfo(archive)
+        if existing is None:
+            root = ElementTree.Element("ComicInfo")
+            old_data = None
+        else:
+            old_data = archive.read(existing)
+            root = ElementTree.fromstring(old_data)
+
+        _setText(root, "Series", series)
+        _setText(root, "Number", unicode(number))
+        _setText(root, "Title", title)
+        data = ElementTree.tostring(root, encoding = "utf-8")
+        if not data.startswith("<?xml"):
+            data = '<?xml version="1.0" encoding="utf-8"?>\n' + data
+
+        if data == old_data:
+            return 0
+
+        if existing is not None:
+            # Repoint the directory at the new member
+            archive.filelist.remove(existing)
+            del archive.NameToInfo[existing.filename]
+
+        # Append after everything, rather than over the old directory, so
+        # nothing already in the file is overwritten
+        archive.fp.seek(0, os.SEEK_END)
+        info = zipfile.ZipInfo("ComicInfo.xml", time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        archive.writestr(info, data)
+        archive.close()
+        written = True
+    finally:
+        if not written:
+            # Close without writing a directory, and remove anything appended
+            archive._didModify = False
+            archive.close()
+            if os.path.getsize(path) != original_size:
+                f = open(path, "r+b")
+                try:
+                    f.truncate(original_size)
+                finally:
+                    f.close()
+
+    return os.path.getsize(path) - original_size
@@ -74,3 +74,13 @@ class IssueNameNotFound(DataRetrievalError):
     """Raised when the name of the issue cannot be found
     """
     pass
+
+
+class ServiceUnavailable(DataRetrievalError):
+    """Raised when comicvine.com is not contacted because recent requests
+    failed. retry_after is the number of seconds until it will be tried again
+    """
+
+    def __init__(self, message, retry_after):
+        DataRetrievalError.__init__(self, message)
+        self.retry_after = retry_after
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Minimal client for the comicvine.com API, used instead of comicvine_api
+when comicvine_client is 'builtin'
+"""
+
+import zlib
+import socket
+import urllib
+import httplib
+import logging
+import urlparse
+import threading
+
+import simplejson as json
+from comicvine_api import (comicvine_error, comicvine_volumenotfound,
+comicvine_issuenotfound, comicvine_attributenotfound)
+
+from lookup import normaliseVolumeName
+
+
+def log():
+    """Returns the logger for current file
+    """
+    return logging.getLogger(__name__)
+
+
+class ClientIssue(dict):
+    """An issue of a ClientVolume. Missing attributes (such as 'issuename'
+    of an issue without a name) raise comicvine_attributenotfound
+    """
+
+    def __missing__(self, key):
+        raise comicvine_attributenotfound("Issue has no attribute %s" % key)
+
+
+class ClientVolume(dict):
+    """A volume fetched by ComicvineClient: a dict of ClientIssue by issue
+    number (int for whole numbers, unicode otherwise). As with comicvine_api
+    volumes, the attributes 'id', 'volumename' and 'start_year' are also
+    accessed by key
+    """
+
+    def __init__(self, attributes, issues):
+        dict.__init__(self, issues)
+        self.attributes = attributes
+
+    def __getitem__(self, key):
+        if key in self.attributes:
+            return self.attributes[key]
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if isinstance(key, (int, long)):
+            raise comicvine_issuenotfound("Issue %s not found" % key)
+        raise comicvine_attributenotfound("Volume has no attribute %s" % key)
+
+
+def issueKey(number):
+    """Returns the key of an issue number from the API in a ClientVolume
+
+    >>> issueKey(u"12")
+    12
+    >>> issueKey(u"12.5")
+    u'12.5'
+    """
+    number = (number or u"").strip()
+    if number.isdigit():
+        return int(number)
+    return number
+
+
+class ComicvineClient(object):
+    """Looks up volumes on comicvine.com, in place of comicvine_api.Comicvine
+    when the first search result is always used (select_first).
+
+    client[name] searches for a volume, preferring a result whose name
+    normalises to the same as name (see normaliseVolumeName) over the first
+    result, and client[volumeid] fetches a volume by id. Both return a
+    ClientVolume with all its issues, fetched page_size at a time.
+
+    Only the fields comicnamer uses are requested, with gzip compression.
+    Each thread keeps its own connection open between requests. Errors raise
+    the comicvine_api exceptions, so ComicvineBackend handles them the same
+    """
+
+    def __init__(self, api_key, base_url = "http://api.comicvine.com/", page_size = 100):
+        self.api_key = api_key
+        self.page_size = page_size
+
+        scheme, self.host, self.path, query, fragment = urlparse.urlsplit(base_url)
+        if scheme == "https":
+            self._connectionClass = httplib.HTTPSConnection
+        else:
+            self._connectionClass = httplib.HTTPConnection
+        if not self.path.endswith("/"):
+            self.path += "/"
+
+        self._local = threading.local()
+
+    def _connection(self):
+        """Returns this thread's connection, and whether it was used before
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            return connection, True
+
+        # Uses the default socket timeout (see lookup_timeout)
+        self._local.connection = self._connectionClass(self.host)
+        return self._local.connection, False
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _read(self, response):
+        """Reads the body of response as it arrives, decompressing it
+        """
+        decompressor = None
+        if response.getheader("content-encoding", "").lower() == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        chunks = []
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+            chunks.append(chunk)
+
+        if decompressor is not None:
+            chunks.append(decompressor.flush())
+        return "".join(chunks)
+
+    def _get(self, resource, **params):
+        """Requests resource, returns the decoded response
+        """
+        params.update(api_key = self.api_key, format = "json")
+        url = "%s%s/?%s" % (self.path, resource, urllib.urlencode(sorted(
+            (key, unicode(value).encode("utf-8")) for key, value in params.items())))
+
+        while True:
+            connection, reused = self._connection()
+            try:
+                connection.request("GET", url, headers = {
+                    "Accept-Encoding": "gzip",
+                    "User-Agent": "comicnamer"})
+                response = connection.getresponse()
+                body = self._read(response)
+            except socket.timeout:
+                self._disconnect()
+                raise
+            except (httplib.HTTPException, socket.error), errormsg:
+                self._disconnect()
+                if reused:
+                    # The server may have closed the kept-alive connection
+                    log().debug("Reconnecting after error: %s" % errormsg)
+                    continue
+                raise comicvine_error("Error contacting %s: %s" % (self.host, errormsg))
+            break
+
+        if response.getheader("connection", "").lower() == "close":
+            self._disconnect()
+
+        if response.status == 404:
+            raise comicvine_volumenotfound("Not found: %s" % resource)
+        if response.status != 200:
+            raise comicvine_error("HTTP Error %d: %s" % (response.status, response.reason))
+
+        try:
+            data = json.loads(body)
+        except ValueError, errormsg:
+            raise comicvine_error("Invalid response from %s: %s" % (self.host, errormsg))
+
+        if data.get("status_code") == 101:
+            raise comicvine_volumenotfound(data.get("error"))
+        if data.get("status_code") != 1:
+            raise comicvine_error("%s (status %s)" % (data.get("error"), data.get("status_code")))
+        return data
+
+    def _search(self, name):
+        """Returns the id of the best search result for volume name
+        """
+        results = self._get("search", resources = "volume", query = name,
+            field_list = "id,name,start_year", limit = 10)["results"]
+        if len(results) == 0:
+            raise comicvine_volumenotfound("Volume %s not found" % name)
+
+        key = normaliseVolumeName(name)
+        for result in results:
+            if normaliseVolumeName(result.get("name") or u"") == key:
+                return result["id"]
+        return results[0]["id"]
+
+    def _issues(self, volumeid):
+        """Returns a dict of ClientIssue by issue number, fetching each page
+        of the volume's issues in turn
+        """
+        issues = {}
+        offset = 0
+        while True:
+            data = self._get("issues", filter = "volume:%d" % volumeid,
+                field_list = "issue_number,name", limit = self.page_size, offset = offset)
+
+            for result in data["results"]:
+                issue = ClientIssue()
+                if result.get("name"):
+                    issue["issuename"] = result["name"]
+                issues[issueKey(result.get("issue_number"))] = issue
+
+            offset += len(data["results"])
+            if len(data["results"]) == 0 or offset >= data.get("number_of_total_results", 0):
+                return issues
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long)):
+            volumeid = key
+        else:
+            volumeid = self._search(key)
+
+        result = self._get("volume/4050-%d" % volumeid, field_list = "id,name,start_year")["results"]
+        attributes = {
+            'id': result["id"],
+            'volumename': result["name"],
+            'start_year': result.get("start_year")}
+        return ClientVolume(attributes, self._issues(volumeid))
@@ -30,6 +30,33 @@ defaults = {
     # desends one level.
     'recursive': False,
 
+    # When recursive, the number of levels of subdirectories to descend
+    # into. None for no limit
+    'max_depth': None,
+
+    # When recursive, descend into symlinks to directories. Each directory
+    # is only visited once, so symlink loops are safe either way
+    'follow_symlinks': True,
+
+    # Glob patterns for directories which are never descended into, and
+    # files which are skipped. Patterns containing a / are matched against
+    # the full path, others against the name alone. For example:
+    # ['.git', '@eaDir', '*/_organized'] and ['*.jpg', '._*']
+    'exclude_dirs': [],
+    'exclude_files': [],
+
+    # Process each file as soon as it is found, rather than after searching
+    # all paths, so large libraries start renaming quickly and memory use
+    # stays flat. Issues are only sorted by volume within batches of
+    # stream_sort_window files (0 to not sort at all)
+    'stream': False,
+    'stream_sort_window': 1000,
+
+    # Number of directories listed at once when recursing. On local disks
+    # extra threads only add overhead, values such as 8 speed up scanning
+    # large trees on high-latency network filesystems such as NFS
+    'finder_threads': 1,
+
     # When non-empty, only look for files with this extension.
     # No leading dot, for example: ['cbr', 'cbz']
     'valid_extensions': [],
@@ -255,12 +282,172 @@ defaults = {
 
     ],
 
+    # How filename_patterns are evaluated, the first matching pattern is
+    # always used. One of:
+    # - 'sequential': try each pattern in turn
+    # - 'combined': skip patterns that cannot match using cheap literal
+    #   checks, then try the remaining patterns as a single regex
+    # - 'adaptive': try the patterns that matched most often (and cheaply)
+    #   in previous runs first, using pattern_stats_file
+    # - 'bulk': run each pattern over all the found filenames at once, rather
+    #   than one filename at a time. Best for very large numbers of files
+    'filename_matcher': 'combined',
+
+    # How filenames are parsed. One of:
+    # - 'regex': use filename_patterns
+    # - 'tokenizer': split the filename into words, numbers and tags, and
+    #   classify them as a comic volume name and issue number, such as
+    #   "Batman 042 (2011) (digital).cbz". Filenames which cannot be
+    #   classified confidently are parsed with filename_patterns
+    'filename_parser': 'regex',
+
+    # Use the ComicInfo.xml metadata in CBZ files (only the archive's
+    # directory and ComicInfo.xml are read, not the pages):
+    #   'off' ignores it
+    #   'fill' uses its series and number instead of those parsed from the
+    #     filename, including for files whose names cannot be parsed
+    #   'trust' also uses its title as the issue name, without looking it up
+    'comicinfo_mode': 'off',
+
+    # After renaming a CBZ file, write the volume name, issue number and
+    # issue name found into its ComicInfo.xml. The archive is not rewritten:
+    # the new ComicInfo.xml is appended to the end of it
+    'write_comicinfo': False,
+
+    # Where per-pattern hit counts and match times are kept between runs
+    # by the 'adaptive' filename_matcher. Shown with --pattern-stats
+    'pattern_stats_file': '~/.comicnamer_pattern_stats.json',
+
+    # Number of threads looking up volumes and issue names at once, ahead
+    # of the file being renamed. Only used with select_first (as in batch
+    # mode), otherwise lookups are made one at a time
+    'lookup_workers': 1,
+
+    # Adjust how many requests are made to comicvine.com at once, up to
+    # lookup_workers: more while requests are fast and succeed, fewer after
+    # errors or timeouts. The current limit is shown with --verbose
+    'lookup_adaptive': True,
+
+    # Maximum number of requests a second made to comicvine.com, or None
+    # for no limit
+    'lookup_rate_limit': None,
+
+    # Maximum number of requests an hour made to comicvine.com by all
+    # comicnamer processes on this computer together (such as several
+    # processes using the same API key), or None for no limit. The limit is
+    # shared through shared_rate_limit_file, and up to
+    # shared_rate_limit_burst requests can be made at once after a pause
+    'shared_rate_limit': None,
+    'shared_rate_limit_burst': 10,
+    'shared_rate_limit_file': '~/.comicnamer_ratelimit',
+
+    # Record every volume search and issue lookup to this file, or None.
+    # Files ending with .gz are compressed
+    'record_cassette': None,
+
+    # Look up volumes and issues from a file recorded with record_cassette,
+    # instead of contacting comicvine.com, or None. Each volume search and
+    # issue list takes replay_latency more seconds, to imitate requests
+    'replay_cassette': None,
+    'replay_latency': 0,
+
+    # Client used to contact comicvine.com:
+    #   'comicvine_api' uses the comicvine_api module
+    #   'builtin' uses comicnamer's own client, which keeps connections open,
+    #     requests compressed responses and only the fields comicnamer uses.
+    #     It needs comicvine_api_key, and is only used with select_first
+    #     (as in batch mode), as it always uses the best search result
+    'comicvine_client': 'comicvine_api',
+    'comicvine_api_key': None,
+    'comicvine_base_url': 'http://api.comicvine.com/',
+
+    # Seconds to wait for comicvine.com to respond, or None to wait forever
+    'lookup_timeout': 30,
+
+    # Number of times to retry a request to comicvine.com which failed with
+    # an error or timeout, waiting lookup_retry_backoff seconds before the
+    # first retry, twice as long before the second, and so on
+    'lookup_retries': 3,
+    'lookup_retry_backoff': 1.0,
+
+    # After this many consecutive failed requests, stop contacting
+    # comicvine.com for circuit_breaker_cooldown seconds, or None to keep
+    # trying. What happens to files looked up meanwhile depends on
+    # circuit_breaker_action:
+    #   'defer' looks them up again at the end of the run
+    #   'rename' renames them using filename_without_issue
+    'circuit_breaker_failures': 5,
+    'circuit_breaker_cooldown': 60,
+    'circuit_breaker_action': 'defer',
+
+    # Cache volume and issue names found on comicvine.com, so files which
+    # were already looked up do not need fetching again
+    'cache_enable': True,
+
+    # SQLite database the cache is stored in
+    'cache_file': '~/.comicnamer_cache.sqlite',
+
+    # Seconds before a cached volume or issue name is fetched again (30 days)
+    'cache_ttl': 30 * 24 * 60 * 60,
+
+    # Seconds before a volume or issue which was not found on comicvine.com
+    # is looked up again (1 day). Until then, files for it are skipped (in
+    # batch mode) without contacting comicvine.com
+    'cache_negative_ttl': 24 * 60 * 60,
+
+    # Maximum number of volumes, and of issues, kept in the cache. The least
+    # recently used are removed first
+    'cache_max_entries': 100000,
+
+    # When a run contains more than this many issues of a volume, the
+    # complete issue list of the volume is fetched at once, rather than
+    # one issue at a time. None to never do this
+    'prefetch_threshold': 10,
+
+    # Where volumes and issue names are looked up, in order. Each lookup is
+    # answered by the first provider which can, and the number answered by
+    # each is shown at the end of the run. Providers are:
+    #   'catalog' the local catalog (see catalog_file)
+    #   'comicvine' comicvine.com, through the lookup cache if cache_enable
+    # For example ['catalog', 'comicvine'] only contacts comicvine.com for
+    # volumes and issues which are not in the catalog
+    'providers': ['comicvine'],
+
+    # Volume names in filenames (compared after normalising, so case and
+    # punctuation do not matter) mapped to the volume to use instead. A
+    # name is searched for instead of the filename's, and a dict with a
+    # comicvine.com volume id as well pins the volume, so it is used without
+    # searching (or asking which search result is right). For example:
+    # {'tec': 'Detective Comics', 'batman': {'name': 'Batman', 'id': 796}}
+    'volume_aliases': {},
+
+    # Look up volumes and issue names only in the local catalog (built with
+    # --build-catalog from the lookup cache and recorded cassettes), without
+    # contacting comicvine.com. Files which are not in the catalog are
+    # renamed using filename_without_issue
+    'offline': False,
+    'catalog_file': '~/.comicnamer_catalog',
+
+    # Ignore existing cache entries, fetching everything again (and
+    # updating the cache). Normally set with --refresh-cache
+    'cache_refresh': False,
+
+    # With --analyze-patterns, patterns taking longer than this many
+    # seconds to match any single filename are reported as possibly
+    # backtracking catastrophically
+    'analyze_slow_threshold': 0.01,
+
+    # With --analyze-patterns, a pattern still matching a single filename
+    # after this many seconds is stopped, and reported as backtracking
+    # catastrophically
+    'analyze_match_timeout': 5,
+
     # Formats for renamed files. Variations for with/without issue,
     # and with/without season number.
     'filename_with_issue':
       '%(volumename)s - [%(issue)s] - %(issuename)s%(ext)s',
     'filename_without_issue':
-     '%(volumename)s - [%(seasonno)02dx%(issue)s]%(ext)s',
+     '%(volumename)s - [%(issue)s]%(ext)s',
      'filename_with_issue_no_season':
       '%(volumename)s - [%(issue)s] - %(issuename)s%(ext)s',
      'filename_without_issue_no_season':
@@ -0,0 +1,1371 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Sources of volume and issue names. A Backend finds volumes by name and
+looks up issue names. Backends such as CachedBackend wrap another backend to
+add behaviour, and getLookup builds the configured chain of backends.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import socket
+import logging
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+from comicvine_api import (comicvine_error, comicvine_volumenotfound,
+comicvine_issuenotfound, comicvine_attributenotfound, comicvine_userabort)
+
+from unicode_helper import p
+
+from config import Config
+from cache import LookupCache
+from cassette import Cassette
+from catalog import Catalog, CatalogWriter
+from comicnamer_exceptions import (volumeNotFound, DataRetrievalError,
+IssueNotFound, IssueNameNotFound, UserAbort, ServiceUnavailable,
+ConfigValueError)
+
+
+def log():
+    """Returns the logger for current file
+    """
+    return logging.getLogger(__name__)
+
+
+def normaliseVolumeName(name):
+    """Normalises a volume name for use as a lookup key, so different
+    spellings of the same name give the same key
+
+    >>> normaliseVolumeName(u"  Amazing   Spider-Man ")
+    u'amazing spider man'
+    >>> normaliseVolumeName(u"The Amazing Spider-Man")
+    u'amazing spider man'
+    >>> normaliseVolumeName(u"amazing.spider_man")
+    u'amazing spider man'
+    >>> normaliseVolumeName(u"Batman & Robin")
+    u'batman and robin'
+    >>> normaliseVolumeName(u"Batman's Villains: The Joker")
+    u'batmans villains the joker'
+    >>> normaliseVolumeName(None)
+    u''
+    """
+    if name is None:
+        # Filenames such as s01e02.cbz have no volume name
+        return u""
+    name = name.lower().replace("&", " and ")
+    name = re.sub("['`]", "", name)
+    name = re.sub("[\W_]+", " ", name, flags = re.UNICODE).strip()
+    return re.sub("^the ", "", name)
+
+
+class Memo(object):
+    """Thread-safe memoisation of results by key. The first get() for a key
+    calls the function, and threads asking for the same key meanwhile wait
+    for that call rather than making their own (counted in coalesced).
+
+    Exceptions of the types in remember are memoised like results, other
+    exceptions are raised to every waiting thread, and the key is tried
+    again by the next get()
+    """
+
+    def __init__(self, remember = ()):
+        self.remember = remember
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        self._results = {}
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def get(self, key, func, *args):
+        """Returns the result for key, calling func(*args) if needed
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                if key in self._results:
+                    result = self._results[key]
+                    break
+                waiting = self._inflight.get(key)
+                if waiting is None:
+                    self._inflight[key] = (threading.Event(), [])
+                else:
+                    self.coalesced += 1
+            finally:
+                self._lock.release()
+
+            if waiting is not None:
+                # Another thread is already making this call
+                event, failure = waiting
+                event.wait()
+                if len(failure) > 0:
+                    raise failure[0]
+                continue
+
+            failure = []
+            try:
+                try:
+                    result = func(*args)
+                except self.remember, errormsg:
+                    result = errormsg
+                except Exception, errormsg:
+                    failure.append(errormsg)
+                    raise
+            finally:
+                self._lock.acquire()
+                try:
+                    event, waiters_failure = self._inflight.pop(key)
+                    if len(failure) == 0:
+                        self._results[key] = result
+                    waiters_failure.extend(failure)
+                finally:
+                    self._lock.release()
+                event.set()
+            break
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class RateLimiter(object):
+    """Spaces calls to wait() so they happen at most rate times a second,
+    across all threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next = 0
+
+        self.waits = 0
+        self.waited = 0.0
+        self.longest = 0.0
+
+    def _reserve(self):
+        """Takes the next slot, returns the seconds to wait for it
+        """
+        now = time.time()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        return start - now
+
+    def wait(self):
+        self._lock.acquire()
+        try:
+            delay = self._reserve()
+            if delay > 0:
+                self.waits += 1
+                self.waited += delay
+                self.longest = max(self.longest, delay)
+        finally:
+            self._lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def summary(self):
+        return "Rate limit: waited %d times, %.1fs in total, longest %.1fs" % (
+            self.waits, self.waited, self.longest)
+
+
+class SharedRateLimiter(RateLimiter):
+    """Token bucket rate limiter shared by every comicnamer process on the
+    host, allowing per_hour calls to wait() an hour, and bursts of up to
+    burst calls. The bucket is stored in the file at path, locked with
+    flock while it is updated.
+
+    Calls when the bucket is empty take a token anyway, leaving it negative,
+    and sleep until the token would have been added, so waiting processes
+    are served in turn
+    """
+
+    def __init__(self, path, per_hour, burst):
+        RateLimiter.__init__(self, per_hour / 3600.0)
+        self.path = os.path.expanduser(path)
+        self.rate = per_hour / 3600.0
+        self.burst = burst
+
+    def _reserve(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            now = time.time()
+            try:
+                tokens, updated = [float(x) for x in os.read(fd, 100).split()]
+            except ValueError:
+                # New or unreadable file
+                tokens, updated = self.burst, now
+
+            tokens = min(self.burst, tokens + max(0, now - updated) * self.rate) - 1
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, "%r %r\n" % (tokens, now))
+        finally:
+            # Also releases the lock
+            os.close(fd)
+
+        if tokens >= 0:
+            return 0
+        delay = -tokens / self.rate
+        if delay > 1:
+            log().info("Waiting %.1fs for shared rate limit" % delay)
+        return delay
+
+
+def waitInterruptibly(wait):
+    """Calls a blocking wait(timeout = ...), such as Queue.get,
+    AsyncResult.get or Condition.wait, returning its result
+    """
+    # Python 2 only lets ctrl+c interrupt a thread blocked on a lock when the
+    # wait has a timeout, so use a day rather than waiting forever
+    return wait(timeout = 86400)
+
+
+class AdaptiveConcurrency(object):
+    """Limits how many requests are made at once, adjusting the limit
+    between 1 and maximum: it grows while requests succeed with healthy
+    latency (by one per request until the first failure, then by about one
+    per round of requests), and is halved when a request fails, for example
+    with an error, HTTP 420 or a timeout. Latency is healthy while its moving
+    average is within latency_tolerance times the fastest request seen.
+
+    Call acquire() before each request, and release() after it
+    """
+
+    latency_tolerance = 2.0
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = 1.0
+        self.latency = None
+        self.fastest = None
+        self.requests = 0
+        self.failures = 0
+
+        self._inflight = 0
+        self._slowstart = True
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        self._condition.acquire()
+        try:
+            while self._inflight >= int(self.limit):
+                waitInterruptibly(self._condition.wait)
+            self._inflight += 1
+        finally:
+            self._condition.release()
+
+    def release(self, elapsed, failed = False):
+        """Records the outcome of a request which took elapsed seconds
+        """
+        self._condition.acquire()
+        try:
+            self._inflight -= 1
+            self.requests += 1
+            previous = int(self.limit)
+
+            if failed:
+                self.failures += 1
+                self._slowstart = False
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                if self.latency is None:
+                    self.latency = elapsed
+                else:
+                    self.latency = 0.8 * self.latency + 0.2 * elapsed
+                self.fastest = min(self.fastest or elapsed, elapsed)
+
+                if self.latency <= self.fastest * self.latency_tolerance:
+                    if self._slowstart:
+                        self.limit = min(self.maximum, self.limit + 1)
+                    else:
+                        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+            if int(self.limit) != previous:
+                log().info("Lookup concurrency %d (latency %.0fms%s)" % (
+                    int(self.limit), 1000 * (self.latency or 0),
+                    failed and ", after a failed request" or ""))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def summary(self):
+        return "Lookup concurrency %d of %d, latency %.0fms, %d of %d requests failed" % (
+            int(self.limit), self.maximum, 1000 * (self.latency or 0),
+            self.failures, self.requests)
+
+
+class CircuitBreaker(object):
+    """Stops requests to comicvine.com while it is failing. After
+    threshold consecutive failed requests the circuit opens, and check()
+    raises ServiceUnavailable for cooldown seconds. Then a single request is
+    allowed through: the circuit closes if it succeeds, and opens again if
+    it fails
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.opened = 0
+        self.rejected = 0
+
+        self._failures = 0
+        self._open_until = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raises ServiceUnavailable if a request should not be made now
+        """
+        self._lock.acquire()
+        try:
+            if self._open_until is None:
+                return
+
+            now = time.time()
+            if now >= self._open_until and not self._trial:
+                # Let this request through to test the service
+                self._trial = True
+                return
+
+            self.rejected += 1
+            raise ServiceUnavailable(
+                "Not contacting www.comicvine.com after %d consecutive failed requests" % (
+                    self._failures),
+                retry_after = max(1, self._open_until - now))
+        finally:
+            self._lock.release()
+
+    def succeeded(self):
+        self._lock.acquire()
+        try:
+            if self._open_until is not None:
+                log().info("Requests to comicvine.com are succeeding again")
+            self._failures = 0
+            self._open_until = None
+            self._trial = False
+        finally:
+            self._lock.release()
+
+    def failed(self):
+        self._lock.acquire()
+        try:
+            self._failures += 1
+            if self._trial or (self._open_until is None and self._failures >= self.threshold):
+                self.opened += 1
+                self._open_until = time.time() + self.cooldown
+                p("WARNING: %d consecutive requests to www.comicvine.com failed, pausing requests for %ds" % (
+                    self._failures, self.cooldown), file = sys.stderr)
+            self._trial = False
+        finally:
+            self._lock.release()
+
+    def summary(self):
+        return "Circuit breaker opened %d times, %d requests not made" % (
+            self.opened, self.rejected)
+
+
+class VolumeInfo(object):
+    """A volume found by a Backend. data is the backend's own representation
+    of the volume (such as a comicvine_api volume), or None
+    """
+
+    def __init__(self, volumeid, volumename, data = None):
+        self.volumeid = volumeid
+        self.volumename = volumename
+        self.data = data
+
+    def __repr__(self):
+        return "<VolumeInfo %s: %s>" % (self.volumeid, self.volumename)
+
+
+class Backend(object):
+    """Base class for sources of volume and issue names. Subclasses
+    implement:
+
+    findVolume(name), returning a VolumeInfo for the volume name, or raising
+    volumeNotFound, DataRetrievalError or UserAbort
+
+    getIssueName(volume, issueno), returning the name of an issue of the
+    VolumeInfo volume, or raising IssueNotFound, IssueNameNotFound or
+    DataRetrievalError
+
+    listIssues(volume), returning a dict of every issue of the VolumeInfo
+    volume, mapping issue number (as unicode) to issue name (None for
+    issues without a name), or raising DataRetrievalError
+
+    The other methods are optional hooks, which do nothing by default
+    """
+
+    def expect(self, volumename, issuenumbers):
+        """Called with the volume name and issue numbers of each file before
+        they are looked up, so backends can plan ahead
+        """
+        pass
+
+    def found(self, name, volume):
+        """Called when the VolumeInfo volume is used for the volume name
+        without calling findVolume, such as a volume pinned by an alias
+        """
+        pass
+
+    def summary(self):
+        """Returns a list of lines describing the backend's activity, such
+        as cache hits, displayed at the end of a run
+        """
+        return []
+
+    def close(self):
+        pass
+
+
+class BackendWrapper(Backend):
+    """Base class for backends adding behaviour to another backend, passing
+    everything through by default
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def findVolume(self, name):
+        return self.backend.findVolume(name)
+
+    def getIssueName(self, volume, issueno):
+        return self.backend.getIssueName(volume, issueno)
+
+    def listIssues(self, volume):
+        return self.backend.listIssues(volume)
+
+    def expect(self, volumename, issuenumbers):
+        self.backend.expect(volumename, issuenumbers)
+
+    def found(self, name, volume):
+        self.backend.found(name, volume)
+
+    def summary(self):
+        return self.backend.summary()
+
+    def close(self):
+        self.backend.close()
+
+
+class ResolvingBackend(BackendWrapper):
+    """Resolves each distinct volume once per run. Names which normalise
+    to the same key (see normaliseVolumeName) share the first VolumeInfo
+    found, so every issue of a volume uses the same volume data, and a
+    volume which was not found is not searched for again
+    """
+
+    def __init__(self, backend):
+        BackendWrapper.__init__(self, backend)
+
+        # Normalised name to VolumeInfo, or the volumeNotFound raised
+        self._resolved = Memo(remember = volumeNotFound)
+        self.lookups = 0
+        self._lock = threading.Lock()
+
+    def findVolume(self, name):
+        self._lock.acquire()
+        self.lookups += 1
+        self._lock.release()
+        return self._resolved.get(normaliseVolumeName(name), self.backend.findVolume, name)
+
+    def summary(self):
+        lines = ["Resolved %d distinct volumes for %d files" % (
+            len(self._resolved), self.lookups)]
+        if self._resolved.coalesced > 0:
+            lines.append("Waited for another lookup of the same volume %d times" % (
+                self._resolved.coalesced))
+        return lines + self.backend.summary()
+
+
+class AliasBackend(BackendWrapper):
+    """Looks up volumes by the names in aliases, a dict of normalised volume
+    name (see normaliseVolumeName) to (volumename, volumeid). A name with an
+    alias is searched for as volumename instead, or when volumeid is not
+    None, the volume is used without searching at all, so only its issues
+    are looked up
+    """
+
+    def __init__(self, backend, aliases):
+        BackendWrapper.__init__(self, backend)
+        self.aliases = aliases
+        self.pinned = 0
+        self.renamed = 0
+        self._lock = threading.Lock()
+
+    def _alias(self, name):
+        return self.aliases.get(normaliseVolumeName(name), (name, None))
+
+    def expect(self, volumename, issuenumbers):
+        self.backend.expect(self._alias(volumename)[0], issuenumbers)
+
+    def findVolume(self, name):
+        key = normaliseVolumeName(name)
+        if key not in self.aliases:
+            return self.backend.findVolume(name)
+
+        volumename, volumeid = self.aliases[key]
+        self._lock.acquire()
+        if volumeid is None:
+            self.renamed += 1
+        else:
+            self.pinned += 1
+        self._lock.release()
+
+        if volumeid is None:
+            log().info("Searching for volume %s as %s" % (name, volumename))
+            return self.backend.findVolume(volumename)
+
+        log().info("Using volume %s (%s) for %s" % (volumename, volumeid, name))
+        volume = VolumeInfo(volumeid, volumename)
+        self.backend.found(volumename, volume)
+        return volume
+
+    def summary(self):
+        return ["Aliases: %d pinned volumes used without searching, %d searched by alias" % (
+            self.pinned, self.renamed)] + self.backend.summary()
+
+
+class ComicvineBackend(Backend):
+    """Looks up volumes and issues using a comicvine_api.Comicvine instance.
+    Fetching a volume is the only request made to comicvine.com, as
+    comicvine_api fetches all its issues with it. The wait() of each
+    of limiters (RateLimiter instances) is called before each request. If
+    concurrency is given (an AdaptiveConcurrency), it limits the requests
+    made at once.
+
+    Requests which fail with an error (rather than the volume not existing)
+    are retried up to retries times, waiting about backoff seconds before
+    the first retry, doubling for each retry up to max_backoff seconds. If
+    breaker is given (a CircuitBreaker), requests are not made while it is
+    open
+    """
+
+    max_backoff = 60
+
+    def __init__(self, comicvine_instance, limiters = (), concurrency = None,
+            retries = 0, backoff = 1.0, breaker = None):
+        self.comicvine = comicvine_instance
+        self.limiters = limiters
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.retried = 0
+
+        # Volumes fetched during this run, by id
+        self._volumes = Memo()
+
+    def _getVolume(self, key, volumename):
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                self.breaker.check()
+
+            try:
+                volume = self._attempt(key, volumename)
+            except (volumeNotFound, UserAbort):
+                if self.breaker is not None:
+                    self.breaker.succeeded()
+                raise
+            except DataRetrievalError, errormsg:
+                if self.breaker is not None:
+                    self.breaker.failed()
+                if attempt >= self.retries:
+                    raise
+
+                # Random jitter spreads out the retries of concurrent lookups
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+                log().info("Retrying in %.1fs after error: %s" % (delay, errormsg))
+                attempt += 1
+                self.retried += 1
+                time.sleep(delay)
+            else:
+                if self.breaker is not None:
+                    self.breaker.succeeded()
+                return volume
+
+    def _attempt(self, key, volumename):
+        """Makes one request, within the rate and concurrency limits
+        """
+        for limiter in self.limiters:
+            limiter.wait()
+
+        if self.concurrency is None:
+            return self._request(key, volumename)
+
+        self.concurrency.acquire()
+        start = time.time()
+        failed = True
+        try:
+            volume = self._request(key, volumename)
+            failed = False
+            return volume
+        except (volumeNotFound, UserAbort):
+            # comicvine.com responded normally
+            failed = False
+            raise
+        finally:
+            self.concurrency.release(time.time() - start, failed)
+
+    def _request(self, key, volumename):
+        try:
+            return self.comicvine[key]
+        except comicvine_volumenotfound:
+            # No such volume found.
+            raise volumeNotFound("volume %s not found on www.comicvine.com" % volumename)
+        except comicvine_error, errormsg:
+            raise DataRetrievalError("Error contacting www.comicvine.com: %s" % errormsg)
+        except socket.timeout:
+            raise DataRetrievalError("Timed out contacting www.comicvine.com")
+        except IOError, errormsg:
+            # Network errors not handled by comicvine_api
+            raise DataRetrievalError("Error contacting www.comicvine.com: %s" % errormsg)
+        except comicvine_userabort, error:
+            raise UserAbort(unicode(error))
+
+    def findVolume(self, name):
+        volume = self._getVolume(name, name)
+        try:
+            volumeid = volume['id']
+        except comicvine_attributenotfound:
+            volumeid = None
+        else:
+            self._volumes.get(volumeid, lambda: volume)
+        return VolumeInfo(volumeid, volume['volumename'], data = volume)
+
+    def _fetch(self, volume):
+        """Fetches the data of a volume which was found through a cache
+        """
+        if volume.data is None:
+            volume.data = self._volumes.get(volume.volumeid,
+                self._getVolume, volume.volumeid, volume.volumename)
+
+    def getIssueName(self, volume, issueno):
+        self._fetch(volume)
+
+        try:
+            return volume.data[issueno]['issuename']
+        except comicvine_issuenotfound:
+            raise IssueNotFound(
+                "Issue %s of volume %s could not be found" % (
+                    issueno,
+                    volume.volumename))
+        except comicvine_attributenotfound:
+            raise IssueNameNotFound(
+                "Could not find issue name for %s issue %s" % (
+                    volume.volumename,
+                    issueno))
+
+    def listIssues(self, volume):
+        self._fetch(volume)
+
+        issues = {}
+        for issueno in volume.data.keys():
+            try:
+                issues[unicode(issueno)] = volume.data[issueno]['issuename']
+            except comicvine_issuenotfound:
+                pass
+            except comicvine_attributenotfound:
+                issues[unicode(issueno)] = None
+        return issues
+
+    def summary(self):
+        lines = [limiter.summary() for limiter in self.limiters]
+        if self.concurrency is not None:
+            lines.append(self.concurrency.summary())
+        if self.retried > 0:
+            lines.append("Retried %d failed requests" % self.retried)
+        if self.breaker is not None:
+            lines.append(self.breaker.summary())
+        return lines
+
+
+class PrefetchingBackend(BackendWrapper):
+    """Fetches the complete issue list of a volume once the run contains
+    more than threshold issues of it, after which its issue names are
+    looked up in memory.
+    """
+
+    def __init__(self, backend, threshold):
+        BackendWrapper.__init__(self, backend)
+        self.threshold = threshold
+
+        # Expected issues by normalised volume name, and by volume id. Once
+        # a name is resolved to a volume id (in _ids), issues expected for
+        # it are counted for the id as well, as later lookups of the name
+        # may be answered by a ResolvingBackend without reaching this one
+        self._expected = {}
+        self._expected_ids = {}
+        self._ids = {}
+        self._lock = threading.Lock()
+
+        # Issue lists by volume id
+        self._issues = Memo()
+
+    def expect(self, volumename, issuenumbers):
+        key = normaliseVolumeName(volumename)
+        self._lock.acquire()
+        try:
+            self._expected[key] = self._expected.get(key, 0) + len(issuenumbers)
+            if key in self._ids:
+                volumeid = self._ids[key]
+                self._expected_ids[volumeid] = self._expected_ids.get(volumeid, 0) + len(issuenumbers)
+        finally:
+            self._lock.release()
+        self.backend.expect(volumename, issuenumbers)
+
+    def _countExpected(self, name, volume):
+        key = normaliseVolumeName(name)
+        if volume.volumeid is not None:
+            self._lock.acquire()
+            try:
+                if key not in self._ids:
+                    self._ids[key] = volume.volumeid
+                    self._expected_ids[volume.volumeid] = (self._expected_ids.get(volume.volumeid, 0)
+                        + self._expected.get(key, 0))
+            finally:
+                self._lock.release()
+
+    def findVolume(self, name):
+        volume = self.backend.findVolume(name)
+        self._countExpected(name, volume)
+        return volume
+
+    def found(self, name, volume):
+        self._countExpected(name, volume)
+        self.backend.found(name, volume)
+
+    def _listIssues(self, volume):
+        log().info("Fetching all issues of %s" % volume.volumename)
+        return self.backend.listIssues(volume)
+
+    def getIssueName(self, volume, issueno):
+        if volume.volumeid not in self._issues:
+            if self._expected_ids.get(volume.volumeid, 0) <= self.threshold:
+                return self.backend.getIssueName(volume, issueno)
+
+        issues = self._issues.get(volume.volumeid, self._listIssues, volume)
+        try:
+            issuename = issues[unicode(issueno)]
+        except KeyError:
+            raise IssueNotFound(
+                "Issue %s of volume %s could not be found" % (
+                    issueno,
+                    volume.volumename))
+        if issuename is None:
+            raise IssueNameNotFound(
+                "Could not find issue name for %s issue %s" % (
+                    volume.volumename,
+                    issueno))
+        return issuename
+
+    def summary(self):
+        return ["Fetched complete issue lists of %d volumes" % len(self._issues)] + (
+            self.backend.summary())
+
+
+class CachedBackend(BackendWrapper):
+    """Caches volumes and issue names found by another backend in a
+    LookupCache. Volumes and issues which could not be found are also
+    cached, and raise the same error again until the entry expires
+    """
+
+    # Kinds of cached missing entry for issues, and the error raised for each
+    missingIssueKinds = (('issue', IssueNotFound), ('issuename', IssueNameNotFound))
+
+    def __init__(self, backend, cache):
+        BackendWrapper.__init__(self, backend)
+        self.cache = cache
+
+        self.hits = 0
+        self.known_missing = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
+
+    def findVolume(self, name):
+        key = normaliseVolumeName(name)
+        cached = self.cache.getVolume(key)
+        if cached is not None:
+            self._count('hits')
+            return VolumeInfo(*cached)
+
+        message = self.cache.getMissing('volume', key)
+        if message is not None:
+            self._count('known_missing')
+            raise volumeNotFound("%s (cached)" % message)
+
+        self._count('misses')
+        try:
+            volume = self.backend.findVolume(name)
+        except volumeNotFound, errormsg:
+            self.cache.setMissing('volume', key, unicode(errormsg))
+            raise
+
+        if volume.volumeid is not None:
+            self.cache.setVolume(key, volume.volumeid, volume.volumename)
+        return volume
+
+    def getIssueName(self, volume, issueno):
+        if volume.volumeid is None:
+            return self.backend.getIssueName(volume, issueno)
+
+        issuename = self.cache.getIssueName(volume.volumeid, issueno)
+        if issuename is not None:
+            self._count('hits')
+            return issuename
+
+        key = "%s/%s" % (volume.volumeid, issueno)
+        for kind, errorclass in self.missingIssueKinds:
+            message = self.cache.getMissing(kind, key)
+            if message is not None:
+                self._count('known_missing')
+                raise errorclass("%s (cached)" % message)
+
+        self._count('misses')
+        try:
+            issuename = self.backend.getIssueName(volume, issueno)
+        except (IssueNotFound, IssueNameNotFound), errormsg:
+            for kind, errorclass in self.missingIssueKinds:
+                if isinstance(errormsg, errorclass):
+                    self.cache.setMissing(kind, key, unicode(errormsg))
+            raise
+
+        self.cache.setIssueName(volume.volumeid, issueno, issuename)
+        return issuename
+
+    def listIssues(self, volume):
+        if volume.volumeid is None:
+            return self.backend.listIssues(volume)
+
+        issues = self.cache.getListing(volume.volumeid)
+        if issues is not None:
+            self._count('hits')
+            return issues
+
+        self._count('misses')
+        issues = self.backend.listIssues(volume)
+        self.cache.setListing(volume.volumeid, issues)
+        return issues
+
+    def summary(self):
+        return ["Cache: %d hits, %d known missing, %d misses" % (
+            self.hits, self.known_missing, self.misses)] + self.backend.summary()
+
+    def close(self):
+        self.cache.close()
+        self.backend.close()
+
+
+# Errors stored in cassettes: only definitive results, not errors such as
+# timeouts or comicvine.com being unavailable, which may not happen again
+recordableErrors = (volumeNotFound, IssueNotFound, IssueNameNotFound)
+
+
+def _errorEntry(errormsg):
+    """Returns the cassette entry for a failed lookup
+    """
+    for errorclass in recordableErrors:
+        if isinstance(errormsg, errorclass):
+            return {'error': errorclass.__name__, 'message': unicode(errormsg)}
+
+
+class RecordingBackend(BackendWrapper):
+    """Records every volume search, issue name and issue list looked up
+    through backend, and the volumes and issues which were not found, in a
+    Cassette which is saved on close(), to be replayed with ReplayBackend.
+    Lookups which failed with other errors are not recorded
+    """
+
+    def __init__(self, backend, cassette):
+        BackendWrapper.__init__(self, backend)
+        self.cassette = cassette
+
+    def findVolume(self, name):
+        key = normaliseVolumeName(name)
+        try:
+            volume = self.backend.findVolume(name)
+        except recordableErrors, errormsg:
+            self.cassette.set('volumes', key, _errorEntry(errormsg))
+            raise
+        self.cassette.set('volumes', key, {'id': volume.volumeid, 'name': volume.volumename})
+        return volume
+
+    def getIssueName(self, volume, issueno):
+        key = "%s/%s" % (volume.volumeid, issueno)
+        try:
+            issuename = self.backend.getIssueName(volume, issueno)
+        except recordableErrors, errormsg:
+            self.cassette.set('issues', key, _errorEntry(errormsg))
+            raise
+        self.cassette.set('issues', key, {'name': issuename})
+        return issuename
+
+    def listIssues(self, volume):
+        try:
+            issues = self.backend.listIssues(volume)
+        except recordableErrors, errormsg:
+            self.cassette.set('listings', volume.volumeid, _errorEntry(errormsg))
+            raise
+        self.cassette.set('listings', volume.volumeid, {'issues': issues})
+        return issues
+
+    def close(self):
+        self.backend.close()
+        self.cassette.save()
+
+
+class ReplayBackend(Backend):
+    """Serves lookups from a Cassette recorded by RecordingBackend, without
+    contacting comicvine.com. Each volume search and issue list takes an
+    extra latency seconds, to imitate requests. Lookups which were not
+    recorded raise DataRetrievalError
+    """
+
+    def __init__(self, cassette, latency = 0):
+        self.cassette = cassette
+        self.latency = latency
+
+        self.replayed = 0
+        self.unrecorded = 0
+        self._lock = threading.Lock()
+
+    def _replay(self, kind, key, latency = 0):
+        """Returns the recorded entry, raising the recorded error
+        """
+        if latency > 0:
+            time.sleep(latency)
+
+        entry = self.cassette.get(kind, key)
+        self._lock.acquire()
+        if entry is None:
+            self.unrecorded += 1
+        else:
+            self.replayed += 1
+        self._lock.release()
+
+        if entry is None:
+            raise DataRetrievalError("Lookup of %s %s was not recorded in %s" % (
+                kind, key, self.cassette.path))
+        if 'error' in entry:
+            # Older cassettes also recorded other errors
+            errorclass = dict((x.__name__, x) for x in recordableErrors).get(
+                entry['error'], DataRetrievalError)
+            raise errorclass(entry['message'])
+        return entry
+
+    def findVolume(self, name):
+        entry = self._replay('volumes', normaliseVolumeName(name), self.latency)
+        return VolumeInfo(entry['id'], entry['name'])
+
+    def getIssueName(self, volume, issueno):
+        if self.cassette.get('issues', "%s/%s" % (volume.volumeid, issueno)) is None:
+            # Recorded while the volume's issue names were prefetched
+            listing = self.cassette.get('listings', volume.volumeid)
+            if listing is not None and 'issues' in listing:
+                try:
+                    issuename = listing['issues'][unicode(issueno)]
+                except KeyError:
+                    raise IssueNotFound(
+                        "Issue %s of volume %s could not be found" % (
+                            issueno,
+                            volume.volumename))
+                if issuename is None:
+                    raise IssueNameNotFound(
+                        "Could not find issue name for %s issue %s" % (
+                            volume.volumename,
+                            issueno))
+                return issuename
+
+        return self._replay('issues', "%s/%s" % (volume.volumeid, issueno))['name']
+
+    def listIssues(self, volume):
+        return self._replay('listings', volume.volumeid, self.latency)['issues']
+
+    def summary(self):
+        return ["Replayed %d lookups from %s, %d were not recorded" % (
+            self.replayed, self.cassette.path, self.unrecorded)]
+
+
+class OfflineBackend(Backend):
+    """Looks up volumes and issues in a local Catalog, without contacting
+    comicvine.com
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        self._lock.acquire()
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._lock.release()
+
+    def findVolume(self, name):
+        found = self.catalog.findVolume(normaliseVolumeName(name))
+        self._count(found is not None)
+        if found is None:
+            raise volumeNotFound("volume %s not found in catalog %s" % (name, self.catalog.path))
+
+        volumeid, volumename, year = found
+        return VolumeInfo(volumeid, volumename)
+
+    def getIssueName(self, volume, issueno):
+        issuename = self.catalog.getIssueName(volume.volumeid, issueno)
+        self._count(issuename is not None)
+        if issuename is None:
+            raise IssueNotFound(
+                "Issue %s of volume %s could not be found in catalog" % (
+                    issueno,
+                    volume.volumename))
+        if issuename == u"":
+            raise IssueNameNotFound(
+                "Could not find issue name for %s issue %s" % (
+                    volume.volumename,
+                    issueno))
+        return issuename
+
+    def listIssues(self, volume):
+        return self.catalog.listIssues(volume.volumeid)
+
+    def summary(self):
+        return ["Catalog: %d found, %d not found" % (self.hits, self.misses)]
+
+    def close(self):
+        self.catalog.close()
+
+
+class ProviderChain(Backend):
+    """Looks up volumes and issues with each of providers, a list of (name,
+    Backend), in order, until one answers. When a provider raises
+    DataRetrievalError (such as volumeNotFound, or an error contacting
+    comicvine.com), the next provider is asked, and the last provider's
+    error is raised. Providers share volume ids, so an issue of a volume
+    found by one provider can be looked up with another.
+
+    The number of lookups each provider answered and passed on, and the time
+    taken, are shown in the summary
+    """
+
+    def __init__(self, providers):
+        self.providers = providers
+
+        # Lookups answered, lookups passed on, and seconds taken by name
+        self.stats = dict((name, [0, 0, 0.0]) for name, provider in providers)
+        self._lock = threading.Lock()
+
+    def _ask(self, method, *args):
+        for position, (name, provider) in enumerate(self.providers):
+            start = time.time()
+            try:
+                result = getattr(provider, method)(*args)
+            except DataRetrievalError:
+                self._count(name, False, time.time() - start)
+                if position == len(self.providers) - 1:
+                    raise
+            else:
+                self._count(name, True, time.time() - start)
+                return result
+
+    def _count(self, name, answered, elapsed):
+        self._lock.acquire()
+        try:
+            stats = self.stats[name]
+            if answered:
+                stats[0] += 1
+            else:
+                stats[1] += 1
+            stats[2] += elapsed
+        finally:
+            self._lock.release()
+
+    def findVolume(self, name):
+        return self._ask('findVolume', name)
+
+    def getIssueName(self, volume, issueno):
+        return self._ask('getIssueName', volume, issueno)
+
+    def listIssues(self, volume):
+        return self._ask('listIssues', volume)
+
+    def expect(self, volumename, issuenumbers):
+        for name, provider in self.providers:
+            provider.expect(volumename, issuenumbers)
+
+    def found(self, volumename, volume):
+        for name, provider in self.providers:
+            provider.found(volumename, volume)
+
+    def summary(self):
+        lines = []
+        for name, provider in self.providers:
+            answered, passed, elapsed = self.stats[name]
+            lines.append("Provider %s: answered %d, passed on %d, %.1fms per lookup" % (
+                name, answered, passed, 1000 * elapsed / max(1, answered + passed)))
+        for name, provider in self.providers:
+            lines.extend(provider.summary())
+        return lines
+
+    def close(self):
+        for name, provider in self.providers:
+            provider.close()
+
+
+def getCache():
+    """Opens the LookupCache, as configured
+    """
+    return LookupCache(
+        Config['cache_file'],
+        ttl = Config['cache_ttl'],
+        max_entries = Config['cache_max_entries'],
+        refresh = Config['cache_refresh'],
+        negative_ttl = Config['cache_negative_ttl'])
+
+
+def openCatalog():
+    """Opens the Catalog, as configured
+    """
+    try:
+        return Catalog(Config['catalog_file'])
+    except (IOError, ValueError), errormsg:
+        raise ConfigValueError("Could not open catalog %s: %s" % (
+            Config['catalog_file'], errormsg))
+
+
+def getCassetteLookup():
+    """Returns a ReplayBackend for the configured cassette
+    """
+    cassette = Cassette(Config['replay_cassette'])
+    try:
+        cassette.load()
+    except (IOError, ValueError), errormsg:
+        raise ConfigValueError("Could not load cassette %s: %s" % (
+            Config['replay_cassette'], errormsg))
+
+    lookup = ReplayBackend(cassette, latency = Config['replay_latency'])
+    if Config['prefetch_threshold'] is not None:
+        lookup = PrefetchingBackend(lookup, Config['prefetch_threshold'])
+    return lookup
+
+
+def getComicvineLookup(comicvine_instance):
+    """Returns the Backend looking up volumes and issues on comicvine.com,
+    with the configured limits, cache and prefetching
+    """
+    limiters = []
+    if Config['lookup_rate_limit']:
+        limiters.append(RateLimiter(Config['lookup_rate_limit']))
+
+    if Config['shared_rate_limit']:
+        if fcntl is None:
+            p("WARNING: Shared rate limit is not supported on this platform, limiting this process only",
+                file = sys.stderr)
+            limiters.append(RateLimiter(Config['shared_rate_limit'] / 3600.0))
+        else:
+            limiters.append(SharedRateLimiter(Config['shared_rate_limit_file'],
+                Config['shared_rate_limit'], Config['shared_rate_limit_burst']))
+
+    concurrency = None
+    if Config['lookup_adaptive'] and Config['lookup_workers'] > 1:
+        concurrency = AdaptiveConcurrency(Config['lookup_workers'])
+
+    breaker = None
+    if Config['circuit_breaker_failures']:
+        breaker = CircuitBreaker(Config['circuit_breaker_failures'],
+            Config['circuit_breaker_cooldown'])
+
+    if Config['lookup_timeout']:
+        # comicvine_api does not take a timeout, so it is set for all
+        # sockets created from now on
+        socket.setdefaulttimeout(Config['lookup_timeout'])
+
+    lookup = ComicvineBackend(comicvine_instance, limiters = limiters,
+        concurrency = concurrency, retries = Config['lookup_retries'],
+        backoff = Config['lookup_retry_backoff'], breaker = breaker)
+
+    if Config['cache_enable']:
+        try:
+            cache = getCache()
+        except sqlite3.Error, errormsg:
+            p("WARNING: Not using lookup cache %s: %s" % (
+                Config['cache_file'], errormsg), file = sys.stderr)
+        else:
+            lookup = CachedBackend(lookup, cache)
+
+    if Config['record_cassette']:
+        lookup = RecordingBackend(lookup, Cassette(Config['record_cassette']))
+
+    if Config['prefetch_threshold'] is not None:
+        lookup = PrefetchingBackend(lookup, Config['prefetch_threshold'])
+
+    return lookup
+
+
+# Providers which can be listed in Config['providers']
+providerNames = ('catalog', 'comicvine')
+
+
+def getProviderNames():
+    """Returns the names of the providers to look up volumes and issues
+    with, in order. Offline only the catalog is used, and when replaying a
+    cassette it replaces comicvine
+    """
+    if Config['offline']:
+        return ['catalog']
+
+    names = list(Config['providers'])
+    for name in names:
+        if name not in providerNames:
+            raise ConfigValueError("Unknown provider %r, should be one of: %s" % (
+                name, ", ".join(providerNames)))
+
+    if Config['replay_cassette']:
+        names = [name == 'comicvine' and 'cassette' or name for name in names]
+    return names
+
+
+def getAliases():
+    """Returns the configured volume_aliases as a dict for AliasBackend
+    """
+    aliases = {}
+    for name, alias in Config['volume_aliases'].items():
+        if isinstance(alias, basestring):
+            volumename, volumeid = alias, None
+        elif isinstance(alias, dict) and isinstance(alias.get('name'), basestring):
+            volumename, volumeid = alias['name'], alias.get('id')
+            if volumeid is not None and not isinstance(volumeid, (int, long)):
+                raise ConfigValueError("Volume id of alias %r should be a number, not %r" % (
+                    name, volumeid))
+        else:
+            raise ConfigValueError("Alias %r should be a volume name, or a dict with "
+                "the keys 'name' and (optionally) 'id', not %r" % (name, alias))
+        aliases[normaliseVolumeName(unicode(name))] = (unicode(volumename), volumeid)
+    return aliases
+
+
+def getLookup(comicvine_instance):
+    """Returns the Backend to use for looking up volumes and issues, as
+    configured. comicvine_instance is only used if comicvine is one of the
+    providers (see getProviderNames)
+    """
+    providers = []
+    for name in getProviderNames():
+        if name == 'catalog':
+            providers.append((name, OfflineBackend(openCatalog())))
+        elif name == 'cassette':
+            providers.append((name, getCassetteLookup()))
+        else:
+            providers.append((name, getComicvineLookup(comicvine_instance)))
+
+    if len(providers) == 1:
+        lookup = providers[0][1]
+    else:
+        lookup = ProviderChain(providers)
+
+    aliases = getAliases()
+    if len(aliases) > 0:
+        lookup = AliasBackend(lookup, aliases)
+    return ResolvingBackend(lookup)
+
+
+def printNegativeCache():
+    """Displays the cached volumes and issues which could not be found
+    """
+    cache = getCache()
+    entries = cache.listMissing()
+    cache.close()
+
+    now = time.time()
+    for kind, key, message, fetched in entries:
+        p("%-9s %-40s %5.1f days ago: %s" % (
+            kind, key, (now - fetched) / (24 * 60 * 60), message))
+    p("# %d volumes or issues cached as not found" % len(entries))
+
+
+def purgeNegativeCache():
+    """Removes the cached volumes and issues which could not be found, so
+    they are looked up again
+    """
+    cache = getCache()
+    removed = cache.purgeMissing()
+    cache.close()
+    p("# Removed %d volumes or issues cached as not found" % removed)
+
+
+def buildCatalog(cassette_paths):
+    """Builds the catalog from the volumes and issues in the lookup cache,
+    and the cassette files recorded with record_cassette
+    """
+    writer = CatalogWriter(Config['catalog_file'])
+
+    if os.path.isfile(os.path.expanduser(Config['cache_file'])):
+        cache = getCache()
+        for key, volumeid, volumename in cache.listVolumes():
+            writer.addVolume(key, volumeid, volumename)
+            writer.addVolume(normaliseVolumeName(volumename), volumeid, volumename)
+        for volumeid, issueno, issuename in cache.listIssues():
+            writer.addIssue(volumeid, issueno, issuename)
+        cache.close()
+
+    for path in cassette_paths:
+        cassette = Cassette(path)
+        try:
+            cassette.load()
+        except (IOError, ValueError), errormsg:
+            raise ConfigValueError("Could not load cassette %s: %s" % (path, errormsg))
+
+        for key, entry in cassette.entries['volumes'].items():
+            if 'error' not in entry:
+                writer.addVolume(key, entry['id'], entry['name'])
+                writer.addVolume(normaliseVolumeName(entry['name']), entry['id'], entry['name'])
+        for key, entry in cassette.entries['issues'].items():
+            volumeid, issueno = key.split(u"/", 1)
+            if volumeid == u"None":
+                continue
+            if 'error' not in entry:
+                writer.addIssue(int(volumeid), issueno, entry['name'])
+            elif entry['error'] == IssueNameNotFound.__name__:
+                writer.addIssue(int(volumeid), issueno, None)
+        for volumeid, entry in cassette.entries['listings'].items():
+            if 'error' not in entry and volumeid != u"None":
+                for issueno, issuename in entry['issues'].items():
+                    writer.addIssue(int(volumeid), issueno, issuename)
+
+    writer.write()
+    p("# Catalog %s has %d volume names and %d issues" % (
+        writer.path, len(writer.volumes), len(writer.issues)))
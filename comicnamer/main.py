@@ -10,7 +10,13 @@ Modified from http://github.com/dbr/tvnamer
 """
 
 import os
+import time
 import logging
+import datetime
+import zipfile
+import itertools
+import collections
+from multiprocessing.pool import ThreadPool
 
 try:
     import readline
@@ -24,13 +30,19 @@ import cliarg_parser
 from config_defaults import defaults
 
 from unicode_helper import p
+from patterns import printPatternStats, savePatternStats
+from pattern_analysis import analysePatterns
+from comicvine_client import ComicvineClient
+from comicinfo import writeComicInfo, zip_extensions
+from lookup import (getLookup, normaliseVolumeName, printNegativeCache,
+purgeNegativeCache, buildCatalog, getProviderNames, waitInterruptibly)
 from utils import (Config, FileFinder, FileParser, Renamer, warn,
 getIssueName, applyCustomInputReplacements, applyCustomOutputReplacements,
 formatIssueNumbers, makeValidFilename)
 
 from comicnamer_exceptions import (volumeNotFound, IssueNotFound,
 IssueNameNotFound, UserAbort, InvalidPath, NoValidFilesFoundError,
-InvalidFilename, DataRetrievalError)
+InvalidFilename, DataRetrievalError, ServiceUnavailable, ConfigValueError)
 
 
 def log():
@@ -104,8 +116,30 @@ def confirm(question, options, default = "y"):
             return default
 
 
-def processFile(comicvine_instance, issue):
-    """Gets issue name, prompts user for input
+def resolveIssue(lookup, issue):
+    """Calls getIssueName, in a lookup worker thread. Returns (result, None),
+    or (None, exception) so the error can be handled by lookupIssue
+    """
+    try:
+        return getIssueName(lookup, issue), None
+    except Exception, errormsg:
+        return None, errormsg
+
+
+def skipOnError():
+    """Returns True if files which could not be looked up should be skipped.
+    Offline, they are renamed without the issue name instead
+    """
+    return (Config['always_rename'] and Config['skip_file_on_error'] is True
+        and not Config['offline'])
+
+
+def lookupIssue(lookup, issue, resolved = None, deferred = None):
+    """Gets issue name, updating issue with it and the corrected volume name.
+    Returns False if the file should be skipped. resolved is the result of
+    resolveIssue, if the issue was already looked up by a worker thread.
+    If comicvine.com is unavailable, the issue is appended to the deferred
+    list and skipped, when deferred is given
     """
     p("#" * 20)
     p("# Processing file: %s" % issue.fullfilename)
@@ -119,25 +153,48 @@ def processFile(comicvine_instance, issue):
         ", ".join([str(x) for x in issue.issuenumbers])))
 
     try:
-        correctedvolumeName, issName = getIssueName(comicvine_instance, issue)
-    except (DataRetrievalError, volumeNotFound), errormsg:
-        if Config['always_rename'] and Config['skip_file_on_error'] is True:
-            warn("Skipping file due to error: %s" % errormsg)
-            return
+        if resolved is None:
+            correctedvolumeName, issName = getIssueName(lookup, issue)
         else:
-            warn(errormsg)
+            result, error = resolved
+            if error is not None:
+                raise error
+            correctedvolumeName, issName = result
+    except ServiceUnavailable, errormsg:
+        if deferred is not None:
+            warn("Deferring file to the end of the run: %s" % errormsg)
+            deferred.append(issue)
+            return False
+        if (Config['circuit_breaker_action'] != 'rename' and
+                Config['always_rename'] and Config['skip_file_on_error'] is True):
+            warn("Skipping file due to error: %s" % errormsg)
+            return False
+        warn(errormsg)
     except (IssueNotFound, IssueNameNotFound), errormsg:
         # volume was found, so use corrected volume name
-        if Config['always_rename'] and Config['skip_file_on_error'] is True:
+        if skipOnError():
             warn("Skipping file due to error: %s" % errormsg)
-            return
+            return False
 
         warn(errormsg)
-        issue.volumename = correctedvolumeName
+        issue.volumename = errormsg.volumename
+    except (DataRetrievalError, volumeNotFound), errormsg:
+        if skipOnError():
+            warn("Skipping file due to error: %s" % errormsg)
+            return False
+        else:
+            warn(errormsg)
     else:
         issue.volumename = correctedvolumeName
         issue.issuename = issName
 
+    return True
+
+
+def renameIssue(issue):
+    """Renames (and moves) the file for issue, prompting user for input.
+    Returns the path of the file afterwards, or None if the user skipped it
+    """
     cnamer = Renamer(issue.fullpath)
     newName = issue.generateFilename()
 
@@ -157,7 +214,7 @@ def processFile(comicvine_instance, issue):
         doRenameFile(cnamer, newName)
         if Config['move_files_enable']:
             doMoveFile(cnamer = cnamer, destDir = getDestinationFolder(issue))
-        return
+        return cnamer.filename
 
     ans = confirm("Rename?", options = ['y', 'n', 'a', 'q'], default = 'y')
 
@@ -174,8 +231,10 @@ def processFile(comicvine_instance, issue):
         shouldRename = True
     elif ans == "n":
         p("Skipping")
+        return None
     else:
         p("Invalid input, skipping")
+        return None
 
     if shouldRename:
         doRenameFile(cnamer, newName)
@@ -196,6 +255,50 @@ def processFile(comicvine_instance, issue):
                 p("Quitting")
                 raise UserAbort("user exited with q")
 
+    return cnamer.filename
+
+
+def writeMetadata(issue, path):
+    """Writes the volume name, issue number and issue name of issue into
+    the ComicInfo.xml of the CBZ file at path (as returned by renameIssue),
+    if write_comicinfo is enabled and a single issue's name was found
+    """
+    if not Config['write_comicinfo'] or path is None:
+        return
+    if os.path.splitext(path)[1].lower() not in zip_extensions:
+        return
+    if issue.issuename is None or len(issue.issuenumbers) != 1 or issue.issuename[0] is None:
+        return
+
+    try:
+        written = writeComicInfo(path, issue.volumename, issue.issuenumbers[0], issue.issuename[0])
+    except (IOError, zipfile.BadZipfile, SyntaxError), errormsg:
+        warn("Could not write ComicInfo.xml to %s: %s" % (path, errormsg))
+    else:
+        if written > 0:
+            p("Wrote ComicInfo.xml (%d bytes)" % written)
+
+
+def processFile(lookup, issue):
+    """Gets issue name, prompts user for input
+    """
+    if lookupIssue(lookup, issue):
+        writeMetadata(issue, renameIssue(issue))
+
+
+def getFileFinder(path):
+    """Returns a FileFinder for path, configured from Config
+    """
+    return FileFinder(
+        path,
+        with_extension = Config['valid_extensions'],
+        recursive = Config['recursive'],
+        threads = Config['finder_threads'],
+        max_depth = Config['max_depth'],
+        follow_symlinks = Config['follow_symlinks'],
+        exclude_dirs = Config['exclude_dirs'],
+        exclude_files = Config['exclude_files'])
+
 
 def findFiles(paths):
     """Takes an array of paths, returns all files found
@@ -203,10 +306,7 @@ def findFiles(paths):
     valid_files = []
 
     for cfile in paths:
-        cur = FileFinder(
-            cfile,
-            with_extension = Config['valid_extensions'],
-            recursive = Config['recursive'])
+        cur = getFileFinder(cfile)
 
         try:
             valid_files.extend(cur.findFiles())
@@ -222,6 +322,251 @@ def findFiles(paths):
     return valid_files
 
 
+def iterFiles(paths, exclude = None):
+    """Takes an array of paths, yields files as they are found, except
+    those in exclude (a set of absolute paths, which may grow meanwhile).
+    Duplicates can only occur when several paths are given, so only then
+    are the found files remembered to remove them
+    """
+    if len(paths) > 1:
+        seen = set()
+    else:
+        seen = None
+
+    for cfile in paths:
+        cur = getFileFinder(cfile)
+
+        try:
+            for found in cur.iterFiles():
+                if exclude is not None and found in exclude:
+                    continue
+                if seen is not None:
+                    if found in seen:
+                        continue
+                    seen.add(found)
+                yield found
+        except InvalidPath:
+            warn("Invalid path: %s" % cfile)
+
+
+def iterIssues(parser, files, batchsize = 100):
+    """Parses files in batches of batchsize, yields an IssueInfo for each
+    valid filename
+    """
+    while True:
+        batch = list(itertools.islice(files, batchsize))
+        if len(batch) == 0:
+            break
+
+        batch = [cfile.decode("utf-8") if isinstance(cfile, str) else cfile
+            for cfile in batch]
+        for cfile, result in parser.parseMany(batch):
+            if isinstance(result, InvalidFilename):
+                warn("Invalid filename %s" % cfile)
+            else:
+                yield result
+
+
+def issueSortKey(issue):
+    """Returns the key to sort issues by volume name and issue number, so
+    files for the same volume are processed together, even if spelt
+    differently. Dated issues sort after numbered ones, as they cannot be
+    compared
+    """
+    return (normaliseVolumeName(issue.volumename),
+        [(isinstance(x, datetime.date), x) for x in issue.issuenumbers])
+
+
+def sortedWindows(issues, window):
+    """Splits issues into consecutive lists of window issues, each sorted by
+    volume name and issue number, so only that many are held in memory.
+    A window of 0 yields each issue alone, in the order they were found
+    """
+    if window <= 0:
+        for issue in issues:
+            yield [issue]
+        return
+
+    while True:
+        batch = list(itertools.islice(issues, window))
+        if len(batch) == 0:
+            break
+
+        batch.sort(key = issueSortKey)
+        yield batch
+
+
+def expectIssues(lookup, issues):
+    """Tells lookup about issues before they are looked up, so it can plan
+    ahead (such as fetching complete issue lists of volumes)
+    """
+    for issue in issues:
+        lookup.expect(issue.volumename, issue.issuenumbers)
+
+
+def getComicvine():
+    """Returns the configured comicvine.com client, a comicvine_api.Comicvine
+    or ComicvineClient instance, or None when comicvine.com is not used
+    """
+    if 'comicvine' not in getProviderNames():
+        return None
+
+    if Config['comicvine_client'] == 'builtin':
+        if Config['select_first']:
+            if not Config['comicvine_api_key']:
+                raise ConfigValueError("comicvine_api_key must be set to use the builtin client")
+            return ComicvineClient(Config['comicvine_api_key'],
+                base_url = Config['comicvine_base_url'])
+        log().info("Not using the builtin client, as volumes may need to be chosen interactively")
+
+    return Comicvine(interactive = not Config['select_first'])
+
+
+def getLookupPool():
+    """Returns a ThreadPool of Config['lookup_workers'] threads to look up
+    issues with, or None to look them up one at a time. Lookups are only
+    concurrent with select_first (as in batch mode), as choosing between
+    search results needs the terminal
+    """
+    if Config['lookup_workers'] <= 1:
+        return None
+    if not Config['select_first']:
+        log().info("Not using lookup_workers, as volumes may need to be chosen interactively")
+        return None
+    return ThreadPool(Config['lookup_workers'])
+
+
+def iterResolved(lookup, issues, pool, ahead):
+    """Looks up issues using pool, up to ahead issues in advance of the one
+    last yielded. Yields (issue, result of resolveIssue) in the original order
+    """
+    pending = collections.deque()
+    for issue in issues:
+        pending.append((issue, pool.apply_async(resolveIssue, (lookup, issue))))
+        if len(pending) >= ahead:
+            issue, result = pending.popleft()
+            yield issue, waitInterruptibly(result.get)
+
+    while len(pending) > 0:
+        issue, result = pending.popleft()
+        yield issue, waitInterruptibly(result.get)
+
+
+def iterLookedUp(lookup, issues, pool = None, deferred = None):
+    """Looks up each issue, yields those which should be renamed. With a
+    pool, issues are looked up concurrently, ahead of the one being renamed.
+    Issues which could not be looked up as comicvine.com was unavailable are
+    appended to deferred, if given
+    """
+    if pool is None:
+        for issue in issues:
+            if lookupIssue(lookup, issue, deferred = deferred):
+                yield issue
+        return
+
+    for issue, resolved in iterResolved(lookup, issues, pool, Config['lookup_workers'] * 4):
+        if lookupIssue(lookup, issue, resolved, deferred):
+            yield issue
+
+
+def getDeferred():
+    """Returns the list to collect issues deferred while comicvine.com is
+    unavailable in, or None if they should not be deferred
+    """
+    if Config['circuit_breaker_action'] == 'defer':
+        return []
+    return None
+
+
+def iterDeferred(lookup, deferred):
+    """Looks up the issues deferred while comicvine.com was unavailable,
+    yields those which should be renamed. Waits for comicvine.com to be
+    tried again once, after which any issues it is still unavailable for are
+    handled as other lookup errors
+    """
+    if not deferred:
+        return
+
+    p("#" * 20)
+    p("# Looking up %d deferred file" % len(deferred) + ("s" * (len(deferred) > 1)))
+
+    waited = False
+    for issue in deferred:
+        resolved = resolveIssue(lookup, issue)
+        if isinstance(resolved[1], ServiceUnavailable) and not waited:
+            p("# Waiting %.0fs for www.comicvine.com" % resolved[1].retry_after)
+            time.sleep(resolved[1].retry_after)
+            waited = True
+            resolved = resolveIssue(lookup, issue)
+
+        if lookupIssue(lookup, issue, resolved):
+            yield issue
+
+
+def closeLookup(lookup):
+    """Closes the lookup backend, displaying its summary
+    """
+    for line in lookup.summary():
+        p("# %s" % line)
+    lookup.close()
+
+
+def comicnamerStream(paths):
+    """Streaming version of comicnamer, for large numbers of files. Each
+    file is looked up and renamed as soon as it is found and parsed, rather
+    than after all paths have been searched.
+
+    Files are moved (with move_files_enable) while directories are still
+    being searched, so the paths they are moved to are remembered, and
+    skipped if the destination is searched later.
+    """
+    lookup = getLookup(getComicvine())
+
+    # Files moved to another directory, by their new absolute path
+    moved = set()
+
+    parser = FileParser()
+    windows = sortedWindows(
+        iterIssues(parser, iterFiles(paths, exclude = moved)),
+        Config['stream_sort_window'])
+
+    pool = getLookupPool()
+    deferred = getDeferred()
+
+    def process(issue):
+        olddir = os.path.dirname(os.path.abspath(issue.fullpath))
+        newpath = renameIssue(issue)
+        if newpath is not None and os.path.dirname(newpath) != olddir:
+            moved.add(newpath)
+        writeMetadata(issue, newpath)
+        p('')
+
+    found = 0
+    renamed = 0
+    try:
+        for issues in windows:
+            found += len(issues)
+            expectIssues(lookup, issues)
+            for issue in iterLookedUp(lookup, issues, pool, deferred):
+                process(issue)
+                renamed += 1
+
+        for issue in iterDeferred(lookup, deferred):
+            process(issue)
+            renamed += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        savePatternStats()
+        closeLookup(lookup)
+
+    if found == 0:
+        raise NoValidFilesFoundError()
+
+    p("# Processed %d of %d issue" % (renamed, found) + ("s" * (found > 1)))
+
+
 def comicnamer(paths):
     """Main comicnamer function, takes an array of paths, does stuff.
     """
@@ -236,32 +581,48 @@ def comicnamer(paths):
     p("#" * 20)
     p("# Starting comicnamer")
 
+    if Config['stream']:
+        comicnamerStream(paths)
+        p("#" * 20)
+        p("# Done")
+        return
+
     issues_found = []
 
-    for cfile in findFiles(paths):
-        cfile = cfile.decode("utf-8")
-        parser = FileParser(cfile)
-        try:
-            issue = parser.parse()
-        except InvalidFilename:
+    parser = FileParser()
+    files = [cfile.decode("utf-8") for cfile in findFiles(paths)]
+    for cfile, result in parser.parseMany(files):
+        if isinstance(result, InvalidFilename):
             warn("Invalid filename %s" % cfile)
         else:
-            issues_found.append(issue)
+            issues_found.append(result)
+
+    savePatternStats()
 
     if len(issues_found) == 0:
         raise NoValidFilesFoundError()
 
     p("# Found %d issue" % len(issues_found) + ("s" * (len(issues_found) > 1)))
 
-    # Sort issues by volume name and issue number
-    issues_found.sort(key = lambda x: (x.volumename, x.issuenumbers))
+    issues_found.sort(key = issueSortKey)
 
-    comicvine_instance = Comicvine(
-        interactive=not Config['select_first'])
+    lookup = getLookup(getComicvine())
 
-    for issue in issues_found:
-        processFile(comicvine_instance, issue)
-        p('')
+    expectIssues(lookup, issues_found)
+    pool = getLookupPool()
+    deferred = getDeferred()
+
+    try:
+        for issue in itertools.chain(
+                iterLookedUp(lookup, issues_found, pool, deferred),
+                iterDeferred(lookup, deferred)):
+            writeMetadata(issue, renameIssue(issue))
+            p('')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        closeLookup(lookup)
 
     p("#" * 20)
     p("# Done")
@@ -315,6 +676,12 @@ def main():
         del configToSave['saveconfig']
         del configToSave['loadconfig']
         del configToSave['showconfig']
+        del configToSave['showpatternstats']
+        del configToSave['analyze_patterns']
+        del configToSave['cache_refresh']
+        del configToSave['list_negative_cache']
+        del configToSave['purge_negative_cache']
+        del configToSave['build_catalog']
         json.dump(
             configToSave,
             open(opts.saveconfig, "w+"),
@@ -337,6 +704,29 @@ def main():
     # Update global config object
     Config.update(opts.__dict__)
 
+    if opts.showpatternstats:
+        printPatternStats()
+        return
+
+    if opts.analyze_patterns is not None:
+        analysePatterns(opts.analyze_patterns)
+        return
+
+    if opts.list_negative_cache:
+        printNegativeCache()
+        return
+
+    if opts.purge_negative_cache:
+        purgeNegativeCache()
+        return
+
+    if opts.build_catalog:
+        try:
+            buildCatalog(args)
+        except ConfigValueError, errormsg:
+            opter.error(errormsg)
+        return
+
     if len(args) == 0:
         opter.error("No filenames or directories supplied")
 
@@ -344,7 +734,7 @@ def main():
         comicnamer(paths = sorted(args))
     except NoValidFilesFoundError:
         opter.error("No valid files were supplied")
-    except UserAbort, errormsg:
+    except (UserAbort, ConfigValueError), errormsg:
         opter.error(errormsg)
 
 if __name__ == '__main__':
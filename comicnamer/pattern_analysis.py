@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Analyses the configured filename patterns against a corpus of filenames
+"""
+
+import os
+import re
+import array
+import sre_parse
+import sre_constants
+import multiprocessing
+from timeit import default_timer
+
+from unicode_helper import p
+
+from config import Config
+from patterns import getCompiledPatterns, _walkParsed
+from utils import applyCustomInputReplacements
+
+
+def _unwrapped(items):
+    """Yields the items of a parsed regex, replacing groups with their contents
+    """
+    for op, av in items:
+        if op == sre_constants.SUBPATTERN:
+            for x in _unwrapped(av[-1]):
+                yield x
+        else:
+            yield op, av
+
+
+def nestedRepeats(cpattern):
+    """Returns True if the pattern has an unbounded repeat whose body is made
+    only of other repeats, such as (\d+)* or (\w+\s*)+, which can backtrack
+    catastrophically. Repeats with a required separator, like ([-_]\d+)*,
+    are not reported
+    """
+    repeats = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+    parsed = sre_parse.parse(cpattern.pattern, re.VERBOSE)
+    for op, av in _walkParsed(parsed):
+        if op in repeats and av[1] >= sre_constants.MAXREPEAT:
+            body = list(_unwrapped(av[2]))
+            if len(body) > 0 and all(
+                    innerop in repeats and innerav[1] > 1 for innerop, innerav in body):
+                return True
+    return False
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _matchFilenames(patterns, filenames, start, skip, progress, conn):
+    """Runs in a worker process, matching every pattern against each of
+    filenames from index start, except the positions in skip for the first
+    filename. Sends (index, results) for each filename through conn, where
+    results has (seconds, matched) for each pattern, or None if skipped.
+    The index and pattern position being matched are kept in progress, for
+    the watchdog
+    """
+    compiled_patterns = getCompiledPatterns(patterns)
+    for index in range(start, len(filenames)):
+        progress[0] = index
+        results = []
+        for position, cpattern in enumerate(compiled_patterns):
+            if index == start and position in skip:
+                results.append(None)
+                continue
+
+            progress[1] = position
+            begin = default_timer()
+            match = cpattern.regex.match(filenames[index])
+            results.append((default_timer() - begin, match is not None))
+        conn.send((index, results))
+    conn.close()
+
+
+class PatternAnalysis(object):
+    """Runs every pattern against every filename in a corpus, timing each
+    match, and records which pattern each filename ends up being parsed
+    with (the first to match).
+
+    Matching is done in a worker process, as a regex cannot be interrupted.
+    If one match takes longer than match_timeout seconds, the worker is
+    stopped, the pattern is recorded as timing out on that filename, and a
+    new worker carries on with the remaining patterns and filenames
+    """
+
+    def __init__(self, filenames, patterns = None, match_timeout = None):
+        self.filenames = filenames
+        self.compiled_patterns = getCompiledPatterns(patterns)
+        if match_timeout is None:
+            match_timeout = Config['analyze_match_timeout']
+        self.match_timeout = match_timeout
+
+        # Per pattern: match times, number of matches, slowest filename
+        self.times = [array.array('d') for x in self.compiled_patterns]
+        self.matches = [0] * len(self.compiled_patterns)
+        self.slowest = [(0.0, None)] * len(self.compiled_patterns)
+
+        # Index of the pattern used for each filename, or None
+        self.assigned = []
+
+        # (CompiledPattern, filename) of each match which timed out
+        self.timeouts = []
+
+    def _record(self, index, results):
+        """Records the results of one filename sent by _matchFilenames.
+        Timed out matches are already None in results
+        """
+        filename = self.filenames[index]
+        assigned = None
+        for position, result in enumerate(results):
+            if result is None:
+                elapsed, matched = self.match_timeout, False
+            else:
+                elapsed, matched = result
+
+            self.times[position].append(elapsed)
+            if elapsed > self.slowest[position][0]:
+                self.slowest[position] = (elapsed, filename)
+
+            if matched:
+                self.matches[position] += 1
+                if assigned is None:
+                    assigned = position
+
+        self.assigned.append(assigned)
+
+    def _runWorker(self, replaced, start, skip):
+        """Matches the filenames from index start in a worker process.
+        Returns None once all are done, or the (index, position) of a match
+        which timed out
+        """
+        patterns = [cpattern.pattern for cpattern in self.compiled_patterns]
+        progress = multiprocessing.Array('i', [start, -1], lock = False)
+        reader, writer = multiprocessing.Pipe(False)
+        worker = multiprocessing.Process(target = _matchFilenames,
+            args = (patterns, replaced, start, skip, progress, writer))
+        worker.daemon = True
+        worker.start()
+        writer.close()
+
+        done = start
+        current, since = None, default_timer()
+        try:
+            while done < len(replaced):
+                if reader.poll(min(0.1, self.match_timeout / 10.0)):
+                    index, results = reader.recv()
+                    self._record(index, results)
+                    done = index + 1
+                    continue
+
+                if not worker.is_alive() and not reader.poll():
+                    raise RuntimeError("Pattern analysis stopped unexpectedly (exit code %s)" % (
+                        worker.exitcode))
+
+                now = default_timer()
+                if (progress[0], progress[1]) != current:
+                    current, since = (progress[0], progress[1]), now
+                elif now - since > self.match_timeout and current[0] == done:
+                    return current
+            return None
+        finally:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+            reader.close()
+
+    def run(self):
+        replaced = [applyCustomInputReplacements(x) for x in self.filenames]
+
+        start, skip = 0, set()
+        while start < len(replaced):
+            timedout = self._runWorker(replaced, start, skip)
+            if timedout is None:
+                break
+
+            # Match the filename again, without the patterns which timed out
+            index, position = timedout
+            if index != start:
+                start, skip = index, set()
+            skip.add(position)
+            self.timeouts.append((self.compiled_patterns[position], self.filenames[index]))
+
+    def slow(self, threshold):
+        """Returns list of (CompiledPattern, seconds, filename) for patterns
+        which took longer than threshold seconds on any filename
+        """
+        return [(cpattern, self.slowest[position][0], self.slowest[position][1])
+            for position, cpattern in enumerate(self.compiled_patterns)
+            if self.slowest[position][0] > threshold]
+
+    def report(self, threshold, show_filenames = False):
+        """Displays the results of run()
+        """
+        total = len(self.filenames)
+        used = [0] * len(self.compiled_patterns)
+        for assigned in self.assigned:
+            if assigned is not None:
+                used[assigned] += 1
+
+        p("# Analysed %d patterns against %d filenames" % (len(self.compiled_patterns), total))
+        p("%5s %8s %8s %10s %10s %10s  %s" % (
+            "#", "matches", "used", "mean (us)", "p99 (us)", "max (us)", "pattern"))
+
+        for position, cpattern in enumerate(self.compiled_patterns):
+            times = self.times[position]
+            if len(times) > 0:
+                mean = 1000000.0 * sum(times) / len(times)
+                p99 = 1000000.0 * _percentile(times, 0.99)
+            else:
+                mean = p99 = 0.0
+
+            summary = [x.strip() for x in cpattern.pattern.splitlines() if x.strip()][0]
+            p("%5d %7.1f%% %8d %10.2f %10.2f %10.2f  %s" % (
+                cpattern.index,
+                100.0 * self.matches[position] / max(total, 1),
+                used[position],
+                mean,
+                p99,
+                1000000.0 * self.slowest[position][0],
+                summary))
+
+        unmatched = len([x for x in self.assigned if x is None])
+        p("# %d filenames matched no pattern" % unmatched)
+
+        never = [cpattern.index for position, cpattern in enumerate(self.compiled_patterns)
+            if used[position] == 0]
+        if never:
+            p("# Patterns never used (earlier patterns always matched first, or nothing matched): %s" % (
+                ", ".join(str(x) for x in never)))
+
+        nested = [cpattern.index for cpattern in self.compiled_patterns if nestedRepeats(cpattern)]
+        if nested:
+            p("# Patterns with nested repeats, which can backtrack catastrophically: %s" % (
+                ", ".join(str(x) for x in nested)))
+
+        for cpattern, elapsed, filename in self.slow(threshold):
+            if (cpattern, filename) in self.timeouts:
+                continue
+            p("# Pattern %d took %.1fms on: %s" % (cpattern.index, elapsed * 1000, filename))
+
+        for cpattern, filename in self.timeouts:
+            p("# Pattern %d timed out after %.1fs, backtracking catastrophically, on: %s" % (
+                cpattern.index, self.match_timeout, filename))
+
+        if show_filenames:
+            p("# Pattern used for each filename:")
+            for filename, assigned in zip(self.filenames, self.assigned):
+                if assigned is None:
+                    p("-\t%s" % filename)
+                else:
+                    p("%d\t%s" % (self.compiled_patterns[assigned].index, filename))
+
+
+def readCorpus(path):
+    """Reads a corpus file, containing one filename (or path) per line
+    """
+    filenames = []
+    for line in open(path):
+        line = line.decode("utf-8").rstrip("\r\n")
+        if line.strip():
+            filenames.append(os.path.split(line)[1])
+    return filenames
+
+
+def analysePatterns(corpus_path):
+    """Analyses the configured patterns against the filenames in the corpus
+    file, displays the report. Filenames are listed with the pattern used
+    for them in verbose mode.
+    """
+    analysis = PatternAnalysis(readCorpus(corpus_path))
+    analysis.run()
+    analysis.report(
+        threshold = Config['analyze_slow_threshold'],
+        show_filenames = Config['verbose'])
+    return analysis
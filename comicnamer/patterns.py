@@ -0,0 +1,1050 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#author:Samus
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Compiled filename pattern registry
+
+Each pattern in Config['filename_patterns'] is compiled once per process
+(per distinct list of patterns), along with an extraction plan describing
+which named groups hold the issue number(s), so FileParser does not need to
+recompile or re-inspect patterns for every file.
+"""
+
+import os
+import re
+import sys
+import time
+import bisect
+import hashlib
+import datetime
+import sre_parse
+import sre_constants
+
+import simplejson as json
+
+from unicode_helper import p
+
+from config import Config
+from comicnamer_exceptions import ConfigValueError
+
+
+# Kinds of extraction plan, see CompiledPattern
+PLAN_MULTI = 'multi'
+PLAN_RANGE = 'range'
+PLAN_SINGLE = 'single'
+PLAN_DATE = 'date'
+
+
+class CompiledPattern(object):
+    """A compiled filename pattern, and the plan used to extract the volume
+    name and issue numbers from a match.
+
+    The plan is one of PLAN_MULTI (issuenumber1, issuenumber2 etc), PLAN_RANGE
+    (issuenumberstart and issuenumberend), PLAN_SINGLE (issuenumber) or
+    PLAN_DATE (year, month and day). If the pattern has no usable groups, the
+    error is stored and raised as ConfigValueError when the pattern matches,
+    as a broken pattern that never matches should not prevent parsing.
+    """
+
+    def __init__(self, index, pattern):
+        self.index = index
+        self.pattern = pattern
+        self.regex = re.compile(pattern, re.VERBOSE)
+
+        self.groupnames = sorted(self.regex.groupindex.keys())
+        self.kind = None
+        self.issuegroups = []
+        self.error = None
+        self._makePlan()
+
+    def _makePlan(self):
+        """Works out which groups hold issue numbers, sets self.kind
+        """
+        namedgroups = self.groupnames
+
+        if 'issuenumber1' in namedgroups:
+            self.kind = PLAN_MULTI
+            self.issuegroups = [x for x in namedgroups
+                if re.match('issuenumber(\d+)', x)]
+
+        elif 'issuenumberstart' in namedgroups:
+            self.kind = PLAN_RANGE
+            self.issuegroups = ['issuenumberstart', 'issuenumberend']
+
+        elif 'issuenumber' in namedgroups:
+            self.kind = PLAN_SINGLE
+            self.issuegroups = ['issuenumber']
+
+        elif 'year' in namedgroups or 'month' in namedgroups or 'day' in namedgroups:
+            if not all(['year' in namedgroups, 'month' in namedgroups, 'day' in namedgroups]):
+                self.error = "Date-based regex must contain groups 'year', 'month' and 'day'"
+            else:
+                self.kind = PLAN_DATE
+                self.issuegroups = ['year', 'month', 'day']
+
+        else:
+            self.error = (
+                "Regex does not contain issue number group, should"
+                "contain issuenumber, issuenumber1-9, or"
+                "issuenumberstart and issuenumberend\n\nPattern"
+                "was:\n" + self.pattern)
+
+        if self.error is None and 'volumename' not in namedgroups:
+            self.error = "Regex must contain volumename. Pattern was:\n" + self.pattern
+
+    def extract(self, groups):
+        """Takes a dict of named group values (as from match.groupdict()),
+        returns a tuple of (volumename, issuenumbers) following the plan.
+        The volume name is returned as matched, without cleaning.
+        """
+        if self.error is not None:
+            raise ConfigValueError(self.error)
+
+        if self.kind == PLAN_MULTI:
+            # Multiple issues, have issuenumber1 or 2 etc
+            issuenumbers = sorted(int(groups[x]) for x in self.issuegroups
+                if groups[x] is not None)
+
+        elif self.kind == PLAN_RANGE:
+            # Multiple issues, regex specifies start and end number
+            start = int(groups['issuenumberstart'])
+            end = int(groups['issuenumberend'])
+            if start > end:
+                # Swap start and end
+                start, end = end, start
+            issuenumbers = range(start, end + 1)
+
+        elif self.kind == PLAN_SINGLE:
+            issuenumbers = [int(groups['issuenumber']), ]
+
+        else:
+            issuenumbers = [datetime.date(int(groups['year']),
+                                          int(groups['month']),
+                                          int(groups['day']))]
+
+        return groups['volumename'], issuenumbers
+
+    def __repr__(self):
+        return "<%s: %d (%s)>" % (
+            self.__class__.__name__,
+            self.index,
+            self.kind)
+
+
+# Compiled patterns, keyed by the tuple of pattern strings they were built from
+_registry = {}
+
+
+def getCompiledPatterns(patterns = None):
+    """Returns a list of CompiledPattern instances for the supplied list of
+    patterns (Config['filename_patterns'] by default). Each distinct list of
+    patterns is only compiled once per process.
+
+    Invalid patterns are warned about and skipped.
+    """
+    if patterns is None:
+        patterns = Config['filename_patterns']
+
+    key = tuple(patterns)
+    if key in _registry:
+        return _registry[key]
+
+    compiled = []
+    for index, cpattern in enumerate(patterns):
+        try:
+            compiled.append(CompiledPattern(index, cpattern))
+        except re.error, errormsg:
+            p("WARNING: Invalid issue_pattern, %s. %s" % (
+                errormsg, cpattern), file = sys.stderr)
+
+    _registry[key] = compiled
+    return compiled
+
+
+# Character class categories, as written in a regex
+_categories = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_NOT_SPACE: r'\S',
+    sre_constants.CATEGORY_WORD: r'\w',
+    sre_constants.CATEGORY_NOT_WORD: r'\W',
+}
+
+
+def _charSource(op, av):
+    """Returns regex source matching the single character described by a
+    parsed (op, av) item, or None if the item is not a single character
+    """
+    if op == sre_constants.LITERAL:
+        return re.escape(unichr(av))
+
+    elif op == sre_constants.NOT_LITERAL:
+        return "[^%s]" % re.escape(unichr(av))
+
+    elif op == sre_constants.IN:
+        parts = []
+        for cop, cav in av:
+            if cop == sre_constants.NEGATE:
+                parts.insert(0, "^")
+            elif cop == sre_constants.LITERAL:
+                parts.append(re.escape(unichr(cav)))
+            elif cop == sre_constants.RANGE:
+                parts.append("%s-%s" % (re.escape(unichr(cav[0])), re.escape(unichr(cav[1]))))
+            elif cop == sre_constants.CATEGORY and cav in _categories:
+                parts.append(_categories[cav])
+            else:
+                return None
+        return "[%s]" % "".join(parts)
+
+    return None
+
+
+def _findRuns(items, runs, current):
+    """Walks parsed regex items, collecting runs of consecutive characters
+    every match must contain. Each run is a list of regex source fragments.
+    Items which may be skipped or vary in width end the current run.
+    """
+    for op, av in items:
+        char = _charSource(op, av)
+        if char is not None:
+            current.append(char)
+            continue
+
+        if op == sre_constants.SUBPATTERN:
+            # Plain group, contents are part of the same sequence
+            _findRuns(av[-1], runs, current)
+            continue
+
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, body = av
+            if lo >= 1 and len(body) == 1 and _charSource(*body[0]) is not None:
+                if hi >= sre_constants.MAXREPEAT:
+                    current.append("%s{%d,}" % (_charSource(*body[0]), lo))
+                else:
+                    current.append("%s{%d,%d}" % (_charSource(*body[0]), lo, hi))
+                if lo != hi:
+                    # What follows is not at a fixed position
+                    _closeRun(runs, current)
+                continue
+            _closeRun(runs, current)
+            if lo >= 1:
+                # Body appears at least once, on its own
+                _findRuns(body, runs, current)
+                _closeRun(runs, current)
+            continue
+
+        if op == sre_constants.AT and av == sre_constants.AT_BEGINNING and len(runs) == 0 and len(current) == 0:
+            current.append("^")
+            continue
+
+        _closeRun(runs, current)
+
+
+def _closeRun(runs, current):
+    """Moves current run to runs if it is selective enough to be worth
+    searching for, then empties it
+    """
+    if len(current) >= 2:
+        runs.append("".join(current))
+    del current[:]
+
+
+def _positionSource(op, av):
+    """Returns regex source matching the single character described by a
+    parsed (op, av) item, including any character, or None
+    """
+    if op == sre_constants.ANY:
+        return "."
+    return _charSource(op, av)
+
+
+def _fixedChars(items, chars, reverse = False):
+    """Appends the regex source of each character at a fixed position from
+    the start of parsed regex items (or from the end, with reverse) to
+    chars. Returns False once an item of varying width is reached
+    """
+    if reverse:
+        items = reversed(list(items))
+
+    for op, av in items:
+        char = _positionSource(op, av)
+        if char is not None:
+            chars.append(char)
+
+        elif op == sre_constants.SUBPATTERN:
+            if not _fixedChars(av[-1], chars, reverse):
+                return False
+
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, body = av
+            if len(body) != 1 or _positionSource(*body[0]) is None:
+                return False
+            chars.extend([_positionSource(*body[0])] * lo)
+            if lo != hi:
+                return False
+
+        elif op == sre_constants.AT and av in (sre_constants.AT_BEGINNING,
+                sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END,
+                sre_constants.AT_END_STRING):
+            # Zero width, so positions carry on
+            continue
+
+        else:
+            return False
+
+    return True
+
+
+def _anchoredAtEnd(items):
+    """Returns True if parsed regex items must match up to the end of the
+    string (ignoring any trailing newline)
+    """
+    for op, av in reversed(list(items)):
+        if op == sre_constants.AT:
+            return av in (sre_constants.AT_END, sre_constants.AT_END_STRING)
+        if op == sre_constants.SUBPATTERN:
+            return _anchoredAtEnd(av[-1])
+        return False
+    return False
+
+
+class Prefilter(object):
+    """Cheap necessary condition for a pattern to match: the most selective
+    run of characters found in the parsed pattern (for example "[Ss][0-9]{1,}" for
+    the sNNeNN patterns). Patterns with identical runs share a Prefilter,
+    so a whole family of patterns is ruled out with one search.
+    """
+
+    def __init__(self, source, flags):
+        self.source = source
+        self.flags = flags
+        self.search = re.compile(source, flags).search
+
+
+def _analysePattern(cpattern, prefilters):
+    """Sets the prefilter and combinable attributes of a CompiledPattern.
+    prefilters is a dict of already created Prefilter instances, for sharing.
+
+    A pattern can only be combined into an alternation if it uses no
+    inline flags (which would apply to every branch), numbered back
+    references or conditional groups (which depend on group numbering).
+    """
+    parsed = sre_parse.parse(cpattern.pattern, re.VERBOSE)
+    flags = parsed.pattern.flags & ~re.VERBOSE
+    cpattern.flags = flags
+
+    # Characters at fixed positions from the start (patterns are always
+    # matched at the start of the filename) and, if the pattern is anchored
+    # there, from the end
+    cpattern.head = []
+    _fixedChars(parsed, cpattern.head)
+    cpattern.tail = []
+    if _anchoredAtEnd(parsed):
+        _fixedChars(parsed, cpattern.tail, reverse = True)
+
+    runs, current = [], []
+    _findRuns(parsed, runs, current)
+    _closeRun(runs, current)
+
+    if len(runs) == 0:
+        cpattern.prefilter = None
+    else:
+        # Runs anchored to the start of the filename are the most selective
+        key = (max(runs, key = lambda x: (x.startswith("^"), len(x))), flags)
+        if key not in prefilters:
+            prefilters[key] = Prefilter(*key)
+        cpattern.prefilter = prefilters[key]
+
+    cpattern.combinable = (
+        flags == 0 and
+        re.search(r"\\[1-9]", cpattern.pattern) is None and
+        "(?(" not in cpattern.pattern)
+
+
+def _analysePatterns(compiled_patterns):
+    """Analyses each pattern (see _analysePattern), returns the list of
+    distinct prefilters used
+    """
+    shared = {}
+    for cpattern in compiled_patterns:
+        _analysePattern(cpattern, shared)
+
+    prefilters = []
+    for cpattern in compiled_patterns:
+        if cpattern.prefilter is not None and cpattern.prefilter not in prefilters:
+            prefilters.append(cpattern.prefilter)
+    return prefilters
+
+
+def _overlapping(compiled_patterns):
+    """Returns, for each pattern, the list of positions of earlier patterns
+    which may match some of the same filenames. Other earlier patterns are
+    provably disjoint from it: at some fixed position from the start or
+    end, the characters they allow have nothing in common. Patterns must
+    have been analysed with _analysePatterns
+    """
+    # Characters which can be told apart: Latin-1, any other literals in
+    # the patterns, and one character standing for all the rest. Patterns
+    # where \w etc can match other characters are never proven disjoint
+    universe = set(unichr(x) for x in range(256))
+    for cpattern in compiled_patterns:
+        for op, av in _walkParsed(sre_parse.parse(cpattern.pattern, re.VERBOSE)):
+            if op == sre_constants.LITERAL and av > 255:
+                universe.add(unichr(av))
+    universe.add(u"\uffff")
+
+    charsets = {}
+
+    def charset(source, flags):
+        if (source, flags) not in charsets:
+            match = re.compile(source, flags).match
+            charsets[(source, flags)] = frozenset(x for x in universe if match(x))
+        return charsets[(source, flags)]
+
+    def disjoint(a, b):
+        if (a.flags | b.flags) & (re.UNICODE | re.LOCALE):
+            return False
+        for achars, bchars in ((a.head, b.head), (a.tail, b.tail)):
+            for asource, bsource in zip(achars, bchars):
+                if not charset(asource, a.flags) & charset(bsource, b.flags):
+                    return True
+        return False
+
+    overlapping = []
+    for position, cpattern in enumerate(compiled_patterns):
+        overlapping.append([earlier for earlier in range(position)
+            if not disjoint(compiled_patterns[earlier], cpattern)])
+    return overlapping
+
+
+class BaseMatcher(object):
+    """Base class for matchers. Subclasses implement match(filename), which
+    returns a tuple of (CompiledPattern, dict of named groups) for the
+    first pattern matching filename, or None
+    """
+
+    def matchMany(self, filenames):
+        """Matches a list of filenames, returns a list of match() results in
+        the same order
+        """
+        return [self.match(x) for x in filenames]
+
+
+class SequentialMatcher(BaseMatcher):
+    """Tries each pattern in order, the first to match wins. This is the
+    reference behaviour other matchers must reproduce.
+    """
+
+    def __init__(self, compiled_patterns):
+        self.compiled_patterns = compiled_patterns
+
+    def match(self, filename):
+        """Returns a tuple of (CompiledPattern, dict of named groups) for the
+        first pattern matching filename, or None
+        """
+        for cpattern in self.compiled_patterns:
+            match = cpattern.regex.match(filename)
+            if match:
+                return cpattern, match.groupdict()
+        return None
+
+
+def _walkParsed(items):
+    """Yields every (op, av) item in a parsed regex, including those nested
+    in groups, repeats and alternations
+    """
+    for op, av in items:
+        yield op, av
+        if op == sre_constants.SUBPATTERN:
+            for x in _walkParsed(av[-1]):
+                yield x
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            for x in _walkParsed(av[2]):
+                yield x
+        elif op == sre_constants.BRANCH:
+            for cbranch in av[1]:
+                for x in _walkParsed(cbranch):
+                    yield x
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            for x in _walkParsed(av[1]):
+                yield x
+        elif op == sre_constants.GROUPREF_EXISTS:
+            for cbranch in av[1:]:
+                if cbranch is not None:
+                    for x in _walkParsed(cbranch):
+                        yield x
+
+
+def _excludeNewlines(pattern):
+    """Rewrites a verbose pattern so negated character classes ([^/]) and
+    \\D, \\S and \\W do not match newlines. The result matches the same as
+    the original on any single line.
+    """
+    out = []
+    position = 0
+    inclass = False
+    while position < len(pattern):
+        char = pattern[position]
+
+        if char == "\\":
+            escape = pattern[position + 1:position + 2]
+            if not inclass and escape in ("D", "S", "W"):
+                out.append("[^\\n\\%s]" % escape.lower())
+            else:
+                out.append(char + escape)
+            position += 2
+            continue
+
+        if inclass:
+            if char == "]":
+                inclass = False
+            out.append(char)
+
+        elif char == "#":
+            # Comment, runs to end of line
+            end = pattern.find("\n", position)
+            if end == -1:
+                end = len(pattern)
+            out.append(pattern[position:end])
+            position = end
+            continue
+
+        elif char == "[":
+            inclass = True
+            if pattern[position + 1:position + 2] == "^":
+                out.append("[^\\n")
+                position += 1
+            else:
+                out.append(char)
+
+            # A ] straight after the opening [ or [^ is a literal
+            if pattern[position + 1:position + 2] == "]":
+                out.append("]")
+                position += 1
+
+        else:
+            out.append(char)
+
+        position += 1
+
+    return "".join(out)
+
+
+class BulkMatcher(SequentialMatcher):
+    """Matches many filenames at once: the filenames are joined into one
+    newline separated block, and each pattern, in order, is run over the
+    whole block with finditer, anchored to the newline before each line. Lines
+    matched by a pattern are removed from the block before the next pattern
+    is tried, so the first pattern to match each filename still wins. Each
+    prefilter is also run once over the whole block, and lines it rules out
+    are left out of the blocks for its patterns.
+
+    Negated character classes are rewritten to not match newlines. Any
+    other match which runs past the end of its line (e.g. through \\s) is
+    discarded, and that line and any lines it covered are matched
+    individually against the pattern. Patterns whose result could
+    depend on text beyond the line (lookarounds, \\A and \\Z) are always
+    matched individually, as are filenames containing newlines.
+
+    Single filenames are matched as SequentialMatcher does.
+    """
+
+    def __init__(self, compiled_patterns):
+        SequentialMatcher.__init__(self, compiled_patterns)
+        _analysePatterns(compiled_patterns)
+        self.bulkregexs = [self._bulkRegex(x) for x in compiled_patterns]
+
+    def _bulkRegex(self, cpattern):
+        """Returns the pattern compiled for matching at line starts in a
+        block, or None if it cannot safely be used on a block
+        """
+        unsafe = (sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+        unsafe_at = (sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END_STRING)
+
+        parsed = sre_parse.parse(cpattern.pattern, re.VERBOSE)
+        for op, av in _walkParsed(parsed):
+            if op in unsafe or (op == sre_constants.AT and av in unsafe_at):
+                return None
+
+        # Lines are found by their leading newline, as the regex engine can
+        # scan quickly for a literal prefix, but not for ^
+        return re.compile("\\n(?:\n%s\n)" % _excludeNewlines(cpattern.pattern),
+            re.VERBOSE | re.MULTILINE)
+
+    def _makeBlock(self, filenames, indexes):
+        """Joins the filenames at indexes into a block, with a newline before
+        each. Returns the block and the offset of each line's newline.
+        """
+        starts = []
+        offset = 0
+        for index in indexes:
+            starts.append(offset)
+            offset += len(filenames[index]) + 1
+        block = "\n" + "\n".join([filenames[x] for x in indexes])
+        return block, starts
+
+    def _passing(self, prefilter, filenames, indexes):
+        """Returns the set of indexes whose filename is not ruled out by
+        prefilter, found with a single scan over a block of them. A match
+        spanning several lines counts for each of them.
+        """
+        block, starts = self._makeBlock(filenames, indexes)
+        regex = re.compile(prefilter.source, prefilter.flags | re.MULTILINE)
+
+        passing = set()
+        for match in regex.finditer(block):
+            first = bisect.bisect_right(starts, match.start()) - 1
+            last = bisect.bisect_right(starts, max(match.start(), match.end() - 1)) - 1
+            passing.update(indexes[first:last + 1])
+        return passing
+
+    def _matchBlock(self, cpattern, bulkregex, filenames, indexes, results):
+        """Matches cpattern against the filenames at indexes, storing matches
+        in results. Returns the set of matched indexes.
+        """
+        matched = set()
+        recheck = indexes
+
+        if bulkregex is not None:
+            block, starts = self._makeBlock(filenames, indexes)
+            lines = dict(zip(starts, indexes))
+            recheck = set()
+
+            for match in bulkregex.finditer(block):
+                index = lines[match.start()]
+                if match.end() <= match.start() + 1 + len(filenames[index]):
+                    results[index] = (cpattern, match.groupdict())
+                    matched.add(index)
+                else:
+                    # Crossed into following lines, which were never tried
+                    first = bisect.bisect_left(starts, match.start())
+                    last = bisect.bisect_left(starts, match.end())
+                    recheck.update(indexes[first:last])
+
+        for index in recheck:
+            match = cpattern.regex.match(filenames[index])
+            if match:
+                results[index] = (cpattern, match.groupdict())
+                matched.add(index)
+
+        return matched
+
+    def matchMany(self, filenames):
+        """Matches a list of filenames, returns a list of match() results in
+        the same order
+        """
+        results = [None] * len(filenames)
+
+        pending = []
+        for index, filename in enumerate(filenames):
+            if "\n" in filename:
+                results[index] = self.match(filename)
+            else:
+                pending.append(index)
+
+        everything = pending
+        passing = {}
+        for cpattern, bulkregex in zip(self.compiled_patterns, self.bulkregexs):
+            if len(pending) == 0:
+                break
+
+            candidates = pending
+            cfilter = cpattern.prefilter
+            if cfilter is not None:
+                if cfilter not in passing:
+                    passing[cfilter] = self._passing(cfilter, filenames, everything)
+                candidates = [x for x in pending if x in passing[cfilter]]
+
+            if len(candidates) == 0:
+                continue
+
+            matched = self._matchBlock(cpattern, bulkregex, filenames, candidates, results)
+            if matched:
+                pending = [x for x in pending if x not in matched]
+
+        return results
+
+
+class CombinedMatcher(BaseMatcher):
+    """Evaluates the whole ordered pattern set in one pass.
+
+    Each distinct prefilter is checked once, dropping the patterns it rules
+    out, then consecutive remaining patterns are joined into one
+    alternation. Each branch is wrapped in its own named group, with the
+    pattern's group names prefixed, so the winning branch and its groups can
+    be recovered. As alternation branches are tried in order, the first
+    pattern to match still wins.
+
+    The match plan for each combination of prefilter results is built on
+    first use and cached.
+    """
+
+    # Python's re module limits the number of groups in a single regex
+    max_groups = 99
+
+    def __init__(self, compiled_patterns):
+        self.compiled_patterns = compiled_patterns
+
+        self.prefilters = _analysePatterns(compiled_patterns)
+
+        self._plans = {}
+        self._combined = {}
+
+    def _segments(self, candidates):
+        """Splits candidates into runs of combinable patterns small enough to
+        be compiled as one regex. Non-combinable patterns are returned on
+        their own.
+        """
+        segment = []
+        groups = 0
+        for cpattern in candidates:
+            if not cpattern.combinable:
+                if segment:
+                    yield segment
+                    segment, groups = [], 0
+                yield [cpattern]
+                continue
+
+            if groups + cpattern.regex.groups + 1 > self.max_groups:
+                yield segment
+                segment, groups = [], 0
+            segment.append(cpattern)
+            groups += cpattern.regex.groups + 1
+
+        if segment:
+            yield segment
+
+    def _getCombined(self, segment):
+        """Returns (regex, {group index: (CompiledPattern, group mapping)})
+        for the alternation of the patterns in segment
+        """
+        key = tuple(x.index for x in segment)
+        if key in self._combined:
+            return self._combined[key]
+
+        branches = []
+        for cpattern in segment:
+            prefix = "_b%d_" % cpattern.index
+            source = re.sub(r"\(\?P<(\w+)>", r"(?P<%s\1>" % prefix, cpattern.pattern)
+            source = re.sub(r"\(\?P=(\w+)\)", r"(?P=%s\1)" % prefix, source)
+            branches.append("(?P<_b%d>\n%s\n)" % (cpattern.index, source))
+
+        regex = re.compile("|".join(branches), re.VERBOSE)
+
+        branchmap = {}
+        for cpattern in segment:
+            prefix = "_b%d_" % cpattern.index
+            groupmap = [(x, prefix + x) for x in cpattern.groupnames]
+            branchmap[regex.groupindex["_b%d" % cpattern.index]] = (cpattern, groupmap)
+
+        self._combined[key] = (regex, branchmap)
+        return regex, branchmap
+
+    def _getPlan(self, outcome):
+        """Returns the list of (regex, branchmap) steps to try for a tuple of
+        prefilter results. For a lone pattern, branchmap is the
+        CompiledPattern itself.
+        """
+        if outcome in self._plans:
+            return self._plans[outcome]
+
+        passed = dict(zip(self.prefilters, outcome))
+        candidates = [x for x in self.compiled_patterns
+            if x.prefilter is None or passed[x.prefilter]]
+
+        plan = []
+        for segment in self._segments(candidates):
+            if len(segment) == 1:
+                plan.append((segment[0].regex, segment[0]))
+            else:
+                plan.append(self._getCombined(segment))
+
+        self._plans[outcome] = plan
+        return plan
+
+    def match(self, filename):
+        """Returns a tuple of (CompiledPattern, dict of named groups) for the
+        first pattern matching filename, or None
+        """
+        outcome = tuple([x.search(filename) is not None for x in self.prefilters])
+
+        for regex, branchmap in self._getPlan(outcome):
+            match = regex.match(filename)
+            if match is None:
+                continue
+
+            if isinstance(branchmap, CompiledPattern):
+                return branchmap, match.groupdict()
+
+            # The outermost group closes last, so lastindex is the branch
+            cpattern, groupmap = branchmap[match.lastindex]
+            return cpattern, dict((x, match.group(y)) for x, y in groupmap)
+
+        return None
+
+
+class PatternStats(object):
+    """Per-pattern statistics, persisted between runs as JSON. For each
+    pattern this stores:
+
+    - attempts: number of times the pattern was tried
+    - hits: number of times the pattern was the one used for a filename
+    - timed: number of attempts which were timed
+    - time: total seconds spent on the timed attempts
+
+    Patterns are keyed by a hash of their text, so statistics for a pattern
+    survive it being moved within the list, and are ignored once it is
+    changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}
+        self.dirty = False
+
+        if os.path.isfile(path):
+            try:
+                self.stats = json.load(open(path))
+            except ValueError, errormsg:
+                p("WARNING: Ignoring invalid pattern statistics in %s: %s" % (
+                    path, errormsg), file = sys.stderr)
+
+    @staticmethod
+    def key(cpattern):
+        return hashlib.md5(cpattern.pattern.encode("utf-8")).hexdigest()
+
+    def get(self, cpattern):
+        """Returns the statistics dict for a pattern
+        """
+        cur = {'attempts': 0, 'hits': 0, 'timed': 0, 'time': 0.0}
+        cur.update(self.stats.get(self.key(cpattern), {}))
+        return cur
+
+    def add(self, cpattern, attempts = 0, hits = 0, timed = 0, elapsed = 0.0):
+        """Adds to the statistics for a pattern
+        """
+        cur = self.get(cpattern)
+        cur['attempts'] += attempts
+        cur['hits'] += hits
+        cur['timed'] += timed
+        cur['time'] += elapsed
+        self.stats[self.key(cpattern)] = cur
+        self.dirty = True
+
+    def save(self):
+        json.dump(self.stats, open(self.path, "w+"), sort_keys = True, indent = 4)
+        self.dirty = False
+
+
+# PatternStats instances, keyed by file path
+_stats = {}
+
+
+def getPatternStats(path = None):
+    """Returns the PatternStats for path (Config['pattern_stats_file'] by
+    default), loading it on first use
+    """
+    if path is None:
+        path = Config['pattern_stats_file']
+    path = os.path.expanduser(path)
+
+    if path not in _stats:
+        _stats[path] = PatternStats(path)
+    return _stats[path]
+
+
+def savePatternStats():
+    """Writes statistics collected by adaptive matchers to disc
+    """
+    for cmatcher in _matchers.values():
+        if isinstance(cmatcher, AdaptiveMatcher):
+            cmatcher.flush()
+
+    for cstats in _stats.values():
+        if cstats.dirty:
+            cstats.save()
+
+
+def printPatternStats(patterns = None):
+    """Displays the recorded statistics for each configured pattern
+    """
+    cstats = getPatternStats()
+
+    p("Pattern statistics from %s" % cstats.path)
+    p("%5s %10s %10s %8s %10s  %s" % ("#", "hits", "attempts", "rate", "mean (us)", "pattern"))
+    for cpattern in getCompiledPatterns(patterns):
+        cur = cstats.get(cpattern)
+        rate, mean = "-", "-"
+        if cur['attempts'] > 0:
+            rate = "%.1f%%" % (100.0 * cur['hits'] / cur['attempts'])
+        if cur['timed'] > 0:
+            mean = "%.2f" % (1000000.0 * cur['time'] / cur['timed'])
+
+        # First non-blank line of the pattern, as a reminder of which it is
+        summary = [x.strip() for x in cpattern.pattern.splitlines() if x.strip()][0]
+        p("%5d %10d %10d %8s %10s  %s" % (
+            cpattern.index, cur['hits'], cur['attempts'], rate, mean, summary))
+
+
+class AdaptiveMatcher(BaseMatcher):
+    """Tries the historically hottest and cheapest patterns first, while
+    still returning the same pattern as SequentialMatcher.
+
+    Patterns are ordered by hits per second spent trying them (patterns
+    without statistics go last, in config order). When a pattern matches,
+    the patterns before it in config order which could also match are tried
+    in order, and the first of those to match is used instead. Patterns
+    which already failed, are ruled out by their prefilter, or are provably
+    disjoint from the matching pattern (see _overlapping) are not tried
+    again. The order is recalculated as statistics accumulate.
+
+    Counts are kept in memory and added to the PatternStats by flush(). Only
+    one in every time_every filenames is timed, to keep overhead down.
+    """
+
+    # Number of filenames between recalculating the order
+    reorder_every = 500
+
+    # Time the attempts for one in this many filenames
+    time_every = 16
+
+    def __init__(self, compiled_patterns, stats = None):
+        self.compiled_patterns = compiled_patterns
+        _analysePatterns(compiled_patterns)
+        self._overlapping = _overlapping(compiled_patterns)
+
+        if stats is None:
+            stats = getPatternStats()
+        self.stats = stats
+
+        self._resetCounters()
+        self._seen = 0
+        self._reorder()
+
+    def _resetCounters(self):
+        count = len(self.compiled_patterns)
+        self._attempts = [0] * count
+        self._hits = [0] * count
+        self._timed = [0] * count
+        self._time = [0.0] * count
+
+    def flush(self):
+        """Adds the counts collected since the last flush to self.stats
+        """
+        for position, cpattern in enumerate(self.compiled_patterns):
+            if self._attempts[position] > 0:
+                self.stats.add(cpattern,
+                    attempts = self._attempts[position],
+                    hits = self._hits[position],
+                    timed = self._timed[position],
+                    elapsed = self._time[position])
+        self._resetCounters()
+
+    def _reorder(self):
+        self.flush()
+
+        def score(position):
+            cur = self.stats.get(self.compiled_patterns[position])
+            if cur['hits'] == 0:
+                return 0
+            # Mean cost per attempt, scaled up to all attempts
+            cost = cur['time'] / max(cur['timed'], 1) * cur['attempts']
+            return cur['hits'] / max(cost, 1e-9)
+
+        # sorted is stable, so ties keep config order
+        self.order = sorted(range(len(self.compiled_patterns)), key = score, reverse = True)
+
+    def match(self, filename):
+        """Returns a tuple of (CompiledPattern, dict of named groups) for the
+        first pattern matching filename, or None
+        """
+        self._seen += 1
+        if self._seen % self.reorder_every == 0:
+            self._reorder()
+        timing = self._seen % self.time_every == 0
+
+        compiled = self.compiled_patterns
+        checked = {}
+        failed = set()
+
+        def attempt(position):
+            cfilter = compiled[position].prefilter
+            if cfilter is not None:
+                if cfilter not in checked:
+                    checked[cfilter] = cfilter.search(filename) is not None
+                if not checked[cfilter]:
+                    return None
+
+            self._attempts[position] += 1
+            if timing:
+                start = time.time()
+                match = compiled[position].regex.match(filename)
+                self._timed[position] += 1
+                self._time[position] += time.time() - start
+            else:
+                match = compiled[position].regex.match(filename)
+
+            if match is None:
+                failed.add(position)
+            return match
+
+        for position in self.order:
+            match = attempt(position)
+            if match is None:
+                continue
+
+            # Fall back to ordered evaluation for any earlier pattern which
+            # could also match
+            if filename.endswith("\n"):
+                # $ also matches before a final newline, so the characters
+                # at the end are not at fixed positions
+                earliers = range(position)
+            else:
+                earliers = self._overlapping[position]
+            for earlier in earliers:
+                if earlier not in failed:
+                    earliermatch = attempt(earlier)
+                    if earliermatch is not None:
+                        position, match = earlier, earliermatch
+                        break
+
+            self._hits[position] += 1
+            return compiled[position], match.groupdict()
+
+        return None
+
+
+# Available matchers, selected with Config['filename_matcher']
+matchers = {
+    'sequential': SequentialMatcher,
+    'combined': CombinedMatcher,
+    'adaptive': AdaptiveMatcher,
+    'bulk': BulkMatcher,
+}
+
+# Matcher instances, keyed by matcher name and pattern list
+_matchers = {}
+
+
+def getMatcher(name = None, patterns = None):
+    """Returns the named matcher (Config['filename_matcher'] by default) for
+    the supplied patterns (Config['filename_patterns'] by default). Like the
+    compiled patterns, matchers are built once per process.
+    """
+    if name is None:
+        name = Config['filename_matcher']
+    if patterns is None:
+        patterns = Config['filename_patterns']
+
+    if name not in matchers:
+        raise ConfigValueError("Unknown filename_matcher %r, should be one of: %s" % (
+            name, ", ".join(sorted(matchers.keys()))))
+
+    key = (name, tuple(patterns))
+    if key not in _matchers:
+        _matchers[key] = matchers[name](getCompiledPatterns(patterns))
+    return _matchers[key]
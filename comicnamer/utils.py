@@ -10,23 +10,33 @@
 Modified from http://github.com/dbr/tvnamer
 """
 
-import datetime
 import os
 import re
 import sys
+import Queue
 import shutil
 import logging
+import fnmatch
 import platform
+import threading
+from multiprocessing.pool import ThreadPool
 
-from comicvine_api import (comicvine_error, comicvine_volumenotfound,
-comicvine_issuenotfound, comicvine_attributenotfound, comicvine_userabort)
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from unicode_helper import p
 
 from config import Config
+from patterns import getMatcher
+from comicinfo import readComicInfo
+from lookup import Backend, ComicvineBackend, waitInterruptibly
 from comicnamer_exceptions import (InvalidPath, InvalidFilename,
-volumeNotFound, DataRetrievalError, IssueNotFound,
-IssueNameNotFound, ConfigValueError, UserAbort)
+volumeNotFound, IssueNotFound, IssueNameNotFound, ConfigValueError)
 
 
 def log():
@@ -41,45 +51,39 @@ def warn(text):
     p(text, file = sys.stderr)
 
 
-def getIssueName(comicvine_instance, issue):
-    """Queries the comicvine_api.Comicvine instance for issue name and corrected
-    volume name.
+def getIssueName(lookup, issue):
+    """Queries lookup (a lookup.Backend, or a comicvine_api.Comicvine
+    instance) for issue name and corrected volume name.
     If volume cannot be found, it will warn the user. If the issue is not
     found, it will use the corrected volume name and not set an issue name.
     If the site is unreachable, it will warn the user. If the user aborts
-    it will catch comicvine_api's user abort error and raise comicnamer's
+    it will catch comicvine_api's user abort error and raise comicnamer's.
+    IssueNotFound and IssueNameNotFound errors have the corrected volume
+    name as their volumename attribute.
     """
-    try:
-        volume = comicvine_instance[issue.volumename]
-    except comicvine_error, errormsg:
-        raise DataRetrievalError("Error contacting www.comicvine.com: %s" % errormsg)
-    except comicvine_volumenotfound:
-        # No such volume found.
-        raise volumeNotFound("volume %s not found on www.comicvine.com" % issue.volumename)
-    except comicvine_userabort, error:
-        raise UserAbort(unicode(error))
-    else:
-        # volume was found, use corrected volume name
-        correctedvolumeName = volume['volumename']
+    if not isinstance(lookup, Backend):
+        lookup = ComicvineBackend(lookup)
+
+    info = issue.comicinfo
+    if (Config['comicinfo_mode'] == 'trust' and info is not None and
+            info.title is not None and issue.issuenumbers == [info.number]):
+        # Named by the file's ComicInfo.xml
+        return info.series, [info.title]
+
+    if issue.volumename is None:
+        raise volumeNotFound("No volume name in filename %s" % issue.fullfilename)
+
+    volume = lookup.findVolume(issue.volumename)
 
     issnames = []
     for cissno in issue.issuenumbers:
         try:
-            issueinfo = volume[cissno]
-
-        except comicvine_issuenotfound:
-            raise IssueNotFound(
-                "Issue %s of volume %s could not be found" % (
-                    cissno,
-                    issue.volumename))
+            issnames.append(lookup.getIssueName(volume, cissno))
+        except (IssueNotFound, IssueNameNotFound), errormsg:
+            errormsg.volumename = volume.volumename
+            raise
 
-        except comicvine_attributenotfound:
-            raise IssueNameNotFound(
-                "Could not find issue name for %s" % issue)
-        else:
-            issnames.append(issueinfo['issuename'])
-
-    return correctedvolumeName, issnames
+    return volume.volumename, issnames
 
 
 def _applyReplacements(cfile, replacements):
@@ -137,6 +141,120 @@ def cleanRegexedvolumeName(volumename):
     return volumename.strip()
 
 
+# Leading tags such as [group], then the title, which runs up to the next tag
+_filename_title = re.compile(r"""
+    ^(?:[\s._\-]*(?:\[[^\]]*\]|\([^)]*\)|\{[^}]*\}))*   # [group] (etc)
+    [\s._\-]*
+    (?P<title>[^\[({]*)                                # up to next tag
+    """, re.VERBOSE | re.UNICODE)
+
+# Separators between title words. Hyphens between digits are kept, as they
+# form ranges such as 01-04
+_title_separators = re.compile(r"[\s._]+|(?<!\d)-+|-+(?!\d)", re.UNICODE)
+
+_number_word = re.compile(r"\d+$")
+_range_word = re.compile(r"(\d+)-(\d+)$")
+_hash_word = re.compile(r"\#(\d+)$")
+
+# Season/episode style words (s01, s01e02, 1x02), left to the regex patterns
+_season_word = re.compile(r"([sS]\d+([eE]\d+)*|\d+([xX]\d+)+)$")
+
+# Words which mean the following number is not an issue number
+_not_issue_prefixes = ['v', 'vol', 'volume']
+
+
+def tokenizeFilename(name):
+    """Splits a filename (without extension) into its title, the text
+    between any leading tags (such as a group name) and the next tag, and
+    the list of words in the title.
+
+    >>> tokenizeFilename("[Group] X-Men #42 (2011) (digital)")
+    ('X-Men #42 ', ['X', 'Men', '#42'])
+    """
+    title = _filename_title.match(name).group('title')
+    words = [x for x in _title_separators.split(title) if x]
+
+    # "# 42" is the same as "#42"
+    while '#' in words[:-1]:
+        position = words.index('#')
+        words[position:position + 2] = ['#' + words[position + 1]]
+
+    return title, words
+
+
+def _isNumeric(word):
+    return (_number_word.match(word) is not None or
+        _range_word.match(word) is not None or
+        _hash_word.match(word) is not None)
+
+
+def parseFilenameTokens(filename):
+    """Parses a comic filename such as "Batman 042 (2011) (digital).cbz" by
+    classifying the words of its title (see tokenizeFilename). The issue
+    number is the last word (a number, #number or range, optionally
+    followed by "of NN"), and everything before it is the volume name.
+
+    Returns a tuple of (volumename, issuenumbers), with the volume name not
+    yet cleaned, or None when the filename cannot be classified confidently
+    (for example a bare number that could be a year, two numbers in a row
+    as in a date, or season/episode numbering such as s01e02), so the
+    caller can fall back to the regex patterns.
+
+    >>> parseFilenameTokens("Batman 042 (2011) (digital) (Group).cbz")
+    ('Batman', [42])
+    >>> parseFilenameTokens("[Group] X-Men 01-04 (1991).cbz")
+    ('X-Men', [1, 2, 3, 4])
+    >>> parseFilenameTokens("show.s01e23.cbr") is None
+    True
+    """
+    name, _ = os.path.splitext(filename)
+    title, words = tokenizeFilename(name)
+
+    # Watchmen 01 of 12
+    end = len(title)
+    if (len(words) >= 4 and words[-2].lower() == 'of' and
+        _number_word.match(words[-1]) and _isNumeric(words[-3])):
+        end = title.rfind(words[-2], 0, title.rfind(words[-1]))
+        words = words[:-2]
+
+    if len(words) < 2:
+        return None
+
+    issue = words[-1]
+    volume = words[:-1]
+
+    if _isNumeric(volume[-1]) or volume[-1].lower() in _not_issue_prefixes:
+        # Date, decimal issue number, or a volume number
+        return None
+    if any(_hash_word.match(x) for x in volume):
+        return None
+    if any(_season_word.match(x) for x in words):
+        return None
+
+    number = _number_word.match(issue)
+    hashed = _hash_word.match(issue)
+    ranged = _range_word.match(issue)
+    if number:
+        if len(issue) == 4 and 1900 <= int(issue) <= 2099:
+            # Could be a year
+            return None
+        issuenumbers = [int(issue)]
+    elif hashed:
+        issuenumbers = [int(hashed.group(1))]
+    elif ranged:
+        first, last = int(ranged.group(1)), int(ranged.group(2))
+        if first > last:
+            first, last = last, first
+        issuenumbers = range(first, last + 1)
+    else:
+        return None
+
+    # Issue numbers in the title are found by their digits, as "#42" may
+    # have been written "# 42"
+    volumename = title[:title.rfind(issue.lstrip("#"), 0, end)].rstrip(" ._-#")
+    return volumename, issuenumbers
+
+
 class FileFinder(object):
     """Given a file, it will verify it exists. Given a folder it will descend
     one level into it and return a list of files, unless the recursive argument
@@ -145,26 +263,61 @@ class FileFinder(object):
     The with_extension argument is a list of valid extensions, without leading
     spaces. If an empty list (or None) is supplied, no extension checking is
     performed.
+
+    When recursive, max_depth limits how many levels of subdirectories are
+    descended (None for no limit), and symlinks to directories are only
+    descended into if follow_symlinks is True. Each directory is listed
+    once, identified by its device and inode, so symlink loops such as
+    library/current -> library are harmless. With max_depth, a directory
+    first reached through a deeper path (such as a symlink) is listed again
+    if it is reached at a shallower depth, so its subdirectories are
+    descended as far as they would be otherwise, but its files are only
+    returned once.
+
+    exclude_dirs and exclude_files are lists of glob patterns, such as
+    '.git' or '*.jpg'. Matching directories are never listed, and matching
+    files are skipped. Patterns containing a / are matched against the full
+    path, others against the file or directory name.
+
+    When recursive, up to threads directories are listed at once, which
+    helps on high latency filesystems such as NFS. Where scandir is
+    available, files and directories are told apart using the directory
+    entries, rather than a stat() call per file.
     """
 
-    def __init__(self, path, with_extension = None, recursive = False):
+    def __init__(self, path, with_extension = None, recursive = False, threads = 1,
+                 max_depth = None, follow_symlinks = True, exclude_dirs = None,
+                 exclude_files = None):
         self.path = path
         if with_extension is None:
             self.with_extension = []
         else:
             self.with_extension = with_extension
         self.recursive = recursive
+        self.threads = threads
+        self.max_depth = max_depth
+        self.follow_symlinks = follow_symlinks
+        self.exclude_dirs = self._compileGlobs(exclude_dirs)
+        self.exclude_files = self._compileGlobs(exclude_files)
+
+        # Shallowest depth each directory was listed at, by (device, inode)
+        self._visited = {}
+        self._visited_lock = threading.Lock()
 
     def findFiles(self):
         """Returns list of files found at path
         """
+        return list(self.iterFiles())
+
+    def iterFiles(self):
+        """Yields files found at path, as each directory is listed
+        """
         if os.path.isfile(self.path):
             if self._checkExtension(self.path):
-                return [os.path.abspath(self.path)]
-            else:
-                return []
+                yield os.path.abspath(self.path)
         elif os.path.isdir(self.path):
-            return self._findFilesInPath(self.path)
+            for cfile in self._iterFilesInPath(self.path):
+                yield cfile
         else:
             raise InvalidPath("%s is not a valid file/directory" % self.path)
 
@@ -180,116 +333,294 @@ class FileFinder(object):
         else:
             return False
 
-    def _findFilesInPath(self, startpath):
-        """Finds files from startpath, could be called recursively
+    def _compileGlobs(self, globs):
+        """Compiles a list of glob patterns into a function taking
+        (name, path) and returning True if either matches any of the patterns
+        """
+        if not globs:
+            return lambda name, path: False
+
+        names = []
+        paths = []
+        for cglob in globs:
+            cglob = cglob.rstrip("/")
+            if "/" in cglob:
+                paths.append(fnmatch.translate(os.path.normcase(cglob)))
+            else:
+                names.append(fnmatch.translate(os.path.normcase(cglob)))
+
+        names = re.compile("|".join(names or ["(?!)"]))
+        paths = re.compile("|".join(paths or ["(?!)"]))
+
+        def excluded(name, path):
+            return (names.match(os.path.normcase(name)) is not None
+                or paths.match(os.path.normcase(path)) is not None)
+        return excluded
+
+    def _visit(self, path, depth):
+        """Records path as visited at depth. Returns None if the same
+        directory was already visited (under this or any other path), at
+        this depth or shallower, True if it was not visited before, and
+        False if it was visited deeper, so only its subdirectories need
+        listing again
+        """
+        stat = os.stat(path)
+        if stat.st_ino == 0:
+            # Inode numbers are not available on this platform
+            return True
+
+        key = (stat.st_dev, stat.st_ino)
+        self._visited_lock.acquire()
+        try:
+            if key not in self._visited:
+                self._visited[key] = depth
+                return True
+            if self.max_depth is not None and depth < self._visited[key]:
+                self._visited[key] = depth
+                return False
+            return None
+        finally:
+            self._visited_lock.release()
+
+    def _listDir(self, path, depth):
+        """Lists a single directory, returns (depth, files, subdirectories,
+        pruned, error) where pruned is the number of excluded (directories,
+        files), and error is the exception raised while listing it, or None.
+        Errors are returned rather than raised, as an exception raised in a
+        worker thread would never reach _iterFilesInPath
         """
-        allfiles = []
-        for subf in os.listdir(unicode(startpath)):
-            if not self._checkExtension(subf):
-                continue
-            newpath = os.path.join(startpath, subf)
-            newpath = os.path.abspath(newpath)
-            if os.path.isfile(newpath):
-                allfiles.append(newpath)
+        files = []
+        subdirs = []
+        pruned = [0, 0]
+        try:
+            first = self._visit(path, depth)
+            if first is None:
+                log().debug("Skipping already visited directory %s" % path)
+                return depth, files, subdirs, pruned, None
+
+            if scandir is not None:
+                for entry in scandir(path):
+                    if not self._checkExtension(entry.name):
+                        continue
+                    if entry.is_file():
+                        if self.exclude_files(entry.name, entry.path):
+                            pruned[1] += 1
+                        else:
+                            files.append(entry.path)
+                    elif entry.is_dir():
+                        if self.exclude_dirs(entry.name, entry.path):
+                            pruned[0] += 1
+                        elif self.follow_symlinks or not entry.is_symlink():
+                            subdirs.append(entry.path)
             else:
-                if self.recursive:
-                    allfiles.extend(self._findFilesInPath(newpath))
-                #end if recursive
-            #end if isfile
-        #end for sf
-        return allfiles
+                for subf in os.listdir(path):
+                    if not self._checkExtension(subf):
+                        continue
+                    newpath = os.path.join(path, subf)
+                    if os.path.isfile(newpath):
+                        if self.exclude_files(subf, newpath):
+                            pruned[1] += 1
+                        else:
+                            files.append(newpath)
+                    elif os.path.isdir(newpath):
+                        if self.exclude_dirs(subf, newpath):
+                            pruned[0] += 1
+                        elif self.follow_symlinks or not os.path.islink(newpath):
+                            subdirs.append(newpath)
+        except Exception, e:
+            return depth, files, subdirs, pruned, e
+
+        if not first:
+            # Files were returned when the directory was first visited
+            log().debug("Listing subdirectories of %s again at depth %d" % (path, depth))
+            files = []
+            pruned = [0, 0]
+        return depth, files, subdirs, pruned, None
+
+    def _iterFilesInPath(self, startpath):
+        """Yields files from startpath, and its subdirectories if recursive.
+        Directories are walked iteratively, never recursing. At most twice
+        as many directories as threads are being listed at once, so memory
+        use depends on the number of directories waiting to be listed, not
+        the number of files
+        """
+        allpruned = [0, 0]
+        listed = Queue.Queue()
+        self._visited.clear()
+
+        if self.recursive and self.threads > 1:
+            pool = ThreadPool(self.threads)
+        else:
+            pool = None
+
+        try:
+            pending = [(os.path.abspath(unicode(startpath)), 0)]
+            outstanding = 0
+            while len(pending) > 0 or outstanding > 0:
+                if pool is None:
+                    result = self._listDir(*pending.pop())
+                else:
+                    while len(pending) > 0 and outstanding < self.threads * 2:
+                        pool.apply_async(self._listDir, pending.pop(), callback = listed.put)
+                        outstanding += 1
+                    result = waitInterruptibly(listed.get)
+                    outstanding -= 1
+
+                depth, files, subdirs, pruned, error = result
+                if error is not None:
+                    raise error
+
+                allpruned[0] += pruned[0]
+                allpruned[1] += pruned[1]
+                if self.recursive and (self.max_depth is None or depth < self.max_depth):
+                    pending.extend((subdir, depth + 1) for subdir in subdirs)
+
+                for cfile in files:
+                    yield cfile
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if allpruned[0] > 0 or allpruned[1] > 0:
+            log().info("Excluded %d directories and %d files in %s" % (
+                allpruned[0], allpruned[1], startpath))
 
 
 class FileParser(object):
-    """Deals with parsing of filenames
+    """Deals with parsing of filenames.
+
+    The compiled patterns and matcher are shared between all instances (see
+    patterns.getMatcher), so a single FileParser can be used to
+    parse any number of filenames by passing each path to parse().
+
+    For backwards compatibility, a path can also be given to the constructor
+    and parsed by calling parse() without arguments.
     """
 
-    def __init__(self, path):
+    # Available values for Config['filename_parser']
+    engines = ['regex', 'tokenizer']
+
+    # Available values for Config['comicinfo_mode']
+    comicinfo_modes = ['off', 'fill', 'trust']
+
+    def __init__(self, path = None):
         self.path = path
-        self.compiled_regexs = []
-        self._compileRegexs()
+        self.matcher = getMatcher()
 
-    def _compileRegexs(self):
-        """Takes issue_patterns from config, compiles them all
-        into self.compiled_regexs
-        """
-        for cpattern in Config['filename_patterns']:
-            try:
-                cregex = re.compile(cpattern, re.VERBOSE)
-            except re.error, errormsg:
-                warn("WARNING: Invalid issue_pattern, %s. %s" % (
-                    errormsg, cregex.pattern))
-            else:
-                self.compiled_regexs.append(cregex)
+        if Config['filename_parser'] not in self.engines:
+            raise ConfigValueError("Unknown filename_parser %r, should be one of: %s" % (
+                Config['filename_parser'], ", ".join(self.engines)))
+        self.use_tokenizer = Config['filename_parser'] == 'tokenizer'
 
-    def parse(self):
+        if Config['comicinfo_mode'] not in self.comicinfo_modes:
+            raise ConfigValueError("Unknown comicinfo_mode %r, should be one of: %s" % (
+                Config['comicinfo_mode'], ", ".join(self.comicinfo_modes)))
+        self.use_comicinfo = Config['comicinfo_mode'] != 'off'
+
+    def parse(self, path = None):
         """Runs path via configured regex, extracting data from groups.
         Returns an IssueInfo instance containing extracted data.
         """
-        _, filename = os.path.split(self.path)
+        if path is None:
+            path = self.path
+
+        try:
+            result = self._parseFilename(path)
+        except InvalidFilename, errormsg:
+            result = errormsg
+
+        result = self._withComicInfo(path, result)
+        if isinstance(result, InvalidFilename):
+            raise result
+        return result
+
+    def _parseFilename(self, path):
+        _, filename = os.path.split(path)
 
         filename = applyCustomInputReplacements(filename)
 
-        for cmatcher in self.compiled_regexs:
-            match = cmatcher.match(filename)
-            if match:
-                namedgroups = match.groupdict().keys()
-
-                if 'issuenumber1' in namedgroups:
-                    # Multiple issues, have issuenumber1 or 2 etc
-                    issnos = []
-                    for cur in namedgroups:
-                        issnomatch = re.match('issuenumber(\d+)', cur)
-                        if issnomatch:
-                            issnos.append(int(match.group(cur)))
-                    issnos.sort()
-                    issuenumbers = issnos
-
-                elif 'issuenumberstart' in namedgroups:
-                    # Multiple issues, regex specifies start and end number
-                    start = int(match.group('issuenumberstart'))
-                    end = int(match.group('issuenumberend'))
-                    if start > end:
-                        # Swap start and end
-                        start, end = end, start
-                    issuenumbers = range(start, end + 1)
-
-                elif 'issuenumber' in namedgroups:
-                    issuenumbers = [int(match.group('issuenumber')), ]
-
-                elif 'year' in namedgroups or 'month' in namedgroups or 'day' in namedgroups:
-                    if not all(['year' in namedgroups, 'month' in namedgroups, 'day' in namedgroups]):
-                        raise ConfigValueError(
-                            "Date-based regex must contain groups 'year', 'month' and 'day'")
-                    match.group('year')
-
-                    issuenumbers = [datetime.date(int(match.group('year')),
-                                                    int(match.group('month')),
-                                                    int(match.group('day')))]
+        if self.use_tokenizer:
+            tokenized = parseFilenameTokens(filename)
+            if tokenized is not None:
+                return self._makeIssue(path, *tokenized)
 
+        matched = self.matcher.match(filename)
+        if matched is None:
+            raise InvalidFilename(path)
+
+        cpattern, groups = matched
+        return self._makeIssue(path, *cpattern.extract(groups))
+
+    def parseMany(self, paths):
+        """Parses a list of paths as a batch, using the matcher's matchMany
+        (which for the 'bulk' filename_matcher runs each pattern over all
+        the filenames at once).
+
+        Returns a list of (path, result) tuples in the same order as paths,
+        where result is an IssueInfo instance, or an InvalidFilename
+        instance if the path could not be parsed.
+        """
+        filenames = [applyCustomInputReplacements(os.path.split(x)[1]) for x in paths]
+
+        results = [None] * len(paths)
+        remaining = range(len(paths))
+
+        if self.use_tokenizer:
+            remaining = []
+            for index, filename in enumerate(filenames):
+                tokenized = parseFilenameTokens(filename)
+                if tokenized is None:
+                    remaining.append(index)
                 else:
-                    raise ConfigValueError(
-                        "Regex does not contain issue number group, should"
-                        "contain issuenumber, issuenumber1-9, or"
-                        "issuenumberstart and issuenumberend\n\nPattern"
-                        "was:\n" + cmatcher.pattern)
-
-                if 'volumename' in namedgroups:
-                    volumename = match.group('volumename')
-                else:
-                    raise ConfigValueError(
-                        "Regex must contain volumename. Pattern was:\n" + cmatcher.pattern)
+                    results[index] = self._makeIssue(paths[index], *tokenized)
 
-                if volumename != None:
-                    volumename = cleanRegexedvolumeName(volumename)
+        matches = self.matcher.matchMany([filenames[x] for x in remaining])
+        for index, matched in zip(remaining, matches):
+            if matched is None:
+                results[index] = InvalidFilename(paths[index])
+            else:
+                cpattern, groups = matched
+                results[index] = self._makeIssue(paths[index], *cpattern.extract(groups))
 
-                issue = IssueInfo(
-                    volumename = volumename,
-                    issuenumbers = issuenumbers,
-                    filename = self.path)
-                return issue
-        else:
-            raise InvalidFilename(self.path)
+        if self.use_comicinfo:
+            results = [self._withComicInfo(path, result) for path, result in zip(paths, results)]
+
+        return zip(paths, results)
+
+    def _withComicInfo(self, path, result):
+        """Updates result (an IssueInfo, or InvalidFilename) with the
+        ComicInfo.xml in the file at path, if comicinfo_mode is enabled. Its
+        series and issue number replace those parsed from the filename
+        (unless the filename has several issue numbers), and it is stored as
+        the comicinfo of the IssueInfo
+        """
+        if not self.use_comicinfo:
+            return result
+
+        info = readComicInfo(path)
+        if info is None or info.series is None or info.number is None:
+            return result
+
+        if isinstance(result, InvalidFilename):
+            result = IssueInfo(filename = path)
+        result.volumename = info.series
+        if result.issuenumbers is None or len(result.issuenumbers) < 2:
+            result.issuenumbers = [info.number]
+        result.comicinfo = info
+        return result
+
+    def _makeIssue(self, path, volumename, issuenumbers):
+        """Creates IssueInfo for path, cleaning the volume name
+        """
+        if volumename != None:
+            volumename = cleanRegexedvolumeName(volumename)
+
+        issue = IssueInfo(
+            volumename = volumename,
+            issuenumbers = issuenumbers,
+            filename = path)
+        return issue
 
 
 def formatIssueName(names, join_with):
@@ -445,6 +776,9 @@ class IssueInfo(object):
         self.issuename = issuename
         self.fullpath = filename
 
+        # ComicInfo from the file, if read (see comicinfo_mode)
+        self.comicinfo = None
+
     def fullpath_get(self):
         return self._fullpath
 
@@ -26,7 +26,7 @@ entry_points = {
     ],
 },
 
-install_requires = ['comicvine_api>=1.04', 'simplejson'],
+install_requires = ['comicvine_api>=1.04', 'simplejson', 'scandir'],
 
 classifiers=[
     "Environment :: Console",
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests the lookup cache
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.cache import LookupCache
+
+
+class test_listings(unittest.TestCase):
+    """Tests complete issue lists in LookupCache
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = LookupCache(os.path.join(self.tmpdir, "cache.sqlite"),
+            ttl = 3600, max_entries = 4)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_listing_keeps_issues(self):
+        """Using a listing keeps its issues from being evicted before other
+        issues
+        """
+        self.cache.setListing(1, {u"1": u"One", u"2": u"Two"})
+        self.cache.setIssueName(2, u"1", u"Other one")
+        self.cache.setIssueName(2, u"2", u"Other two")
+        self.cache.getListing(1)
+        self.cache.setIssueName(2, u"3", u"Other three")
+        self.cache.evict()
+
+        self.assertEqual(self.cache.getListing(1), {u"1": u"One", u"2": u"Two"})
+
+    def test_incomplete_listing_ignored(self):
+        """A listing some of whose issues were evicted is not returned
+        """
+        self.cache.setListing(1, {u"1": u"One", u"2": u"Two", u"3": u"Three"})
+        self.cache.setIssueName(2, u"1", u"Other one")
+        self.cache.setIssueName(2, u"2", u"Other two")
+        self.cache.evict()
+
+        self.assertEqual(self.cache.getListing(1), None)
+        self.assertEqual(self.cache.getListing(1), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests Catalog and CatalogWriter
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.config import Config
+from comicnamer.cache import LookupCache
+from comicnamer.cassette import Cassette
+from comicnamer.catalog import Catalog, CatalogWriter, catalog_header
+from comicnamer.lookup import buildCatalog
+
+
+class test_catalog(unittest.TestCase):
+    """Tests Catalog and CatalogWriter
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "catalog")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, volumes = (), issues = ()):
+        writer = CatalogWriter(self.path)
+        for volume in volumes:
+            writer.addVolume(*volume)
+        for issue in issues:
+            writer.addIssue(*issue)
+        writer.write()
+        return Catalog(self.path)
+
+    def test_first_and_last_lines(self):
+        catalog = self.write(
+            volumes = [(u"aaa", 1, u"AAA"), (u"mmm", 2, u"MMM")],
+            issues = [(1, u"1", u"First"), (9999999, u"99", u"Last")])
+        self.assertEqual(catalog.findVolume(u"aaa"), (1, u"AAA", None))
+        self.assertEqual(catalog.getIssueName(9999999, u"99"), u"Last")
+        self.assertEqual(catalog.getIssueName(1, u"1"), u"First")
+        self.assertEqual(catalog.listIssues(9999999), {u"99": u"Last"})
+        catalog.close()
+
+    def test_missing_keys(self):
+        catalog = self.write(
+            volumes = [(u"bbb", 2, u"BBB"), (u"ddd", 4, u"DDD")],
+            issues = [(2, u"2", u"Two"), (4, u"4", u"Four")])
+        for key in (u"aaa", u"ccc", u"zzz", u""):
+            self.assertEqual(catalog.findVolume(key), None)
+        for volumeid, issueno in ((1, u"1"), (2, u"1"), (3, u"3"), (4, u"5"), (5, u"5")):
+            self.assertEqual(catalog.getIssueName(volumeid, issueno), None)
+        self.assertEqual(catalog.listIssues(3), {})
+        self.assertEqual(catalog.listIssues(5), {})
+        catalog.close()
+
+    def test_prefix_keys(self):
+        """Keys which are prefixes of their neighbours are told apart
+        """
+        catalog = self.write(
+            volumes = [(u"bat", 1, u"Bat"), (u"batman", 2, u"Batman"),
+                (u"batman beyond", 3, u"Batman Beyond")],
+            issues = [(2, u"1", u"One"), (2, u"10", u"Ten"), (2, u"1.5", u"One and a half"),
+                (20, u"1", u"Other volume")])
+        self.assertEqual(catalog.findVolume(u"bat"), (1, u"Bat", None))
+        self.assertEqual(catalog.findVolume(u"batman"), (2, u"Batman", None))
+        self.assertEqual(catalog.findVolume(u"batman beyond"), (3, u"Batman Beyond", None))
+        self.assertEqual(catalog.findVolume(u"batma"), None)
+
+        self.assertEqual(catalog.getIssueName(2, u"1"), u"One")
+        self.assertEqual(catalog.getIssueName(2, u"10"), u"Ten")
+        self.assertEqual(catalog.listIssues(2),
+            {u"1": u"One", u"10": u"Ten", u"1.5": u"One and a half"})
+        catalog.close()
+
+    def test_fields_cleaned(self):
+        catalog = self.write(
+            volumes = [(u"caf\xe9", 1, u"Caf\xe9\tTab", 2011)],
+            issues = [(1, 1, u"Line\nbreak"), (1, 2, None)])
+        self.assertEqual(catalog.findVolume(u"caf\xe9"), (1, u"Caf\xe9 Tab", u"2011"))
+        self.assertEqual(catalog.getIssueName(1, 1), u"Line break")
+        self.assertEqual(catalog.getIssueName(1, 2), u"")
+        catalog.close()
+
+    def test_header_only(self):
+        catalog = self.write()
+        self.assertEqual(open(self.path, "rb").read(), catalog_header)
+        self.assertEqual(catalog.findVolume(u"volume"), None)
+        self.assertEqual(catalog.getIssueName(1, u"1"), None)
+        self.assertEqual(catalog.listIssues(1), {})
+        catalog.close()
+
+    def test_not_a_catalog(self):
+        open(self.path, "wb").write("V\tvolume\t1\tVolume\t\n")
+        self.assertRaises(ValueError, Catalog, self.path)
+
+    def test_many_lines(self):
+        catalog = self.write(
+            volumes = [(u"volume %d" % x, x, u"Volume %d" % x) for x in range(500)],
+            issues = [(x, u"1", u"Issue of %d" % x) for x in range(500)])
+        for x in range(500):
+            self.assertEqual(catalog.findVolume(u"volume %d" % x), (x, u"Volume %d" % x, None))
+            self.assertEqual(catalog.getIssueName(x, u"1"), u"Issue of %d" % x)
+        catalog.close()
+
+
+class test_build_catalog(unittest.TestCase):
+    """Tests buildCatalog from the lookup cache and cassettes
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.original_config = dict(Config)
+        Config['cache_file'] = os.path.join(self.tmpdir, "cache.sqlite")
+        Config['catalog_file'] = os.path.join(self.tmpdir, "catalog")
+        self.original_stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.original_stdout
+        Config.clear()
+        Config.update(self.original_config)
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        cache = LookupCache(Config['cache_file'], ttl = 3600, max_entries = 100)
+        cache.setVolume(u"volume", 1, u"The Volume")
+        cache.setIssueName(1, u"1", u"One")
+        cache.setListing(2, {u"1": u"Other", u"2": None})
+        cache.close()
+
+        cassette = Cassette(os.path.join(self.tmpdir, "cassette.json"))
+        cassette.set('volumes', u"other", {'id': 2, 'name': u"Other"})
+        cassette.set('volumes', u"missing", {'error': 'volumeNotFound', 'message': u"Not found"})
+        cassette.set('issues', u"1/2", {'name': u"Two"})
+        cassette.set('issues', u"1/3", {'error': 'IssueNameNotFound', 'message': u"No name"})
+        cassette.set('issues', u"1/4", {'error': 'IssueNotFound', 'message': u"Not found"})
+        cassette.set('listings', 3, {'issues': {u"1": u"Third"}})
+        cassette.save()
+
+        buildCatalog([cassette.path])
+
+        catalog = Catalog(Config['catalog_file'])
+        self.assertEqual(catalog.findVolume(u"volume"), (1, u"The Volume", None))
+        self.assertEqual(catalog.findVolume(u"other"), (2, u"Other", None))
+        self.assertEqual(catalog.findVolume(u"missing"), None)
+        self.assertEqual(catalog.listIssues(1), {u"1": u"One", u"2": u"Two", u"3": None})
+        self.assertEqual(catalog.listIssues(2), {u"1": u"Other", u"2": None})
+        self.assertEqual(catalog.listIssues(3), {u"1": u"Third"})
+        catalog.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
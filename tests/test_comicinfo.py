@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests reading and writing ComicInfo.xml
+"""
+
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer import comicinfo
+from comicnamer.comicinfo import ComicInfo, readComicInfo, writeComicInfo
+
+
+def comicInfoXml(series, number, title, extra = ""):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<ComicInfo><Series>%s</Series>'
+        '<Number>%s</Number><Title>%s</Title>%s</ComicInfo>' % (series, number, title, extra))
+
+
+class ArchiveTestCase(unittest.TestCase):
+    """Runs with a temporary directory to create archives in
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeArchive(self, members, name = "issue.cbz", comment = ""):
+        """Creates an archive of members, a list of (name, data), returns
+        its path
+        """
+        path = os.path.join(self.tmpdir, name)
+        archive = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        try:
+            for member, data in members:
+                archive.writestr(member, data)
+            archive.comment = comment
+        finally:
+            archive.close()
+        return path
+
+
+class test_read_comicinfo(ArchiveTestCase):
+    """Tests readComicInfo
+    """
+
+    def test_read(self):
+        path = self.makeArchive([("page1.jpg", "x" * 100),
+            ("ComicInfo.xml", comicInfoXml("Batman", "012", "The Last Laugh", "<Year>2011</Year>"))])
+        info = readComicInfo(path)
+        self.assertEqual((info.series, info.number, info.title, info.year, info.volume),
+            (u"Batman", 12, u"The Last Laugh", 2011, None))
+
+    def test_unicode(self):
+        path = self.makeArchive([("ComicInfo.xml",
+            comicInfoXml(u"Am\xe9lie".encode("utf-8"), "1.5", u"Caf\xe9".encode("utf-8")))])
+        info = readComicInfo(path)
+        self.assertEqual((info.series, info.number, info.title), (u"Am\xe9lie", None, u"Caf\xe9"))
+        self.assertEqual(repr(info), u"<ComicInfo Am\xe9lie #None: Caf\xe9>".encode("utf-8"))
+
+    def test_namespaces_and_whitespace(self):
+        path = self.makeArchive([("ComicInfo.xml",
+            '<ComicInfo xmlns="http://example.com/"><Series> Batman </Series>'
+            '<Number>1</Number><Title>  </Title></ComicInfo>')])
+        info = readComicInfo(path)
+        self.assertEqual((info.series, info.number, info.title), (u"Batman", 1, None))
+
+    def test_top_level_preferred(self):
+        path = self.makeArchive([
+            ("extras/comicinfo.xml", comicInfoXml("Nested", 1, "Nested")),
+            ("ComicInfo.xml", comicInfoXml("Top", 1, "Top"))])
+        self.assertEqual(readComicInfo(path).series, u"Top")
+
+        path = self.makeArchive([("extras\\ComicInfo.xml", comicInfoXml("Nested", 1, "Nested"))],
+            name = "nested.cbz")
+        self.assertEqual(readComicInfo(path).series, u"Nested")
+
+    def test_missing_or_invalid(self):
+        self.assertEqual(readComicInfo(self.makeArchive([("page1.jpg", "x")])), None)
+        self.assertEqual(readComicInfo(self.makeArchive([("ComicInfo.xml", "<ComicInfo>")])), None)
+
+        path = os.path.join(self.tmpdir, "broken.cbz")
+        open(path, "wb").write("PK\x03\x04 not really a zip file")
+        self.assertEqual(readComicInfo(path), None)
+
+        path = self.makeArchive([("ComicInfo.xml", comicInfoXml("Batman", 1, "Title"))],
+            name = "issue.cbr")
+        self.assertEqual(readComicInfo(path), None)
+
+    def test_too_large(self):
+        original = comicinfo.max_comicinfo_size
+        comicinfo.max_comicinfo_size = 100
+        try:
+            path = self.makeArchive([("ComicInfo.xml", comicInfoXml("Batman", 1, "x" * 200))])
+            self.assertEqual(readComicInfo(path), None)
+        finally:
+            comicinfo.max_comicinfo_size = original
+
+    def test_repr(self):
+        self.assertEqual(repr(ComicInfo(u"Batman", 1, u"Title")), "<ComicInfo Batman #1: Title>")
+
+
+class test_write_comicinfo(ArchiveTestCase):
+    """Tests writeComicInfo
+    """
+
+    pages = [("page%d.jpg" % x, os.urandom(2000)) for x in range(3)]
+
+    def check(self, path, names):
+        """Checks the archive is valid, has the pages and members names
+        (besides the pages), and returns its ComicInfo
+        """
+        archive = zipfile.ZipFile(path)
+        try:
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(sorted(archive.namelist()), sorted([x[0] for x in self.pages] + names))
+            for name, data in self.pages:
+                self.assertEqual(archive.read(name), data)
+        finally:
+            archive.close()
+        return readComicInfo(path)
+
+    def test_append(self):
+        path = self.makeArchive(self.pages)
+        size = os.path.getsize(path)
+        written = writeComicInfo(path, u"Batman", 12, u"The Last Laugh")
+        self.assertEqual(os.path.getsize(path), size + written)
+
+        info = self.check(path, ["ComicInfo.xml"])
+        self.assertEqual((info.series, info.number, info.title), (u"Batman", 12, u"The Last Laugh"))
+
+    def test_unchanged(self):
+        path = self.makeArchive(self.pages)
+        writeComicInfo(path, u"Am\xe9lie", 1, u"Caf\xe9")
+        data = open(path, "rb").read()
+        self.assertEqual(writeComicInfo(path, u"Am\xe9lie", 1, u"Caf\xe9"), 0)
+        self.assertEqual(open(path, "rb").read(), data)
+
+    def test_replace(self):
+        path = self.makeArchive(self.pages + [("ComicInfo.xml", comicInfoXml("Old", 1, "Old"))])
+        self.assertTrue(writeComicInfo(path, u"New", 2, u"New") > 0)
+        info = self.check(path, ["ComicInfo.xml"])
+        self.assertEqual((info.series, info.number, info.title), (u"New", 2, u"New"))
+
+    def test_replace_in_subdirectory(self):
+        """A ComicInfo.xml in a subdirectory is replaced by one at the top
+        of the archive
+        """
+        path = self.makeArchive(self.pages + [("extras/ComicInfo.xml", comicInfoXml("Old", 1, "Old"))])
+        writeComicInfo(path, u"New", 2, u"New")
+        info = self.check(path, ["ComicInfo.xml"])
+        self.assertEqual((info.series, info.number, info.title), (u"New", 2, u"New"))
+
+    def test_other_fields_and_comment_kept(self):
+        path = self.makeArchive(self.pages + [("ComicInfo.xml", comicInfoXml("Old", 1, "Old",
+            "<Year>2011</Year><Summary>Kept</Summary>"))], comment = "Archive comment")
+        writeComicInfo(path, u"New", 2, u"New")
+
+        info = self.check(path, ["ComicInfo.xml"])
+        self.assertEqual((info.series, info.year), (u"New", 2011))
+        archive = zipfile.ZipFile(path)
+        try:
+            self.assertTrue("<Summary>Kept</Summary>" in archive.read("ComicInfo.xml"))
+            self.assertEqual(archive.comment, "Archive comment")
+        finally:
+            archive.close()
+
+    def test_not_a_zip(self):
+        path = os.path.join(self.tmpdir, "issue.cbz")
+        open(path, "wb").write("Not a zip file")
+        self.assertRaises(zipfile.BadZipfile, writeComicInfo, path, u"Batman", 1, u"Title")
+        self.assertEqual(open(path, "rb").read(), "Not a zip file")
+
+    def test_invalid_existing(self):
+        path = self.makeArchive(self.pages + [("ComicInfo.xml", "<ComicInfo>")])
+        size = os.path.getsize(path)
+        self.assertRaises(SyntaxError, writeComicInfo, path, u"Batman", 1, u"Title")
+        self.assertEqual(os.path.getsize(path), size)
+
+    def test_truncated_on_failure(self):
+        """When writing fails part way through, the file is truncated back
+        to its original size, and is unchanged
+        """
+        path = self.makeArchive(self.pages + [("ComicInfo.xml", comicInfoXml("Old", 1, "Old"))])
+        data = open(path, "rb").read()
+
+        def failingWritestr(archive, info, data):
+            archive.fp.write(data[:10])
+            raise IOError("No space left on device")
+
+        original = zipfile.ZipFile.writestr
+        zipfile.ZipFile.writestr = failingWritestr
+        try:
+            self.assertRaises(IOError, writeComicInfo, path, u"New", 2, u"New")
+        finally:
+            zipfile.ZipFile.writestr = original
+
+        self.assertEqual(open(path, "rb").read(), data)
+        self.assertEqual(self.check(path, ["ComicInfo.xml"]).series, u"Old")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests ComicvineClient against tools/stub_comicvine_server.py
+"""
+
+import os
+import sys
+import socket
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+
+from comicvine_api import (comicvine_error, comicvine_volumenotfound,
+comicvine_issuenotfound, comicvine_attributenotfound)
+
+from stub_comicvine_server import StubHandler, StubServer
+from comicnamer.comicvine_client import ComicvineClient
+
+
+class TestHandler(StubHandler):
+    """Responds with the server's status, if set, and records the open
+    connections and content encodings sent
+    """
+
+    def setup(self):
+        StubHandler.setup(self)
+        self.server.sockets.append(self.connection)
+
+    def do_GET(self):
+        if self.server.status is not None:
+            self.server.count("requests")
+            self.send_error(self.server.status)
+        else:
+            StubHandler.do_GET(self)
+
+    def send_header(self, keyword, value):
+        if keyword == "Content-Encoding":
+            self.server.encodings.append(value)
+        StubHandler.send_header(self, keyword, value)
+
+
+class TestServer(StubServer):
+    """A StubServer on any free port, using TestHandler
+    """
+
+    def __init__(self, volumes, issues):
+        StubServer.__init__(self, ("localhost", 0), volumes, issues)
+        self.RequestHandlerClass = TestHandler
+        self.status = None
+        self.sockets = []
+        self.encodings = []
+
+    def closeConnections(self):
+        """Closes the server side of every connection, as a server does
+        with idle kept-alive connections
+        """
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.sockets = []
+
+
+class test_comicvine_client(unittest.TestCase):
+    """Tests ComicvineClient
+    """
+
+    def setUp(self):
+        self.server = TestServer(volumes = 3, issues = 20)
+        thread = threading.Thread(target = self.server.serve_forever, args = (0.05, ))
+        thread.daemon = True
+        thread.start()
+
+        self.client = ComicvineClient("key", page_size = 7,
+            base_url = "http://localhost:%d/" % self.server.server_address[1])
+
+    def tearDown(self):
+        self.client._disconnect()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_search_and_pages(self):
+        volume = self.client[u"volume 2"]
+        self.assertEqual((volume['id'], volume['volumename']), (1002, u"Volume 2"))
+        self.assertEqual(sorted(volume.keys()), range(1, 21))
+        self.assertEqual(volume[20]['issuename'], u"Volume 2 Issue 20")
+        self.assertRaises(comicvine_issuenotfound, volume.__getitem__, 21)
+        self.assertRaises(comicvine_attributenotfound, volume[1].__getitem__, 'description')
+
+        # A search, the volume, and three pages of issues over one connection
+        self.assertEqual(self.server.counts, {"requests": 5, "connections": 1})
+        self.assertEqual(self.server.encodings, ["gzip"] * 5)
+
+    def test_by_id(self):
+        self.assertEqual(self.client[1003]['volumename'], u"Volume 3")
+        self.assertEqual(self.server.counts["requests"], 4)
+
+    def test_not_found(self):
+        # No search results
+        self.assertRaises(comicvine_volumenotfound, self.client.__getitem__, u"Missing")
+        # Status code 101 for an unknown id
+        self.assertRaises(comicvine_volumenotfound, self.client.__getitem__, 2000)
+        # HTTP 404
+        self.server.status = 404
+        self.assertRaises(comicvine_volumenotfound, self.client.__getitem__, 1001)
+
+    def test_server_errors(self):
+        for status in (500, 502, 503):
+            self.server.status = status
+            try:
+                self.client[1001]
+            except comicvine_volumenotfound:
+                self.fail("HTTP %d raised comicvine_volumenotfound" % status)
+            except comicvine_error, errormsg:
+                self.assertTrue(str(status) in str(errormsg))
+            else:
+                self.fail("HTTP %d did not raise comicvine_error" % status)
+
+    def test_reconnect(self):
+        """A kept-alive connection closed by the server is reopened, without
+        failing the request
+        """
+        self.client[1001]
+        self.server.closeConnections()
+        self.assertEqual(self.client[1002]['volumename'], u"Volume 2")
+        self.assertEqual(self.server.counts["connections"], 2)
+
+    def test_connection_refused(self):
+        unused = socket.socket()
+        unused.bind(("localhost", 0))
+        port = unused.getsockname()[1]
+        unused.close()
+
+        client = ComicvineClient("key", base_url = "http://localhost:%d/" % port)
+        self.assertRaises(comicvine_error, client.__getitem__, 1001)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests FileFinder
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.utils import FileFinder
+
+
+class FailingFileFinder(FileFinder):
+    """Raises ValueError when checking the extension of bad.cbz
+    """
+
+    def _checkExtension(self, fname):
+        if os.path.basename(fname) == "bad.cbz":
+            raise ValueError("Cannot check %s" % fname)
+        return FileFinder._checkExtension(self, fname)
+
+
+class SymlinksFirstFileFinder(FileFinder):
+    """Lists subdirectories reached through symlinks before the others
+    """
+
+    def _listDir(self, path, depth):
+        result = FileFinder._listDir(self, path, depth)
+        # Directories are taken from the end of the pending list
+        result[2].sort(key = lambda x: os.path.islink(x))
+        return result
+
+
+class test_filefinder(unittest.TestCase):
+    """Tests FileFinder
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeFiles(self, *paths):
+        for path in paths:
+            path = os.path.join(self.tmpdir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+    def findFiles(self, finder, timeout = 10):
+        """Returns the files found, or raises the exception raised by
+        finder. Fails if it takes longer than timeout seconds
+        """
+        result = []
+
+        def run():
+            try:
+                result.append(sorted(finder.findFiles()))
+            except Exception, e:
+                result.append(e)
+
+        thread = threading.Thread(target = run)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.isAlive(), "FileFinder did not finish")
+
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def test_worker_exception_raised(self):
+        """An exception in a thread listing a directory is raised, rather
+        than waiting for the listing forever
+        """
+        self.makeFiles("a/1.cbz", "a/b/bad.cbz", "c/2.cbz")
+        for threads in (1, 4):
+            finder = FailingFileFinder(self.tmpdir, recursive = True, threads = threads)
+            self.assertRaises(ValueError, self.findFiles, finder)
+
+    def test_threads_find_same_files(self):
+        self.makeFiles("a/1.cbz", "a/b/2.cbz", "c/3.cbz", "4.cbz")
+        expected = self.findFiles(FileFinder(self.tmpdir, recursive = True, threads = 1))
+        self.assertEqual(len(expected), 4)
+        self.assertEqual(self.findFiles(FileFinder(self.tmpdir, recursive = True, threads = 4)), expected)
+
+    def test_depth_independent_of_order(self):
+        """A directory first reached through a deeper symlink is still
+        descended as far as max_depth allows from its shallower path
+        """
+        self.makeFiles("a/1.cbz", "c/2.cbz", "c/d/3.cbz")
+        os.symlink(os.path.join(self.tmpdir, "c"), os.path.join(self.tmpdir, "a", "link"))
+
+        found = self.findFiles(SymlinksFirstFileFinder(self.tmpdir, recursive = True, max_depth = 2))
+        self.assertEqual([os.path.relpath(x, self.tmpdir) for x in found],
+            ["a/1.cbz", "a/link/2.cbz", "c/d/3.cbz"])
+
+    def test_exclude_globs(self):
+        """Excluded directories are not listed, and excluded files are
+        skipped. Patterns with a / match the full path, others the name
+        """
+        self.makeFiles("1.cbz", "cover.jpg", "._1.cbz", "a/2.cbz",
+            ".git/3.cbz", "a/.git/4.cbz", "a/_organized/5.cbz",
+            "_organized/6.cbz", "b/_organized/c/7.cbz")
+
+        finder = FileFinder(self.tmpdir, recursive = True,
+            exclude_dirs = [".git", "*/b/_organized/"],
+            exclude_files = ["*.jpg", "._*"])
+        found = self.findFiles(finder)
+        self.assertEqual([os.path.relpath(x, self.tmpdir) for x in found],
+            ["1.cbz", "_organized/6.cbz", "a/2.cbz", "a/_organized/5.cbz"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests the tokenizer and regex filename parsers
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.config import Config
+from comicnamer.utils import FileParser, tokenizeFilename, parseFilenameTokens
+from comicnamer.comicnamer_exceptions import InvalidFilename
+
+
+# Filenames both parsers give the same volume name and issue numbers for
+agreeing = [
+    ("Batman 042 (2011) (digital) (Group).cbz", "Batman", [42]),
+    ("Batman (2011) 042.cbz", "Batman (2011)", [42]),
+    ("Batman 2011 042.cbz", "Batman 2011", [42]),
+    ("Batman - 042.cbz", "Batman", [42]),
+    ("Batman.042.cbz", "Batman", [42]),
+    ("Batman_042_(2011).cbz", "Batman", [42]),
+    ("Detective Comics 027 [HD].cbr", "Detective Comics", [27]),
+    ("Green Lantern v2 042.cbz", "Green Lantern v2", [42]),
+    ("[Group] Green Lantern - 007 [digital].cbz", "Green Lantern", [7]),
+    # A year is left to the regex patterns
+    ("Spawn 2010.cbz", "Spawn", [10]),
+]
+
+# Filenames only the tokenizer parses correctly
+tokenized = [
+    ("[Group] X-Men 01-04 (1991).cbz", "X-Men", [1, 2, 3, 4]),
+    ("X-Men - 01-04 [Group].cbz", "X-Men", [1, 2, 3, 4]),
+    ("Invincible 044-045 (2007).cbz", "Invincible", [44, 45]),
+    ("Watchmen 01 of 12.cbz", "Watchmen", [1]),
+    ("Superman #12.cbz", "Superman", [12]),
+    ("Superman # 12 (2012) (digital).cbz", "Superman", [12]),
+    ("The Walking Dead 100 (digital) (Minutemen-Faessla).cbz", "The Walking Dead", [100]),
+]
+
+
+def parse(engine, filename):
+    """Returns (volumename, issuenumbers) parsed by FileParser using
+    engine, or None if the filename is invalid
+    """
+    original = Config['filename_parser']
+    Config['filename_parser'] = engine
+    try:
+        issue = FileParser().parse(filename)
+    except InvalidFilename:
+        return None
+    finally:
+        Config['filename_parser'] = original
+    return issue.volumename, issue.issuenumbers
+
+
+class test_tokenizer(unittest.TestCase):
+    """Tests parsing filenames with the tokenizer
+    """
+
+    def test_same_as_regex(self):
+        for filename, volumename, issuenumbers in agreeing:
+            self.assertEqual(parse('tokenizer', filename), (volumename, issuenumbers))
+            self.assertEqual(parse('regex', filename), parse('tokenizer', filename))
+
+    def test_ranges_and_tags(self):
+        for filename, volumename, issuenumbers in tokenized:
+            self.assertEqual(parse('tokenizer', filename), (volumename, issuenumbers))
+
+    def test_parse_many_same_as_parse(self):
+        original = Config['filename_parser']
+        Config['filename_parser'] = 'tokenizer'
+        try:
+            filenames = [x[0] for x in agreeing + tokenized]
+            results = FileParser().parseMany(filenames)
+        finally:
+            Config['filename_parser'] = original
+
+        self.assertEqual([(issue.volumename, issue.issuenumbers) for filename, issue in results],
+            [parse('tokenizer', x) for x in filenames])
+
+    def test_unclassified_left_to_regex(self):
+        for filename in ["show.s01e23.cbr", "Batman 2011.cbz", "Batman 2010.01.02.cbz",
+                "Batman v2.cbz", "42.cbz"]:
+            self.assertEqual(parseFilenameTokens(filename), None, filename)
+
+    def test_tokenize(self):
+        self.assertEqual(tokenizeFilename("[Group] X-Men #42 (2011) (digital)"),
+            ("X-Men #42 ", ["X", "Men", "#42"]))
+        self.assertEqual(tokenizeFilename("{Tag} (2011) Batman_01-04.5")[1],
+            ["Batman", "01-04", "5"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests lookup backends
+"""
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicvine_api import comicvine_attributenotfound
+
+from comicnamer import cliarg_parser
+from comicnamer.config import Config
+from comicnamer.config_defaults import defaults
+from comicnamer.cache import LookupCache
+from comicnamer.cassette import Cassette
+from comicnamer.utils import FileParser
+from comicnamer.catalog import Catalog, CatalogWriter
+from comicnamer import lookup as lookup_module
+from comicnamer.lookup import (Backend, CachedBackend, VolumeInfo,
+ComicvineBackend, PrefetchingBackend, ResolvingBackend, OfflineBackend,
+CircuitBreaker, RecordingBackend, ReplayBackend, ProviderChain,
+AliasBackend, getProviderNames, getAliases)
+from comicnamer.comicnamer_exceptions import (volumeNotFound, IssueNotFound,
+IssueNameNotFound, DataRetrievalError, ServiceUnavailable, UserAbort,
+ConfigValueError)
+
+
+class MissingBackend(Backend):
+    """Has no issue 1, and no name for issue 2
+    """
+
+    def getIssueName(self, volume, issueno):
+        if issueno == 1:
+            raise IssueNotFound("No issue 1")
+        raise IssueNameNotFound("No name for issue 2")
+
+
+class FakeIssue(dict):
+    """An issue as returned by comicvine_api, raising
+    comicvine_attributenotfound for missing attributes
+    """
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise comicvine_attributenotfound(key)
+        return dict.__getitem__(self, key)
+
+
+class FakeVolume(dict):
+    """A volume as returned by comicvine_api, a dict of issues by number
+    which also has the volume's attributes
+    """
+
+    def __init__(self, volumeid, volumename, issues):
+        dict.__init__(self, issues)
+        self.attributes = {'id': volumeid, 'volumename': volumename}
+
+    def __getitem__(self, key):
+        if key in self.attributes:
+            return self.attributes[key]
+        return dict.__getitem__(self, key)
+
+
+class FakeComicvine(object):
+    """Has one volume, Volume, with issues 1 to 3. Issue 2 has no name
+    """
+
+    def __getitem__(self, key):
+        return FakeVolume(1, u"Volume", {1: FakeIssue(issuename = u"One"),
+            2: FakeIssue(), 3: FakeIssue(issuename = u"Three")})
+
+
+class FailingComicvine(FakeComicvine):
+    """Times out the first failures requests
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.requests = 0
+
+    def __getitem__(self, key):
+        self.requests += 1
+        if self.requests <= self.failures:
+            raise socket.timeout("timed out")
+        return FakeComicvine.__getitem__(self, key)
+
+
+class FakeClock(object):
+    """Replaces the time module, sleeping by moving the time on
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ListingBackend(Backend):
+    """Has every issue of every volume, counting the issues looked up one
+    at a time and the listings fetched
+    """
+
+    def __init__(self):
+        self.lookups = 0
+        self.listings = 0
+
+    def findVolume(self, name):
+        return VolumeInfo(1, name)
+
+    def getIssueName(self, volume, issueno):
+        self.lookups += 1
+        return u"Issue %s" % issueno
+
+    def listIssues(self, volume):
+        self.listings += 1
+        return dict((unicode(x), u"Issue %s" % x) for x in range(1, 10))
+
+
+class ScriptedBackend(Backend):
+    """Finds Volume, but not Missing, and cannot contact comicvine.com for
+    Busy or Slow. Volume has a named issue 1, an issue 2 without a name, no
+    issue 3, and looking up issue 4 times out
+    """
+
+    def findVolume(self, name):
+        if name == u"Missing":
+            raise volumeNotFound("Missing not found")
+        if name == u"Busy":
+            raise ServiceUnavailable("Busy", retry_after = 60)
+        if name == u"Slow":
+            raise DataRetrievalError("Timed out")
+        return VolumeInfo(1, u"Volume")
+
+    def getIssueName(self, volume, issueno):
+        if issueno == 2:
+            raise IssueNameNotFound("No name for issue 2")
+        if issueno == 3:
+            raise IssueNotFound("No issue 3")
+        if issueno == 4:
+            raise DataRetrievalError("Timed out")
+        return u"One"
+
+    def listIssues(self, volume):
+        return {u"1": u"One", u"2": None}
+
+
+class FakeProvider(Backend):
+    """Has the volumes named in volumes, and the issues of volume ids in
+    issues, a dict of (volume id, issue number) to name. Raises error (if
+    given) instead of volumeNotFound. Appends its name and the method called
+    to calls
+    """
+
+    def __init__(self, name, calls, volumes = (), issues = None, error = None):
+        self.name = name
+        self.calls = calls
+        self.volumes = volumes
+        self.issues = issues or {}
+        self.error = error
+        self.expected = []
+        self.found_volumes = []
+
+    def findVolume(self, name):
+        self.calls.append((self.name, 'findVolume'))
+        if name in self.volumes:
+            return VolumeInfo(self.volumes.index(name), name)
+        if self.error is not None:
+            raise self.error
+        raise volumeNotFound("%s not found by %s" % (name, self.name))
+
+    def getIssueName(self, volume, issueno):
+        self.calls.append((self.name, 'getIssueName'))
+        try:
+            return self.issues[(volume.volumeid, issueno)]
+        except KeyError:
+            raise IssueNotFound("%s not found by %s" % (issueno, self.name))
+
+    def expect(self, volumename, issuenumbers):
+        self.expected.append((volumename, issuenumbers))
+
+    def found(self, name, volume):
+        self.found_volumes.append(name)
+
+
+class ClockTestCase(unittest.TestCase):
+    """Runs with lookup using a FakeClock, and warnings captured
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.original_time = lookup_module.time
+        lookup_module.time = self.clock
+        self.original_stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.original_stderr
+        lookup_module.time = self.original_time
+
+
+class test_circuit_breaker(ClockTestCase):
+    """Tests CircuitBreaker
+    """
+
+    def test_open_half_open_close(self):
+        breaker = CircuitBreaker(threshold = 2, cooldown = 60)
+        breaker.check()
+        breaker.failed()
+        breaker.check()
+        breaker.failed()
+
+        # Open
+        try:
+            breaker.check()
+        except ServiceUnavailable, errormsg:
+            self.assertEqual(errormsg.retry_after, 60)
+        else:
+            self.fail("Open circuit did not raise ServiceUnavailable")
+        self.clock.now += 59
+        self.assertRaises(ServiceUnavailable, breaker.check)
+
+        # Half open: a single trial request, which fails
+        self.clock.now += 1
+        breaker.check()
+        self.assertRaises(ServiceUnavailable, breaker.check)
+        breaker.failed()
+        self.assertRaises(ServiceUnavailable, breaker.check)
+
+        # A successful trial closes the circuit
+        self.clock.now += 60
+        breaker.check()
+        breaker.succeeded()
+        breaker.check()
+        breaker.check()
+        breaker.failed()
+        breaker.check()
+
+        self.assertEqual((breaker.opened, breaker.rejected), (2, 4))
+
+
+class test_comicvine_backend(ClockTestCase):
+    """Tests ComicvineBackend retrying failed requests
+    """
+
+    def test_timeouts_retried(self):
+        comicvine = FailingComicvine(failures = 2)
+        lookup = ComicvineBackend(comicvine, retries = 2, backoff = 1.0)
+        self.assertEqual(lookup.findVolume(u"Volume").volumename, u"Volume")
+        self.assertEqual((comicvine.requests, lookup.retried), (3, 2))
+
+        # Backoff doubles, with jitter of up to half the delay
+        self.assertEqual(len(self.clock.slept), 2)
+        self.assertTrue(0.5 <= self.clock.slept[0] <= 1.0)
+        self.assertTrue(1.0 <= self.clock.slept[1] <= 2.0)
+
+    def test_retries_exhausted(self):
+        comicvine = FailingComicvine(failures = 3)
+        lookup = ComicvineBackend(comicvine, retries = 2, backoff = 1.0)
+        self.assertRaises(DataRetrievalError, lookup.findVolume, u"Volume")
+        self.assertEqual(comicvine.requests, 3)
+
+    def test_breaker_stops_requests(self):
+        comicvine = FailingComicvine(failures = 2)
+        lookup = ComicvineBackend(comicvine, breaker = CircuitBreaker(threshold = 2, cooldown = 60))
+        for attempt in range(2):
+            self.assertRaises(DataRetrievalError, lookup.findVolume, u"Volume")
+        self.assertRaises(ServiceUnavailable, lookup.findVolume, u"Volume")
+        self.assertEqual(comicvine.requests, 2)
+
+        self.clock.now += 60
+        self.assertEqual(lookup.findVolume(u"Volume").volumename, u"Volume")
+        lookup.findVolume(u"Volume")
+        self.assertEqual(comicvine.requests, 4)
+
+
+class test_provider_chain(unittest.TestCase):
+    """Tests ProviderChain
+    """
+
+    def setUp(self):
+        self.calls = []
+
+    def test_fallthrough_order(self):
+        first = FakeProvider("first", self.calls, volumes = [u"A"], issues = {(0, 1): u"A1"})
+        second = FakeProvider("second", self.calls, volumes = [u"A", u"B"], issues = {(0, 2): u"A2"})
+        lookup = ProviderChain([("first", first), ("second", second)])
+
+        volume = lookup.findVolume(u"A")
+        self.assertEqual(self.calls, [("first", 'findVolume')])
+        self.assertEqual(lookup.findVolume(u"B").volumename, u"B")
+        self.assertEqual(self.calls[1:], [("first", 'findVolume'), ("second", 'findVolume')])
+
+        # Volume ids are shared, so the second provider has issues of
+        # volumes found by the first
+        self.calls[:] = []
+        self.assertEqual(lookup.getIssueName(volume, 1), u"A1")
+        self.assertEqual(lookup.getIssueName(volume, 2), u"A2")
+        self.assertEqual(self.calls, [("first", 'getIssueName'),
+            ("first", 'getIssueName'), ("second", 'getIssueName')])
+
+        self.assertEqual(lookup.stats["first"][:2], [2, 2])
+        self.assertEqual(lookup.stats["second"][:2], [2, 0])
+
+    def test_last_error_raised(self):
+        first = FakeProvider("first", self.calls, error = ServiceUnavailable("Busy", retry_after = 60))
+        second = FakeProvider("second", self.calls)
+        lookup = ProviderChain([("first", first), ("second", second)])
+        try:
+            lookup.findVolume(u"A")
+        except volumeNotFound, errormsg:
+            self.assertEqual(str(errormsg), "A not found by second")
+        else:
+            self.fail("volumeNotFound not raised")
+
+        lookup = ProviderChain([("second", second), ("first", first)])
+        self.assertRaises(ServiceUnavailable, lookup.findVolume, u"A")
+
+    def test_other_errors_not_passed_on(self):
+        first = FakeProvider("first", self.calls, error = UserAbort("Aborted"))
+        second = FakeProvider("second", self.calls, volumes = [u"A"])
+        lookup = ProviderChain([("first", first), ("second", second)])
+        self.assertRaises(UserAbort, lookup.findVolume, u"A")
+        self.assertEqual(self.calls, [("first", 'findVolume')])
+
+    def test_hooks_reach_every_provider(self):
+        first = FakeProvider("first", self.calls)
+        second = FakeProvider("second", self.calls)
+        lookup = ProviderChain([("first", first), ("second", second)])
+        lookup.expect(u"A", [1])
+        lookup.found(u"A", VolumeInfo(1, u"A"))
+        for provider in (first, second):
+            self.assertEqual(provider.expected, [(u"A", [1])])
+            self.assertEqual(provider.found_volumes, [u"A"])
+
+
+class test_provider_names(unittest.TestCase):
+    """Tests getProviderNames and --providers
+    """
+
+    def setUp(self):
+        self.original_config = dict(Config)
+
+    def tearDown(self):
+        Config.clear()
+        Config.update(self.original_config)
+
+    def test_command_line(self):
+        opter = cliarg_parser.getCommandlineParser(defaults)
+        opts, args = opter.parse_args(["--providers", " catalog, comicvine,", "path"])
+        self.assertEqual(opts.providers, ['catalog', 'comicvine'])
+
+    def test_names(self):
+        Config['providers'] = ['catalog', 'comicvine']
+        self.assertEqual(getProviderNames(), ['catalog', 'comicvine'])
+
+        Config['replay_cassette'] = "cassette.json"
+        self.assertEqual(getProviderNames(), ['catalog', 'cassette'])
+
+        Config['offline'] = True
+        self.assertEqual(getProviderNames(), ['catalog'])
+
+    def test_unknown_name(self):
+        Config['providers'] = ['comicvine', 'elsewhere']
+        self.assertRaises(ConfigValueError, getProviderNames)
+
+
+class test_alias_backend(unittest.TestCase):
+    """Tests AliasBackend and volume_aliases
+    """
+
+    def setUp(self):
+        self.calls = []
+        self.original_config = dict(Config)
+
+    def tearDown(self):
+        Config.clear()
+        Config.update(self.original_config)
+
+    def test_pinned_not_searched(self):
+        inner = FakeProvider("inner", self.calls, issues = {(42, 1): u"One"})
+        lookup = AliasBackend(inner, {u"batman": (u"Batman (2011)", 42)})
+
+        lookup.expect(u"The Batman", [1])
+        volume = lookup.findVolume(u"The Batman")
+        self.assertEqual((volume.volumeid, volume.volumename), (42, u"Batman (2011)"))
+        self.assertEqual(lookup.getIssueName(volume, 1), u"One")
+
+        self.assertEqual(self.calls, [("inner", 'getIssueName')])
+        self.assertEqual(inner.expected, [(u"Batman (2011)", [1])])
+        self.assertEqual(inner.found_volumes, [u"Batman (2011)"])
+        self.assertEqual((lookup.pinned, lookup.renamed), (1, 0))
+
+    def test_searched_by_alias(self):
+        inner = FakeProvider("inner", self.calls, volumes = [u"Amazing Spider-Man", u"Batman"])
+        lookup = AliasBackend(inner, {u"asm": (u"Amazing Spider-Man", None)})
+        self.assertEqual(lookup.findVolume(u"ASM").volumename, u"Amazing Spider-Man")
+        self.assertEqual(lookup.findVolume(u"Batman").volumename, u"Batman")
+        self.assertRaises(volumeNotFound, lookup.findVolume, u"Superman")
+        self.assertEqual((lookup.pinned, lookup.renamed), (0, 1))
+
+    def test_pinned_volume_prefetched(self):
+        """Issues expected for a pinned volume count towards fetching its
+        issue list
+        """
+        inner = ListingBackend()
+        lookup = AliasBackend(PrefetchingBackend(inner, threshold = 1), {u"bats": (u"Batman", 1)})
+        lookup.expect(u"Bats", [1, 2])
+        volume = lookup.findVolume(u"Bats")
+        lookup.getIssueName(volume, 1)
+        lookup.getIssueName(volume, 2)
+        self.assertEqual((inner.lookups, inner.listings), (0, 1))
+
+    def test_config_keys_match_parsed_names(self):
+        """Aliases configured with any spelling match the volume names
+        parsed from filenames, after cleanRegexedvolumeName
+        """
+        Config['volume_aliases'] = {
+            "The Amazing Spider-Man": {"name": "Amazing Spider-Man", "id": 1},
+            "batman and robin": "Batman & Robin (2009)"}
+        inner = FakeProvider("inner", self.calls, volumes = [u"Batman & Robin (2009)"])
+        lookup = AliasBackend(inner, getAliases())
+
+        parser = FileParser()
+        for filename in ("the.amazing.spider-man.001.cbz", "the_amazing_spider-man_001.cbz",
+                "Amazing Spider-Man - 001.cbz"):
+            issue = parser.parse(os.path.join("/comics", filename))
+            self.assertEqual(lookup.findVolume(issue.volumename).volumeid, 1)
+        self.assertEqual(self.calls, [])
+
+        issue = parser.parse("/comics/Batman_&_Robin_-_001.cbz")
+        self.assertEqual(lookup.findVolume(issue.volumename).volumename, u"Batman & Robin (2009)")
+        self.assertEqual((lookup.pinned, lookup.renamed), (3, 1))
+
+    def test_invalid_config(self):
+        for alias in (1, {"id": 1}, {"name": "Batman", "id": "1"}, ["Batman"]):
+            Config['volume_aliases'] = {"Bats": alias}
+            self.assertRaises(ConfigValueError, getAliases)
+
+
+class test_nameless_issues(unittest.TestCase):
+    """Tests issues without a name are kept in issue lists
+    """
+
+    def test_comicvine_listing(self):
+        lookup = ComicvineBackend(FakeComicvine())
+        volume = lookup.findVolume(u"Volume")
+        self.assertEqual(lookup.listIssues(volume),
+            {u"1": u"One", u"2": None, u"3": u"Three"})
+
+    def test_prefetched(self):
+        lookup = PrefetchingBackend(ComicvineBackend(FakeComicvine()), threshold = 0)
+        lookup.expect(u"Volume", [1, 2])
+        volume = lookup.findVolume(u"Volume")
+        self.assertEqual(lookup.getIssueName(volume, 1), u"One")
+        self.assertRaises(IssueNameNotFound, lookup.getIssueName, volume, 2)
+        self.assertRaises(IssueNotFound, lookup.getIssueName, volume, 4)
+        self.assertEqual(len(lookup._issues), 1)
+
+    def test_catalog(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            writer = CatalogWriter(os.path.join(tmpdir, "catalog"))
+            writer.addVolume(u"volume", 1, u"Volume")
+            comicvine = ComicvineBackend(FakeComicvine())
+            for issueno, issuename in comicvine.listIssues(comicvine.findVolume(u"Volume")).items():
+                writer.addIssue(1, issueno, issuename)
+            writer.write()
+
+            lookup = OfflineBackend(Catalog(writer.path))
+            volume = lookup.findVolume(u"Volume")
+            self.assertEqual(lookup.listIssues(volume),
+                {u"1": u"One", u"2": None, u"3": u"Three"})
+            self.assertRaises(IssueNameNotFound, lookup.getIssueName, volume, 2)
+            lookup.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class test_prefetching_backend(unittest.TestCase):
+    """Tests PrefetchingBackend
+    """
+
+    def test_expected_after_resolved(self):
+        """Issues expected after their volume was resolved count towards
+        fetching its issue list, as in stream mode, where later lookups
+        of the volume are answered by ResolvingBackend
+        """
+        inner = ListingBackend()
+        lookup = ResolvingBackend(PrefetchingBackend(inner, threshold = 2))
+
+        lookup.expect(u"Volume", [1])
+        volume = lookup.findVolume(u"Volume")
+        lookup.getIssueName(volume, 1)
+
+        lookup.expect(u"The Volume", [2, 3])
+        volume = lookup.findVolume(u"The Volume")
+        lookup.getIssueName(volume, 2)
+        lookup.getIssueName(volume, 3)
+
+        self.assertEqual((inner.lookups, inner.listings), (1, 1))
+
+
+class test_cassettes(unittest.TestCase):
+    """Tests RecordingBackend and ReplayBackend
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "cassette.json.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def lookUp(self, lookup):
+        """Returns the result, or class of error raised, of each lookup
+        """
+
+        def result(method, *args):
+            try:
+                return getattr(lookup, method)(*args)
+            except DataRetrievalError, errormsg:
+                return errormsg.__class__
+
+        volume = lookup.findVolume(u"Volume")
+        return ([result('findVolume', name) for name in (u"Missing", u"Busy", u"Slow")]
+            + [result('getIssueName', volume, issueno) for issueno in (1, 2, 3, 4)]
+            + [(volume.volumeid, volume.volumename)])
+
+    def test_round_trip(self):
+        lookup = RecordingBackend(ScriptedBackend(), Cassette(self.path))
+        recorded = self.lookUp(lookup)
+        lookup.close()
+        self.assertEqual(recorded[:3], [volumeNotFound, ServiceUnavailable, DataRetrievalError])
+
+        cassette = Cassette(self.path)
+        cassette.load()
+        self.assertEqual(sorted(cassette.entries['volumes']), [u"missing", u"volume"])
+        self.assertEqual(sorted(cassette.entries['issues']), [u"1/1", u"1/2", u"1/3"])
+
+        # Only definitive results were recorded, other errors are replayed
+        # as the lookup not being recorded
+        replayed = self.lookUp(ReplayBackend(cassette))
+        self.assertEqual(replayed, recorded[:1] + [DataRetrievalError] * 2 + recorded[3:])
+
+    def test_listing_replayed_for_issues(self):
+        lookup = RecordingBackend(ScriptedBackend(), Cassette(self.path))
+        lookup.listIssues(VolumeInfo(1, u"Volume"))
+        lookup.close()
+
+        cassette = Cassette(self.path)
+        cassette.load()
+        lookup = ReplayBackend(cassette)
+        volume = VolumeInfo(1, u"Volume")
+        self.assertEqual(lookup.getIssueName(volume, 1), u"One")
+        self.assertRaises(IssueNameNotFound, lookup.getIssueName, volume, 2)
+        self.assertRaises(IssueNotFound, lookup.getIssueName, volume, 3)
+
+
+class test_cached_backend(unittest.TestCase):
+    """Tests CachedBackend
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = LookupCache(os.path.join(self.tmpdir, "cache.sqlite"),
+            ttl = 3600, max_entries = 100)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cached_missing_issues_raise_same_error(self):
+        lookup = CachedBackend(MissingBackend(), self.cache)
+        volume = VolumeInfo(1, u"Volume")
+        for attempt in ("cold", "warm"):
+            self.assertRaises(IssueNotFound, lookup.getIssueName, volume, 1)
+            self.assertRaises(IssueNameNotFound, lookup.getIssueName, volume, 2)
+        self.assertEqual(lookup.known_missing, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests the main renaming loop
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer import main
+from comicnamer.config import Config
+from comicnamer.utils import FileParser
+from comicnamer.lookup import (Backend, VolumeInfo, ResolvingBackend,
+PrefetchingBackend)
+from comicnamer.comicnamer_exceptions import (volumeNotFound,
+NoValidFilesFoundError, ServiceUnavailable)
+
+
+class FakeBackend(Backend):
+    """Finds every volume, except those named "Missing", and names every
+    issue. Counts the issues looked up
+    """
+
+    def __init__(self):
+        self.lookups = 0
+
+    def findVolume(self, name):
+        if name == "Missing":
+            raise volumeNotFound("Missing not found")
+        return VolumeInfo(1, name)
+
+    def getIssueName(self, volume, issueno):
+        self.lookups += 1
+        return u"Issue %d" % issueno
+
+
+class UnavailableBackend(FakeBackend):
+    """Raises ServiceUnavailable, to be retried after 30 seconds, until
+    clock reaches available
+    """
+
+    def __init__(self, clock, available):
+        FakeBackend.__init__(self)
+        self.clock = clock
+        self.available = available
+        self.attempts = 0
+
+    def findVolume(self, name):
+        self.attempts += 1
+        if self.clock.now < self.available:
+            raise ServiceUnavailable("Unavailable", retry_after = 30)
+        return FakeBackend.findVolume(self, name)
+
+
+class FakeClock(object):
+    """Replaces the time module, sleeping by moving the time on
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class MainTestCase(unittest.TestCase):
+    """Runs with a temporary directory, Config restored afterwards, output
+    captured, and lookups made by a FakeBackend
+    """
+
+    config = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.original_config = dict(Config)
+        Config.update(self.config)
+
+        self.lookup = FakeBackend()
+        self.original_getLookup = main.getLookup
+        self.original_getComicvine = main.getComicvine
+        main.getLookup = lambda comicvine: self.lookup
+        main.getComicvine = lambda: None
+
+        self.original_stdout, self.original_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.original_stdout, self.original_stderr
+        main.getLookup = self.original_getLookup
+        main.getComicvine = self.original_getComicvine
+        Config.clear()
+        Config.update(self.original_config)
+        shutil.rmtree(self.tmpdir)
+
+    def makeFiles(self, *paths):
+        for path in paths:
+            path = os.path.join(self.tmpdir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, "w").close()
+
+
+class test_stream(MainTestCase):
+    """Tests comicnamerStream
+    """
+
+    config = {
+        'stream': True,
+        'stream_sort_window': 0,
+        'recursive': True,
+        'always_rename': True,
+        'select_first': True,
+        'skip_file_on_error': True,
+        'lookup_workers': 1}
+
+    def test_moved_files_skipped(self):
+        """Files moved into a directory which is searched later are not
+        found again. They are renamed so they would be parsed again, the
+        destination must exist before searching to be listed, and over 100
+        files are needed, as they are parsed in batches of 100 before any
+        are renamed
+        """
+        Config['move_files_enable'] = True
+        Config['filename_with_issue'] = '%(volumename)s %(issue)s %(issuename)s%(ext)s'
+        Config['filename_with_issue_no_season'] = Config['filename_with_issue']
+        Config['issue_single'] = '%03d'
+        Config['move_files_destination'] = os.path.join(self.tmpdir, "dest")
+        os.mkdir(Config['move_files_destination'])
+        self.makeFiles(*["Volume%03d 001.cbz" % x for x in range(120)])
+
+        main.comicnamerStream([self.tmpdir])
+        self.assertEqual(self.lookup.lookups, 120)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmpdir, "dest"))), 120)
+
+    def test_no_files_found(self):
+        self.makeFiles("notes.txt")
+        Config['valid_extensions'] = ["cbz"]
+        self.assertRaises(NoValidFilesFoundError, main.comicnamerStream, [self.tmpdir])
+
+    def test_all_files_skipped(self):
+        """Files which are found but skipped are not reported as no files
+        being found
+        """
+        self.makeFiles("Missing 001.cbz", "Missing 002.cbz")
+        main.comicnamerStream([self.tmpdir])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+            ["Missing 001.cbz", "Missing 002.cbz"])
+        self.assertTrue("# Processed 0 of 2 issues" in sys.stdout.getvalue())
+
+    def test_no_volume_name(self):
+        """Files without a volume name, such as s01e02.cbz, are sorted and
+        skipped as their volume is not found, rather than crashing
+        """
+        main.getLookup = lambda comicvine: ResolvingBackend(
+            PrefetchingBackend(self.lookup, threshold = 100))
+        names = ["1x05.cbz", "2010.01.02.cbz", "s01e02.cbz"]
+
+        for stream, window in ((True, 0), (True, 1000), (False, 0)):
+            Config['stream'] = stream
+            Config['stream_sort_window'] = window
+            self.makeFiles("Volume 001.cbz", *names)
+            self.lookup.lookups = 0
+
+            main.comicnamer([self.tmpdir])
+            self.assertEqual(self.lookup.lookups, 1)
+            self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                sorted(names + ["Volume - [01] - Issue 1.cbz"]))
+            os.remove(os.path.join(self.tmpdir, "Volume - [01] - Issue 1.cbz"))
+
+
+class test_deferred(MainTestCase):
+    """Tests iterDeferred
+    """
+
+    config = {
+        'always_rename': True,
+        'skip_file_on_error': True,
+        'circuit_breaker_action': 'defer'}
+
+    def setUp(self):
+        MainTestCase.setUp(self)
+        self.clock = FakeClock()
+        self.original_time = main.time
+        main.time = self.clock
+        parser = FileParser()
+        self.deferred = [parser.parse("/x/Volume %03d.cbz" % x) for x in (1, 2, 3)]
+
+    def tearDown(self):
+        main.time = self.original_time
+        MainTestCase.tearDown(self)
+
+    def test_waits_once(self):
+        """Waits until comicvine.com is tried again once, then looks up
+        every deferred issue
+        """
+        lookup = UnavailableBackend(self.clock, available = 1030)
+        issues = list(main.iterDeferred(lookup, self.deferred))
+        self.assertEqual(issues, self.deferred)
+        self.assertEqual(self.clock.slept, [30])
+        self.assertEqual(lookup.attempts, 4)
+        self.assertEqual([x.issuename for x in issues], [[u"Issue 1"], [u"Issue 2"], [u"Issue 3"]])
+
+    def test_still_unavailable(self):
+        """Issues still not looked up after waiting once are skipped, as
+        other lookup errors are, without waiting again
+        """
+        lookup = UnavailableBackend(self.clock, available = 1100)
+        self.assertEqual(list(main.iterDeferred(lookup, self.deferred)), [])
+        self.assertEqual(self.clock.slept, [30])
+        self.assertEqual(lookup.attempts, 4)
+
+    def test_nothing_deferred(self):
+        self.assertEqual(list(main.iterDeferred(FakeBackend(), [])), [])
+        self.assertEqual(list(main.iterDeferred(FakeBackend(), None)), [])
+        self.assertEqual(self.clock.slept, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests --analyze-patterns
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.pattern_analysis import PatternAnalysis
+
+
+class test_pattern_analysis(unittest.TestCase):
+    """Tests PatternAnalysis
+    """
+
+    def test_catastrophic_pattern_times_out(self):
+        """A pattern which backtracks catastrophically is stopped and
+        reported with the filename, and the other patterns still run
+        """
+        filenames = [u"Batman 012.cbz", u"a" * 40 + u"!", u"Detective Comics 027.cbz"]
+        analysis = PatternAnalysis(filenames, patterns = [
+            r'^(?P<volumename>(a+)+)$',
+            r'^(?P<volumename>.+?)[ ](?P<issuenumber>\d+)\.cbz$',
+        ], match_timeout = 0.5)
+        analysis.run()
+
+        self.assertEqual([(cpattern.index, filename) for cpattern, filename in analysis.timeouts],
+            [(0, u"a" * 40 + u"!")])
+        self.assertEqual(analysis.assigned, [1, None, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Tests filename pattern matchers
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.patterns import (CompiledPattern, PatternStats,
+    SequentialMatcher, AdaptiveMatcher, _analysePatterns)
+from comicnamer.config_defaults import defaults
+
+
+filenames = [
+    u"Batman 012.cbz",
+    u"Batman 013.cbr",
+    u"Detective Comics 027.cbz",
+    u"[group] Green Lantern - 007 [digital].cbz",
+    u"Superman.s01e02.cbz",
+    u"Action Comics 1x05.cbz",
+    u"no issue number.cbz",
+]
+
+
+def compilePatterns(patterns):
+    return [CompiledPattern(index, pattern) for index, pattern in enumerate(patterns)]
+
+
+def prefilteredAttempts(compiled_patterns, filename):
+    """Number of patterns SequentialMatcher would try, skipping those ruled
+    out by their prefilter
+    """
+    attempts = 0
+    for cpattern in compiled_patterns:
+        if cpattern.prefilter is not None and cpattern.prefilter.search(filename) is None:
+            continue
+        attempts += 1
+        if cpattern.regex.match(filename):
+            break
+    return attempts
+
+
+class test_adaptive_matcher(unittest.TestCase):
+    """Tests AdaptiveMatcher returns the same results as SequentialMatcher
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats = PatternStats(os.path.join(self.tmpdir, "stats.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def makeHot(self, cpattern):
+        self.stats.add(cpattern, attempts = 100, hits = 100, timed = 10, elapsed = 0.001)
+
+    def assertSameResults(self, compiled_patterns, matcher):
+        sequential = SequentialMatcher(compiled_patterns)
+        for filename in filenames:
+            expected = sequential.match(filename)
+            result = matcher.match(filename)
+            if expected is None:
+                self.assertEqual(result, None)
+            else:
+                self.assertEqual((result[0].index, result[1]), (expected[0].index, expected[1]))
+
+    def test_disjoint_patterns_not_retried(self):
+        """Earlier patterns which cannot match the same filenames are not
+        tried again after the hot pattern matches
+        """
+        compiled = compilePatterns([
+            r'^(?P<volumename>.+?)[ ](?P<issuenumber>\d+)\.cbr$',
+            r'^(?P<volumename>.+?)[ ](?P<issuenumber>\d+)\.cbz$',
+        ])
+        self.makeHot(compiled[1])
+        matcher = AdaptiveMatcher(compiled, stats = self.stats)
+        self.assertEqual(matcher._overlapping, [[], []])
+
+        self.assertSameResults(compiled, matcher)
+
+        _analysePatterns(compiled)
+        sequential = sum(prefilteredAttempts(compiled, x) for x in filenames)
+        self.assertTrue(sum(matcher._attempts) < sequential,
+            "%d attempts, %d sequentially" % (sum(matcher._attempts), sequential))
+
+    def test_overlapping_patterns_retried(self):
+        """An earlier pattern which could also match is still used
+        """
+        compiled = compilePatterns([
+            r'^(?P<volumename>.+)[ ](?P<issuenumber>\d+)[^\/]*$',
+            r'^(?P<volumename>.+?)[ ](?P<issuenumber>\d+)\.cbz$',
+        ])
+        self.makeHot(compiled[1])
+        matcher = AdaptiveMatcher(compiled, stats = self.stats)
+        self.assertEqual(matcher._overlapping, [[], [0]])
+        self.assertSameResults(compiled, matcher)
+
+    def test_default_patterns(self):
+        compiled = compilePatterns(defaults['filename_patterns'])
+        for cpattern in compiled[::3]:
+            self.makeHot(cpattern)
+        self.assertSameResults(compiled, AdaptiveMatcher(compiled, stats = self.stats))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Benchmarks writeComicInfo against rewriting the archive.
+
+Creates --archives synthetic CBZ files of --pages pages each (or uses the
+.cbz files in --path, which are copied first, as they are modified), then
+writes a ComicInfo.xml into each one: once into the archive without one,
+again replacing it, and by rewriting the whole archive as zipfile would
+need to. Reports the bytes written per archive and the time taken, and
+checks the archives are still valid.
+
+    python tools/bench_comicinfo_writer.py --archives 5 --pages 100 --page-size 2000
+"""
+
+import os
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer.comicinfo import writeComicInfo, readComicInfo, findComicInfo
+
+
+def makeArchive(path, pages, page_size):
+    """Creates a CBZ file of pages stored (uncompressed, as JPEGs usually
+    are) pages of page_size KB
+    """
+    archive = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+    try:
+        for x in range(pages):
+            archive.writestr("page%03d.jpg" % x, os.urandom(page_size * 1024))
+    finally:
+        archive.close()
+
+
+def rewriteComicInfo(path, series, number, title):
+    """Writes ComicInfo.xml by copying every member into a new archive,
+    returns the number of bytes written
+    """
+    data = ('<?xml version="1.0" encoding="utf-8"?>\n<ComicInfo><Series>%s</Series>'
+        '<Number>%s</Number><Title>%s</Title></ComicInfo>' % (series, number, title))
+
+    source = zipfile.ZipFile(path)
+    target = zipfile.ZipFile(path + ".new", "w")
+    try:
+        for info in source.infolist():
+            if info is not findComicInfo(source):
+                target.writestr(info, source.read(info))
+        target.writestr("ComicInfo.xml", data)
+    finally:
+        target.close()
+        source.close()
+
+    os.rename(path + ".new", path)
+    return os.path.getsize(path)
+
+
+def check(path, title):
+    archive = zipfile.ZipFile(path)
+    try:
+        bad = archive.testzip()
+    finally:
+        archive.close()
+    info = readComicInfo(path)
+    return bad is None and info is not None and info.title == title
+
+
+def bench(name, func, paths, title):
+    start = time.time()
+    written = [func(path, u"Volume", 1, title) for path in paths]
+    elapsed = time.time() - start
+
+    valid = all(check(path, title) for path in paths)
+    print "%-22s %12.0f bytes %10.1fms per archive%s" % (
+        name, float(sum(written)) / len(paths), 1000 * elapsed / len(paths),
+        ("" if valid else "  INVALID"))
+
+
+def main():
+    opter = OptionParser()
+    opter.add_option("--path", dest = "path", help = "Use copies of the .cbz files in this directory")
+    opter.add_option("--archives", type = "int", dest = "archives", default = 5)
+    opter.add_option("--pages", type = "int", dest = "pages", default = 100)
+    opter.add_option("--page-size", type = "int", dest = "page_size", default = 1000, help = "KB per page")
+    opts, args = opter.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix = "comicnamer_bench_")
+    try:
+        paths = []
+        if opts.path is None:
+            for x in range(opts.archives):
+                path = os.path.join(tmpdir, "volume %03d.cbz" % x)
+                makeArchive(path, opts.pages, opts.page_size)
+                paths.append(path)
+        else:
+            for name in sorted(os.listdir(opts.path)):
+                if name.lower().endswith(".cbz"):
+                    paths.append(os.path.join(tmpdir, name))
+                    shutil.copyfile(os.path.join(opts.path, name), paths[-1])
+
+        if len(paths) == 0:
+            opter.error("No archives found")
+
+        size = sum(os.path.getsize(x) for x in paths) / len(paths)
+        print "%d archives, %d bytes each on average" % (len(paths), size)
+
+        bench("append (new)", writeComicInfo, paths, u"First title")
+        bench("append (replace)", writeComicInfo, paths, u"Second title")
+        bench("rewrite", rewriteComicInfo, paths, u"Third title")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
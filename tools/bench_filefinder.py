@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Benchmarks FileFinder against the original listdir/isfile implementation.
+
+Creates a synthetic tree of comic files (or uses an existing directory given
+with --path, for example a library on NFS), then times a recursive scan with
+each implementation and checks they find the same files.
+
+    python tools/bench_filefinder.py --dirs 2000 --files 50 --threads 1,8,16
+
+--latency adds a delay to each listdir/stat call, to approximate a network
+filesystem when benchmarking on a local disk.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from comicnamer import utils
+from comicnamer.utils import FileFinder
+
+
+def legacyFindFilesInPath(startpath, with_extension = None, recursive = True):
+    """The original FileFinder._findFilesInPath, one listdir and one stat per
+    entry, recursing single-threaded
+    """
+    finder = FileFinder(startpath, with_extension = with_extension)
+    allfiles = []
+    for subf in os.listdir(unicode(startpath)):
+        if not finder._checkExtension(subf):
+            continue
+        newpath = os.path.join(startpath, subf)
+        newpath = os.path.abspath(newpath)
+        if os.path.isfile(newpath):
+            allfiles.append(newpath)
+        else:
+            if recursive:
+                allfiles.extend(legacyFindFilesInPath(newpath, with_extension, recursive))
+    return allfiles
+
+
+def makeTree(root, dirs, files, fanout):
+    """Creates dirs directories, with up to fanout subdirectories each, and
+    files empty files per directory
+    """
+    paths = [root]
+    for x in range(dirs):
+        parent = paths[x // fanout]
+        path = os.path.join(parent, "volume %d" % x)
+        os.mkdir(path)
+        paths.append(path)
+
+    for path in paths:
+        for x in range(files):
+            open(os.path.join(path, "Volume %03d (2011).cbz" % x), "w").close()
+
+    return len(paths) * files
+
+
+def addLatency(seconds):
+    """Delays every listdir and stat call, to simulate a network filesystem
+    """
+
+    def delayed(func):
+
+        def wrapper(*args, **kwargs):
+            time.sleep(seconds)
+            return func(*args, **kwargs)
+        return wrapper
+
+    os.listdir = delayed(os.listdir)
+    os.stat = delayed(os.stat)
+    if utils.scandir is not None:
+        utils.scandir = delayed(utils.scandir)
+
+
+def timeit(func, repeat):
+    best = None
+    for x in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    opter = OptionParser()
+    opter.add_option("--path", dest = "path", help = "Scan this directory instead of a synthetic tree")
+    opter.add_option("--dirs", type = "int", dest = "dirs", default = 1000)
+    opter.add_option("--files", type = "int", dest = "files", default = 20, help = "Files per directory")
+    opter.add_option("--fanout", type = "int", dest = "fanout", default = 10, help = "Subdirectories per directory")
+    opter.add_option("--threads", dest = "threads", default = "1,4,8,16", help = "Comma separated thread counts to try")
+    opter.add_option("--repeat", type = "int", dest = "repeat", default = 3)
+    opter.add_option("--latency", type = "float", dest = "latency", default = 0, help = "Milliseconds added to each listdir/stat call, to simulate NFS")
+    opts, args = opter.parse_args()
+
+    tmpdir = None
+    if opts.path is None:
+        tmpdir = tempfile.mkdtemp(prefix = "comicnamer_bench_")
+        root = tmpdir
+        count = makeTree(root, opts.dirs, opts.files, opts.fanout)
+        print "Created %d files in %d directories under %s" % (count, opts.dirs + 1, root)
+    else:
+        root = opts.path
+
+    if opts.latency > 0:
+        addLatency(opts.latency / 1000.0)
+
+    try:
+        elapsed, expected = timeit(lambda: legacyFindFilesInPath(root), opts.repeat)
+        expected = set(expected)
+        print "%-20s %8.3fs %8d files" % ("legacy", elapsed, len(expected))
+
+        for threads in [int(x) for x in opts.threads.split(",")]:
+            finder = FileFinder(root, recursive = True, threads = threads)
+            elapsed, found = timeit(finder.findFiles, opts.repeat)
+            same = set(found) == expected and len(found) == len(expected)
+            print "%-20s %8.3fs %8d files%s" % (
+                "threads=%d" % threads, elapsed, len(found), ("" if same else "  MISMATCH"))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
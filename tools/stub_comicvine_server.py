@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#encoding:utf-8
+#project:comicnamer
+#license:Creative Commons GNU GPL v2
+# http://creativecommons.org/licenses/GPL/2.0/
+
+"""Serves a small imitation of the comicvine.com API, for trying comicnamer's
+builtin client without contacting comicvine.com.
+
+    python tools/stub_comicvine_server.py --port 8420 --volumes 50
+    comicnamer --batch --client builtin --api-key x --base-url http://localhost:8420/ ...
+
+Volumes are named "Volume 1" to "Volume N" (ids 1001 onwards), each with
+--issues issues. Responses are compressed when the client accepts gzip, and
+connections are kept alive. The number of requests and connections is
+printed on exit (ctrl+c).
+"""
+
+import re
+import sys
+import gzip
+import time
+import urlparse
+import StringIO
+import threading
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+
+import simplejson as json
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.count("connections")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self.server.count("requests")
+        time.sleep(self.server.latency)
+
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        params = dict(urlparse.parse_qsl(query))
+        fields = params.get("field_list")
+
+        volume = re.match(r"/volume/4050-(\d+)/$", path)
+        if path == "/search/":
+            results = self.server.search(params.get("query", ""))
+            self.respond(results[:int(params.get("limit", 10))], fields)
+        elif path == "/issues/":
+            volumeid = int(params.get("filter", "volume:0").split(":")[1])
+            issues = self.server.issues(volumeid)
+            offset = int(params.get("offset", 0))
+            limit = int(params.get("limit", 100))
+            self.respond(issues[offset:offset + limit], fields, total = len(issues))
+        elif volume and int(volume.group(1)) in self.server.volumes:
+            self.respond(self.server.volumes[int(volume.group(1))], fields)
+        else:
+            self.respond(None, None, status_code = 101, error = "Object Not Found")
+
+    def respond(self, results, fields, total = None, status_code = 1, error = "OK"):
+        if fields is not None and results is not None:
+            fields = fields.split(",")
+            if isinstance(results, list):
+                results = [dict((k, v) for k, v in x.items() if k in fields) for x in results]
+            else:
+                results = dict((k, v) for k, v in results.items() if k in fields)
+
+        if total is None:
+            total = isinstance(results, list) and len(results) or 1
+        body = json.dumps({
+            "status_code": status_code,
+            "error": error,
+            "number_of_total_results": total,
+            "results": results})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressed = StringIO.StringIO()
+            gzipped = gzip.GzipFile(fileobj = compressed, mode = "wb")
+            gzipped.write(body)
+            gzipped.close()
+            body = compressed.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, volumes, issues, latency = 0, verbose = False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StubHandler)
+        self.latency = latency
+        self.verbose = verbose
+        self.issue_count = issues
+        self.volumes = dict((1000 + x, {
+            "id": 1000 + x,
+            "name": "Volume %d" % x,
+            "start_year": "2011",
+            "count_of_issues": issues}) for x in range(1, volumes + 1))
+
+        self.counts = {"requests": 0, "connections": 0}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        self._lock.acquire()
+        self.counts[name] += 1
+        self._lock.release()
+
+    def search(self, query):
+        words = query.lower().split()
+        return [volume for volumeid, volume in sorted(self.volumes.items())
+            if all(word in volume["name"].lower() for word in words)]
+
+    def issues(self, volumeid):
+        if volumeid not in self.volumes:
+            return []
+        return [{"id": volumeid * 1000 + x, "issue_number": str(x),
+            "name": "%s Issue %d" % (self.volumes[volumeid]["name"], x),
+            "description": "Unused " * 50} for x in range(1, self.issue_count + 1)]
+
+
+def main():
+    opter = OptionParser()
+    opter.add_option("--port", type = "int", dest = "port", default = 8420)
+    opter.add_option("--volumes", type = "int", dest = "volumes", default = 50)
+    opter.add_option("--issues", type = "int", dest = "issues", default = 250, help = "Issues per volume")
+    opter.add_option("--latency", type = "float", dest = "latency", default = 0, help = "Milliseconds added to each response")
+    opter.add_option("-v", "--verbose", action = "store_true", dest = "verbose", default = False)
+    opts, args = opter.parse_args()
+
+    server = StubServer(("localhost", opts.port), opts.volumes, opts.issues,
+        latency = opts.latency / 1000.0, verbose = opts.verbose)
+    print "Serving %d volumes on http://localhost:%d/" % (opts.volumes, opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print "%(requests)d requests, %(connections)d connections" % server.counts
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()